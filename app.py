@@ -16,16 +16,40 @@ app.config.from_object(Config)
 CORS(app)
 
 # 注册路由蓝图
-from routes import session_bp, faq_bp, chat_bp, stats_bp, meta_bp
-# 可选：WebSocket 广播（实时弹幕推送）
-# NOTE: 临时禁用自动启动 websockets 服务以避免在某些环境中因 asyncio loop 导致的线程异常。
-bullet_ws = None
+from routes import session_bp, faq_bp, chat_bp, stats_bp, meta_bp, tts_bp, metrics_bp
+# 可选：WebSocket 广播（实时弹幕推送），由 BULLET_WS_ENABLED 控制
+from services import bullet_ws
 
 app.register_blueprint(session_bp)
 app.register_blueprint(faq_bp)
 app.register_blueprint(chat_bp)
 app.register_blueprint(stats_bp)
 app.register_blueprint(meta_bp)
+app.register_blueprint(tts_bp)
+app.register_blueprint(metrics_bp)
+
+# 请求级工作单元：同一请求内的数据库访问共用一个连接，返回响应前统一提交
+if Config.DB_REQUEST_UOW:
+    from flask import jsonify, request
+    from db_backend import db
+
+    @app.before_request
+    def _begin_db_unit_of_work():
+        if request.path.startswith('/api/'):
+            db.begin_unit_of_work()
+
+    @app.after_request
+    def _commit_db_unit_of_work(response):
+        # 在响应发出前提交：提交失败时返回 500，而不是让客户端以为写入已成功
+        if request.path.startswith('/api/') and not db.checkpoint():
+            response = jsonify({"error": "保存数据失败，请稍后重试"})
+            response.status_code = 500
+        return response
+
+    @app.teardown_request
+    def _end_db_unit_of_work(exc):
+        # 视图抛出异常时回滚；流式响应在生成期间的写入在这里提交
+        db.end_unit_of_work(commit=exc is None)
 
 # 静态文件路由
 @app.route('/')
@@ -50,8 +74,8 @@ if __name__ == '__main__':
     
     # 启动可选的 WebSocket 广播服务（非强依赖）
     try:
-        if bullet_ws:
-            bullet_ws.start_server(host='127.0.0.1', port=6789)
+        if Config.BULLET_WS_ENABLED:
+            bullet_ws.start_server(host=Config.BULLET_WS_HOST, port=Config.BULLET_WS_PORT)
     except Exception:
         logger.warning('启动 WebSocket 广播服务失败，继续以 HTTP 模式运行')
 
@@ -18,19 +18,56 @@ class Config:
     DB_PASSWORD = os.getenv('DB_PASSWORD', '')
     DB_NAME = os.getenv('DB_NAME', 'live_assistant')
     DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+    DB_REQUEST_UOW = os.getenv('DB_REQUEST_UOW', 'True').lower() == 'true'  # 每个 HTTP 请求共用一个数据库连接并统一提交
     
     # AI配置
     DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY', '')
     DEEPSEEK_API_URL = os.getenv('DEEPSEEK_API_URL', 'https://api.deepseek.com/chat/completions')
     DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
+    CHAT_COALESCE_TIMEOUT = float(os.getenv('CHAT_COALESCE_TIMEOUT', '35'))  # 相同问题等待进行中请求的秒数
     
     # 缓存配置
     QA_CACHE_MAX_SIZE = int(os.getenv('QA_CACHE_MAX_SIZE', '1000'))
     
+    # 弹幕批量写入（group commit）
+    BULLET_BUFFER_SIZE = int(os.getenv('BULLET_BUFFER_SIZE', '10000'))  # 内存缓冲容量，满时返回 429
+    BULLET_FLUSH_MS = int(os.getenv('BULLET_FLUSH_MS', '20'))  # 写线程的写入间隔（毫秒）
+    BULLET_FLUSH_ROWS = int(os.getenv('BULLET_FLUSH_ROWS', '500'))  # 攒够多少条立即写入
+    BULLET_BATCH_MAX = int(os.getenv('BULLET_BATCH_MAX', '500'))  # 单次请求最多弹幕条数
+    BULLET_COMMIT_TIMEOUT = float(os.getenv('BULLET_COMMIT_TIMEOUT', '5'))  # 请求等待落库的秒数
+    # 刷屏控制：每个用户（会话内）每秒可发弹幕数与突发上限（速率为 0 不限流）；
+    # 窗口秒数内相同（归一化后）的弹幕合并为一行并累加 repeat_count（0 不合并）
+    BULLET_USER_RATE = float(os.getenv('BULLET_USER_RATE', '1'))
+    BULLET_USER_BURST = int(os.getenv('BULLET_USER_BURST', '5'))
+    BULLET_COLLAPSE_WINDOW = float(os.getenv('BULLET_COLLAPSE_WINDOW', '10'))
+    BULLET_FLOOD_MAX_KEYS = int(os.getenv('BULLET_FLOOD_MAX_KEYS', '100000'))  # 限流与合并各自最多跟踪的 key 数
+    # 入库分类后，pending/claim 默认只取出优先级不低于该值的弹幕（问题类；问候、刷屏等不交给 AI）
+    BULLET_AI_MIN_PRIORITY = int(os.getenv('BULLET_AI_MIN_PRIORITY', '30'))
+    # 弹幕回答调度（/api/bullet-screen/next）：按用户加权公平排队、同话题合并、超时过期、每分钟回答预算
+    BULLET_ANSWERS_PER_MINUTE = int(os.getenv('BULLET_ANSWERS_PER_MINUTE', '30'))  # 0 表示不限
+    BULLET_MAX_AGE_SECONDS = int(os.getenv('BULLET_MAX_AGE_SECONDS', '120'))  # 等待超过该秒数的弹幕不再回答，0 表示不过期
+    BULLET_TOPIC_WINDOW_SECONDS = int(os.getenv('BULLET_TOPIC_WINDOW_SECONDS', '60'))  # 该时间内已回答过的话题直接合并
+    BULLET_SCHEDULE_PER_USER = int(os.getenv('BULLET_SCHEDULE_PER_USER', '3'))  # 每个用户进入候选窗口的最多条数
+    # WebSocket 实时推送（按会话房间订阅，合并发送，慢客户端丢弃最旧帧）
+    BULLET_WS_ENABLED = os.getenv('BULLET_WS_ENABLED', 'false').lower() == 'true'
+    BULLET_WS_HOST = os.getenv('BULLET_WS_HOST', '127.0.0.1')
+    BULLET_WS_PORT = int(os.getenv('BULLET_WS_PORT', '6789'))
+    BULLET_WS_QUEUE_SIZE = int(os.getenv('BULLET_WS_QUEUE_SIZE', '256'))  # 每个客户端发送队列的帧数上限
+    BULLET_WS_FLUSH_MS = int(os.getenv('BULLET_WS_FLUSH_MS', '50'))  # 合并发送间隔（毫秒）
+    BULLET_WS_HEARTBEAT = int(os.getenv('BULLET_WS_HEARTBEAT', '20'))  # 心跳间隔与超时（秒）
+    BULLET_WS_IDLE_TIMEOUT = int(os.getenv('BULLET_WS_IDLE_TIMEOUT', '60'))  # 连接后未订阅房间的最长秒数
+    BULLET_WS_STALL_TIMEOUT = int(os.getenv('BULLET_WS_STALL_TIMEOUT', '30'))  # 发送队列无进展的最长秒数
+    
+    # 语音合成配置
+    TTS_WORKERS = int(os.getenv('TTS_WORKERS', '4'))
+    TTS_JOB_TTL = int(os.getenv('TTS_JOB_TTL', '600'))  # 已结束任务在任务表中的保留秒数
+    TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))  # 音频缓存磁盘预算
+    
     # 文件路径
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     DATA_DIR = os.path.join(BASE_DIR, 'data')
     LOGS_DIR = os.path.join(BASE_DIR, 'logs')
+    AUDIO_DIR = os.path.join(BASE_DIR, 'static', 'audio')
     
     BLACKLIST_FILE = os.path.join(DATA_DIR, 'blacklist.json')
     WHITELIST_FILE = os.path.join(DATA_DIR, 'whitelist.json')
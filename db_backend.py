@@ -1,7 +1,14 @@
+import atexit
+import copy
+import functools
 import json
 import logging
 import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from sqlite3 import Error as SQLiteError
 
 import mysql.connector
@@ -9,10 +16,123 @@ from mysql.connector import Error as MySQLError
 from mysql.connector import pooling
 from dotenv import load_dotenv
 
+from utils.bullet_classifier import BulletClassifier, Classification, compile_lexicon
+from utils.db_pool import BlockingPool, CircuitBreaker, PoolTimeout
+from utils.hit_counter import HitCounter
+from utils.pattern_matcher import PatternMatcher
+from utils.periodic import PeriodicTask
+from utils.question_index import QuestionIndex
+from utils.rule_snapshot import RuleFileWatcher
+from utils.ttl_cache import TTLCache
+from utils.unit_of_work import UnitOfWork
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# qa_cache 淘汰顺序：lru 按最近使用时间，lfu 优先淘汰命中次数少的（同频次再按最近使用时间）
+QA_EVICTION_ORDER = {
+    "lru": "last_used_at ASC, id ASC",
+    "lfu": "hit_count ASC, last_used_at ASC, id ASC",
+}
+
+
+@functools.lru_cache(maxsize=2048)
+def _translate_query(backend, query):
+    """把 MySQL 风格的 SQL 转换为目标方言（每条语句只转换一次）。"""
+    if backend != "sqlite":
+        return query
+
+    replacements = {
+        "NOW()": "CURRENT_TIMESTAMP",
+        "BOOLEAN": "INTEGER",
+    }
+    for source, target in replacements.items():
+        query = query.replace(source, target)
+    return query.replace("%s", "?")
+
+
+class _ThreadSQLiteConnection:
+    """线程内复用的 SQLite 连接：close() 只回滚未提交的事务，不真正关闭连接。"""
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn):
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+
+# 版本化表结构迁移：按版本号顺序各执行一次，已应用的版本记录在 schema_version 表中。
+# 每一步都可重复执行（建表 IF NOT EXISTS、建/删索引前先检查），中途失败重启后可安全重跑。
+# 步骤格式：("call", 名称) 调用 Database 上按方言实现的 名称_mysql / 名称_sqlite；
+# ("sql", {方言: 语句})；("column", 表, 列名, {方言: 列定义})；("index", 表, 索引名, 列, 是否唯一)；
+# ("drop_index", 表, 索引名)。
+SCHEMA_MIGRATIONS = [
+    (1, "基础表结构", [("call", "_create_base_tables")]),
+    (2, "热点查询的组合索引", [
+        # get_conversations 按 id 游标分页，get_session 按创建时间排序
+        ("index", "conversations", "idx_conversations_session_id", "session_id, id", False),
+        ("index", "conversations", "idx_conversations_session_created", "session_id, created_at", False),
+        # save_product_info / get_product_info 按商品名查找
+        ("index", "products", "idx_products_session_name", "session_id, product_name", False),
+        # get_product_info / get_products_with_info 按商品读取补充信息（按 id 顺序合并）
+        ("index", "product_info", "idx_product_info_session_product", "session_id, product_id, id", False),
+        # 精确命中与写入按 (会话, 问题哈希) 唯一；建唯一索引前先删除重复行（保留最新一条）
+        ("sql", {
+            "mysql": "DELETE q FROM qa_cache q JOIN qa_cache newer ON newer.session_id = q.session_id "
+                     "AND newer.question_hash = q.question_hash AND newer.id > q.id",
+            "sqlite": "DELETE FROM qa_cache WHERE session_id IS NOT NULL AND id NOT IN "
+                      "(SELECT MAX(id) FROM qa_cache WHERE session_id IS NOT NULL GROUP BY session_id, question_hash)",
+        }),
+        ("index", "qa_cache", "uq_qa_cache_session_hash", "session_id, question_hash", True),
+        ("drop_index", "qa_cache", "idx_session_hash"),
+        # 按会话淘汰：lru 按最近使用时间，lfu 按命中次数
+        ("index", "qa_cache", "idx_qa_cache_session_used", "session_id, last_used_at", False),
+        ("index", "qa_cache", "idx_qa_cache_session_hits", "session_id, hit_count, last_used_at", False),
+        # get_pending_bullet_screens：WHERE session_id, is_processed ORDER BY priority DESC, created_at
+        ("index", "bullet_screen_queue", "idx_bullet_pending", "session_id, is_processed, priority DESC, created_at", False),
+        ("drop_index", "bullet_screen_queue", "idx_session_processed"),
+        # apply_faq_template 查重，FAQ 统计按会话取热门/未使用
+        ("index", "whitelist", "idx_whitelist_session_pattern", "session_id, pattern", False),
+        ("index", "whitelist", "idx_whitelist_session_hits", "session_id, hit_count, created_at", False),
+        ("drop_index", "whitelist", "idx_session_pattern"),
+        # get_faq_templates / apply_faq_template：WHERE product_type AND is_active ORDER BY priority DESC
+        ("index", "faq_templates", "idx_faq_templates_type_active", "product_type, is_active, priority", False),
+        ("drop_index", "faq_templates", "idx_product_type"),
+    ]),
+    (3, "弹幕队列租约与死信", [
+        # 认领者与租约到期时间：租约过期未确认的弹幕会被重新投递
+        ("column", "bullet_screen_queue", "claimed_by", {"mysql": "VARCHAR(64) NULL", "sqlite": "TEXT"}),
+        ("column", "bullet_screen_queue", "lease_expires_at", {"mysql": "TIMESTAMP NULL", "sqlite": "DATETIME"}),
+        # 投递次数达到上限仍未确认的弹幕转入死信，不再投递
+        ("column", "bullet_screen_queue", "attempts", {"mysql": "INT DEFAULT 0", "sqlite": "INTEGER DEFAULT 0"}),
+        ("column", "bullet_screen_queue", "dead_letter", {"mysql": "BOOLEAN DEFAULT FALSE", "sqlite": "INTEGER DEFAULT 0"}),
+        ("column", "bullet_screen_queue", "last_error", {"mysql": "VARCHAR(255) NULL", "sqlite": "TEXT"}),
+        ("index", "bullet_screen_queue", "idx_bullet_dead_letter", "session_id, dead_letter, id", False),
+    ]),
+    (4, "弹幕重复合并计数", [
+        # 刷屏合并：窗口内相同（归一化后）的弹幕只写入一行，其余计入该行的 repeat_count
+        ("column", "bullet_screen_queue", "repeat_count", {"mysql": "INT DEFAULT 1", "sqlite": "INTEGER DEFAULT 1"}),
+        ("column", "bullet_screen_queue", "dedupe_key", {"mysql": "VARCHAR(64) NULL", "sqlite": "TEXT"}),
+        # 写回重复次数时按 (session_id, dedupe_key) 找最新的一行
+        ("index", "bullet_screen_queue", "idx_bullet_dedupe", "session_id, dedupe_key, id", False),
+    ]),
+    (5, "弹幕话题合并", [
+        # 调度时合并到同话题代表弹幕的 id：随代表弹幕确认而完成，退回或租约过期时释放
+        ("column", "bullet_screen_queue", "merged_into", {"mysql": "INT NULL", "sqlite": "INTEGER"}),
+        ("index", "bullet_screen_queue", "idx_bullet_merged_into", "merged_into", False),
+    ]),
+]
+
 
 class Database:
     """Database abstraction preferring MySQL with an automatic SQLite fallback."""
@@ -26,34 +146,124 @@ class Database:
         self.backend = "mysql"
         self.pool = None
         self.mysql_error = None
+        self.schema_version = None
 
         data_dir = os.path.join(os.path.dirname(__file__), "data")
         os.makedirs(data_dir, exist_ok=True)
         self.sqlite_path = os.path.join(data_dir, "local_db.sqlite3")
+        # SQLite 调优：WAL 日志、每线程复用连接（False 时每次操作新建连接，使用默认回滚日志）
+        self.sqlite_tuned = os.getenv("SQLITE_TUNED", "True").lower() == "true"
+        self.sqlite_pragmas = {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),
+            "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+            "cache_size": -int(os.getenv("SQLITE_CACHE_KB", "20000")),
+            "temp_store": "MEMORY",
+        }
+        self._sqlite_local = threading.local()
+
+        # MySQL 连接池：用完时排队等待（超时只让本次操作失败），连续连接失败才熔断并回退到 SQLite，
+        # 回退后由后台健康探测在 MySQL 恢复时切回
+        self.pool_size = min(max(1, int(os.getenv("DB_POOL_SIZE", "5"))), pooling.CNX_POOL_MAXSIZE)
+        self.pool_wait_timeout = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+        self.mysql_breaker = CircuitBreaker(int(os.getenv("DB_BREAKER_FAILURES", "3")))
+        self._backend_lock = threading.Lock()
+        self.fallbacks = 0
+        self.failbacks = 0
+        self.exhausted = 0
+        self.health_probe = PeriodicTask(
+            self._probe_mysql, interval=float(os.getenv("DB_HEALTH_INTERVAL", "10")), name="mysql-health-probe"
+        )
 
         try:
-            self.pool = pooling.MySQLConnectionPool(
-                pool_name="mypool",
-                pool_size=5,
-                pool_reset_session=True,
-                host=self.host,
-                user=self.user,
-                password=self.password,
-                database=self.database,
-                ssl_disabled=True,
-            )
-            logger.info("✅ 数据库连接池创建成功 (MySQL)")
+            self.pool = self._create_mysql_pool()
+            logger.info(f"✅ 数据库连接池创建成功 (MySQL, 大小 {self.pool_size})")
         except MySQLError as err:
             self.pool = None
             self.backend = "sqlite"
             self.mysql_error = err
+            self.mysql_breaker.trip(err)
+            self.fallbacks += 1
             logger.error(f"❌ 数据库连接池创建失败，已回退到 SQLite: {err}")
             self._ensure_sqlite_db()
 
         self.blacklist_file = os.path.join(os.path.dirname(__file__), "data", "blacklist.json")
         self.whitelist_file = os.path.join(os.path.dirname(__file__), "data", "whitelist.json")
+        # 规则文件载入为内存快照并预编译匹配器，后台轮询文件变化后原子替换
+        rule_poll_interval = float(os.getenv("RULE_FILE_POLL_INTERVAL", "2"))
+        self.blacklist_rules = RuleFileWatcher(self.blacklist_file, self._compile_blacklist_file, rule_poll_interval)
+        self.whitelist_rules = RuleFileWatcher(self.whitelist_file, self._compile_whitelist_file, rule_poll_interval)
+        self.blacklist_rules.start()
+        self.whitelist_rules.start()
+
+        # 问答缓存：进程内 L1（LRU + TTL）位于 qa_cache 表之前，热点问题无需访问数据库
+        self.qa_cache_max_size = int(os.getenv("QA_CACHE_MAX_SIZE", "1000"))
+        self.qa_l1 = TTLCache(max_size=self.qa_cache_max_size, ttl=int(os.getenv("QA_L1_TTL", "300")))
+        # qa_cache 淘汰：每会话配额 + 全局上限，由后台线程定期或每 N 次新增后执行，写路径只计数
+        self.qa_cache_session_quota = int(os.getenv("QA_CACHE_SESSION_QUOTA", "500"))
+        self.qa_evict_policy = os.getenv("QA_EVICT_POLICY", "lru").lower()
+        if self.qa_evict_policy not in QA_EVICTION_ORDER:
+            logger.warning(f"未知的问答缓存淘汰策略 {self.qa_evict_policy}，使用 lru")
+            self.qa_evict_policy = "lru"
+        self.qa_evict_batch = int(os.getenv("QA_EVICT_BATCH", "200"))
+        self.qa_evict_every = max(1, int(os.getenv("QA_EVICT_EVERY", "50")))
+        self._qa_inserts = 0
+        self._qa_eviction_stats = {
+            'runs': 0, 'evicted_quota': 0, 'evicted_global': 0, 'last_run_at': None, 'last_duration_ms': None,
+        }
+        self.qa_evictor = PeriodicTask(
+            self.evict_qa_cache, interval=float(os.getenv("QA_EVICT_INTERVAL", "60")), name="qa-cache-evictor"
+        )
+        # 问答缓存与 FAQ 的命中计数先在内存累积，由后台线程批量写回（进程退出时写回剩余部分）
+        hit_flush_interval = float(os.getenv("HIT_FLUSH_INTERVAL", "5"))
+        hit_flush_threshold = int(os.getenv("HIT_FLUSH_THRESHOLD", "256"))
+        self.qa_hits = HitCounter(
+            lambda pending: self._flush_hit_counts('qa_cache', 'last_used_at', pending),
+            name='qa_cache', flush_interval=hit_flush_interval, flush_threshold=hit_flush_threshold,
+        )
+        self.faq_hits = HitCounter(
+            lambda pending: self._flush_hit_counts('whitelist', 'last_hit_at', pending),
+            name='whitelist', flush_interval=hit_flush_interval, flush_threshold=hit_flush_threshold,
+        )
+        # 合并的重复弹幕只在内存中累加，批量写回对应行的 repeat_count
+        self.bullet_repeats = HitCounter(
+            self._flush_bullet_repeats,
+            name='bullet_repeat', flush_interval=hit_flush_interval, flush_threshold=hit_flush_threshold,
+        )
+        self.qa_hits.start()
+        self.faq_hits.start()
+        self.bullet_repeats.start()
+        atexit.register(self.flush_hit_counters)
+        # 近似问题匹配：精确哈希未命中时，相似度不低于阈值的已缓存问题可复用答案（0 表示关闭）
+        self.qa_index = QuestionIndex()
+        self.qa_similarity_threshold = float(os.getenv("QA_SIMILARITY_THRESHOLD", "0.8"))
+        self._qa_similar_hits = 0
+        # 数据库中黑名单/白名单规则的已编译匹配器，按刷新周期重新编译
+        self._compiled_patterns = {}
+        self._compiled_patterns_lock = threading.Lock()
+        self.pattern_refresh_interval = int(os.getenv("PATTERN_REFRESH_INTERVAL", "60"))
+
+        # 会话事实缓存：会话信息、合并补充信息后的商品与商品类型。写路径递增版本号并失效，
+        # 短 TTL 作为多 worker 部署下其他进程写入的兜底
+        self.session_facts = TTLCache(max_size=1000, ttl=int(os.getenv("SESSION_FACTS_TTL", "30")))
+        self._session_versions = {}
+        self._session_versions_lock = threading.Lock()
+
+        # 弹幕入库分类：会话词典（商品名 + FAQ 模式）随会话事实版本与规则刷新周期重新编译
+        self.bullet_classifier = BulletClassifier()
+
+        # 弹幕队列租约：默认租约秒数与最大投递次数（达到后转入死信）
+        self.bullet_lease_seconds = int(os.getenv("BULLET_LEASE_SECONDS", "30"))
+        self.bullet_max_attempts = max(1, int(os.getenv("BULLET_MAX_ATTEMPTS", "5")))
+
+        # 请求级工作单元（按线程），见 begin_unit_of_work
+        self._uow_local = threading.local()
 
         self.init_tables()
+        self.qa_evictor.start()
+        if self.health_probe.interval > 0:
+            self.health_probe.start()
 
     def _ensure_sqlite_db(self):
         """Ensure the SQLite database file exists before first use."""
@@ -68,48 +278,184 @@ class Database:
         except SQLiteError as err:
             logger.error(f"❌ 无法创建本地 SQLite 数据库: {err}")
 
-    def _load_json_file(self, path):
-        try:
-            if not os.path.exists(path):
-                return {}
-            with open(path, 'r', encoding='utf-8') as handle:
-                return json.load(handle)
-        except Exception as err:
-            logger.warning(f"无法加载 JSON 文件 {path}: {err}")
-            return {}
+    def _db_pattern_version(self):
+        """数据库中的模式按刷新周期重新编译（其他进程如 import_faqs 写入的规则也能生效）。"""
+        return int(time.monotonic() // max(1, self.pattern_refresh_interval))
+
+    def _get_compiled(self, name, version, build):
+        """返回按 name 缓存的编译结果；version 变化时调用 build() 重新编译。"""
+        with self._compiled_patterns_lock:
+            entry = self._compiled_patterns.get(name)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        compiled = build()
+        with self._compiled_patterns_lock:
+            self._compiled_patterns[name] = (version, compiled)
+        return compiled
+
+    @classmethod
+    def _compile_blacklist_file(cls, data):
+        """编译 blacklist.json：'_global' 为敏感词匹配器，其余会话分区为 (用户名集合, 消息模式匹配器)。"""
+        compiled = {}
+        for key, items in data.items():
+            if not isinstance(items, list):
+                continue
+            if key == '_global':
+                compiled[key] = PatternMatcher(
+                    (word.lower().strip(), word) for word in items if isinstance(word, str) and word.strip()
+                )
+            else:
+                compiled[key] = cls._compile_blacklist(items)
+        return compiled
+
+    @classmethod
+    def _compile_whitelist_file(cls, data):
+        """编译 whitelist.json：每个会话分区一个 FAQ 匹配器。"""
+        return {key: cls._compile_whitelist(items) for key, items in data.items() if isinstance(items, list)}
+
+    @staticmethod
+    def _compile_blacklist(items):
+        """编译黑名单规则，返回 (用户名集合, 消息模式匹配器)。"""
+        usernames = set()
+        matcher = PatternMatcher()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            pattern = item.get('pattern')
+            item_type = item.get('type', 'message')
+            if item_type == 'username' and pattern:
+                usernames.add(pattern)
+            elif item_type == 'message' and pattern:
+                matcher.add(pattern)
+        return usernames, matcher
+
+    def _create_mysql_pool(self):
+        pool = pooling.MySQLConnectionPool(
+            pool_name="mypool",
+            pool_size=self.pool_size,
+            pool_reset_session=True,
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            ssl_disabled=True,
+        )
+        return BlockingPool(pool, self.pool_size, timeout=self.pool_wait_timeout)
 
     def _fallback_to_sqlite(self, reason):
         """Downgrade to SQLite backend after persistent MySQL failures."""
-        if self.backend == "sqlite":
-            return
+        with self._backend_lock:
+            if self.backend == "sqlite":
+                return
+            self.backend = "sqlite"
+            self.pool = None
+            self.mysql_error = reason
+            self.fallbacks += 1
 
-        self.backend = "sqlite"
-        self.pool = None
-        self.mysql_error = reason
         logger.warning(f"⚠️ MySQL 连接不可用，回退到 SQLite：{reason}")
+        self._clear_backend_caches()
         self._ensure_sqlite_db()
         # 初始化 SQLite 表结构，确保后续查询可用
-        self._init_tables_sqlite()
+        self.migrate()
+
+    def _probe_mysql(self):
+        """健康探测：当前回退在 SQLite 上时尝试连接 MySQL，恢复后重建连接池并切回。"""
+        if self.backend == "mysql":
+            return
+        try:
+            conn = mysql.connector.connect(
+                host=self.host,
+                user=self.user,
+                password=self.password,
+                database=self.database,
+                ssl_disabled=True,
+                connection_timeout=3,
+            )
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            finally:
+                conn.close()
+            pool = self._create_mysql_pool()
+        except MySQLError as err:
+            logger.debug(f"MySQL 健康探测失败: {err}")
+            return
+
+        with self._backend_lock:
+            if self.backend == "mysql":
+                return
+            self.pool = pool
+            self.backend = "mysql"
+            self.mysql_error = None
+            self.failbacks += 1
+        self.mysql_breaker.record_success()
+        # 回退期间写入 SQLite 的数据不会自动迁回 MySQL
+        logger.info("✅ MySQL 已恢复，切回 MySQL")
+        self._clear_backend_caches()
+        self.migrate()
+
+    def _clear_backend_caches(self):
+        """切换后端后，基于旧后端数据的进程内缓存全部失效。"""
+        self.qa_l1.clear()
+        self.session_facts.clear()
+
+    def get_pool_stats(self):
+        pool = self.pool
+        return {
+            'backend': self.backend,
+            'pool': pool.stats() if pool else None,
+            'pool_size': self.pool_size,
+            'exhausted': self.exhausted,
+            'breaker': self.mysql_breaker.stats(),
+            'fallbacks': self.fallbacks,
+            'failbacks': self.failbacks,
+            'health_probe_interval': self.health_probe.interval,
+        }
 
     def get_connection(self):
-        """Return a database connection for the active backend."""
+        """Return a database connection for the active backend.
+
+        当前线程处于 MySQL 工作单元中时，返回共享连接的包装（commit/close 作用于保存点）。
+        SQLite 已按线程复用连接，且 WAL 下长事务先读后写会因快照过期直接失败（不等待 busy_timeout），
+        因此 SQLite 后端不使用工作单元，各方法仍各自提交。
+        """
+        uow = getattr(self._uow_local, 'uow', None)
+        if uow is not None and self.backend == "mysql":
+            return uow.connection()
+        return self._new_connection()
+
+    def _new_connection(self):
         if self.backend == "mysql":
             try:
                 if self.pool:
-                    return self.pool.get_connection()
-                return mysql.connector.connect(
-                    host=self.host,
-                    user=self.user,
-                    password=self.password,
-                    database=self.database,
-                    ssl_disabled=True,
-                )
+                    conn = self.pool.get_connection()
+                else:
+                    conn = mysql.connector.connect(
+                        host=self.host,
+                        user=self.user,
+                        password=self.password,
+                        database=self.database,
+                        ssl_disabled=True,
+                    )
+            except (PoolTimeout, pooling.PoolError) as err:
+                # 连接池耗尽是负载问题：本次操作失败，但不回退
+                self.exhausted += 1
+                logger.warning(f"⚠️ 数据库连接池耗尽: {err}")
+                return None
             except MySQLError as err:
                 logger.error(f"❌ 获取数据库连接失败: {err}")
-                self._fallback_to_sqlite(err)
-                return self.get_connection()
+                if self.mysql_breaker.record_failure(err):
+                    self._fallback_to_sqlite(err)
+                    return self._new_connection()
+                return None
+            if self.mysql_breaker.consecutive_failures:
+                self.mysql_breaker.record_success()
+            return conn
 
         try:
+            if self.sqlite_tuned:
+                return self._thread_sqlite_connection()
             conn = sqlite3.connect(self.sqlite_path, check_same_thread=False)
             conn.row_factory = sqlite3.Row
             conn.execute("PRAGMA foreign_keys = ON")
@@ -118,6 +464,87 @@ class Database:
             logger.error(f"❌ 获取数据库连接失败: {err}")
             return None
 
+    def _thread_sqlite_connection(self):
+        """当前线程的 SQLite 连接，首次使用时创建并设置 PRAGMA。"""
+        local = self._sqlite_local
+        conn = getattr(local, "conn", None)
+        if conn is None or local.path != self.sqlite_path:
+            conn = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+            for name, value in self.sqlite_pragmas.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+            conn.execute("PRAGMA foreign_keys = ON")
+            local.conn, local.path = conn, self.sqlite_path
+        conn.row_factory = sqlite3.Row
+        return _ThreadSQLiteConnection(conn)
+
+    def begin_unit_of_work(self):
+        """在当前线程开启工作单元（可嵌套，由最外层负责提交；仅对 MySQL 后端生效，见 get_connection）。
+
+        之后的 Database 方法共用一个连接，各方法的 commit 只释放保存点，
+        end_unit_of_work 时统一提交一次。未开启时各方法仍各自获取连接并提交。
+        """
+        uow = getattr(self._uow_local, 'uow', None)
+        if uow is None:
+            uow = self._uow_local.uow = UnitOfWork(self._new_connection)
+        uow.depth += 1
+        return uow
+
+    def end_unit_of_work(self, commit=True):
+        """结束工作单元：最外层提交（commit 为 False 时回滚）并归还连接。"""
+        uow = getattr(self._uow_local, 'uow', None)
+        if uow is None:
+            return
+        uow.depth -= 1
+        if uow.depth > 0:
+            return
+        self._uow_local.uow = None
+        try:
+            uow.checkpoint(commit=commit)
+        except Exception as err:
+            # 请求中应已由 checkpoint 提交，这里只剩流式响应期间的写入
+            logger.error(f"❌ 提交工作单元失败: {err}")
+
+    @contextmanager
+    def unit_of_work(self):
+        """``with db.unit_of_work(): ...``，代码块抛出异常时回滚。"""
+        uow = self.begin_unit_of_work()
+        ok = False
+        try:
+            yield uow
+            ok = True
+        finally:
+            self.end_unit_of_work(commit=ok)
+
+    def checkpoint(self):
+        """提交当前工作单元中已完成的写入并归还连接，适合在调用外部服务等慢操作之前和返回响应之前调用。
+
+        提交失败时返回 False（写入已丢失，调用方应返回错误）；不在工作单元中时什么也不做并返回 True。
+        """
+        uow = getattr(self._uow_local, 'uow', None)
+        if uow is None:
+            return True
+        try:
+            uow.checkpoint()
+            return True
+        except Exception as err:
+            logger.error(f"❌ 提交工作单元失败: {err}")
+            return False
+
+    def _after_commit(self, callback, invalidation=False):
+        """更新进程内缓存（L1、相似度索引、会话事实等）。
+
+        MySQL 工作单元中的写入要到工作单元提交时才生效，回调推迟到提交成功后执行，其他情况立即执行。
+        invalidation 为 True 的失效操作立即执行一次，并在事务结束时（无论提交或回滚）再执行一次，
+        避免事务期间读入缓存的数据在提交后或回滚后仍留在缓存中。
+        """
+        uow = getattr(self._uow_local, 'uow', None)
+        if uow is None or uow.conn is None or self.backend != "mysql":
+            callback()
+            return
+        if invalidation:
+            callback()
+        uow.defer(callback, on_rollback=invalidation)
+
     def _get_cursor(self, conn, dictionary=False):
         if self.backend == "mysql":
             return conn.cursor(dictionary=dictionary)
@@ -130,16 +557,7 @@ class Database:
         return "NOW()" if self.backend == "mysql" else "CURRENT_TIMESTAMP"
 
     def _normalize_query(self, query):
-        if self.backend != "sqlite":
-            return query
-
-        replacements = {
-            "NOW()": "CURRENT_TIMESTAMP",
-            "BOOLEAN": "INTEGER",
-        }
-        for source, target in replacements.items():
-            query = query.replace(source, target)
-        return query.replace("%s", "?")
+        return _translate_query(self.backend, query)
 
     def _execute(self, cursor, query, params=None):
         if params is None:
@@ -149,6 +567,9 @@ class Database:
 
         cursor.execute(self._normalize_query(query), params)
 
+    def _executemany(self, cursor, query, seq_of_params):
+        cursor.executemany(self._normalize_query(query), [tuple(params) for params in seq_of_params])
+
     def _row_to_dict(self, row):
         if row is None:
             return None
@@ -178,508 +599,577 @@ class Database:
         return [self._row_to_dict(row) for row in rows]
 
     def init_tables(self):
-        if self.backend == "mysql":
-            self._init_tables_mysql()
-        else:
-            if self.mysql_error:
-                logger.warning(f"⚠️ 使用 SQLite 作为后端，MySQL 错误: {self.mysql_error}")
-            self._init_tables_sqlite()
+        if self.backend != "mysql" and self.mysql_error:
+            logger.warning(f"⚠️ 使用 SQLite 作为后端，MySQL 错误: {self.mysql_error}")
+        self.migrate()
+
+    def migrate(self):
+        """执行尚未应用的表结构迁移（见 SCHEMA_MIGRATIONS），返回迁移后的版本号。
 
-    def _init_tables_mysql(self):
+        已是最新版本时只读一次 schema_version，不执行任何 DDL。
+        """
+        latest = SCHEMA_MIGRATIONS[-1][0]
         conn = None
+        locked = False
         try:
             conn = self.get_connection()
             if not conn:
-                return
+                return None
 
             cursor = self._get_cursor(conn)
+            current = self._read_schema_version(cursor)
+            if current >= latest:
+                self.schema_version = current
+                return current
 
-            self._execute(
-                cursor,
-                """
-                CREATE TABLE IF NOT EXISTS sessions (
-                    id VARCHAR(36) PRIMARY KEY,
-                    host_name VARCHAR(255) NOT NULL,
-                    live_theme VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-                )
-                """,
-            )
+            if self.backend == "mysql":
+                # 多个进程同时启动时只让一个执行迁移
+                self._execute(cursor, "SELECT GET_LOCK('live_assistant_schema', 60)")
+                locked = cursor.fetchone()[0] == 1
+                current = self._read_schema_version(cursor)
 
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS products (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    product_name VARCHAR(255) NOT NULL,
-                    price DECIMAL(10,2) NOT NULL,
-                    unit VARCHAR(20) DEFAULT '元',
-                    product_type VARCHAR(50),
-                    attributes JSON,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """,
+                "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description VARCHAR(255), applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
             )
-
-            try:
+            for version, description, steps in SCHEMA_MIGRATIONS:
+                if version <= current:
+                    continue
+                for step in steps:
+                    self._apply_migration_step(cursor, step)
                 self._execute(
                     cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'products' AND column_name = 'unit'",
-                    (self.database,),
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (version, description),
                 )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE products ADD COLUMN unit VARCHAR(20) DEFAULT '元'")
+                conn.commit()
+                current = version
+                logger.info(f"✅ 数据库迁移完成: v{version} {description} ({self.backend})")
 
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'products' AND column_name = 'product_type'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE products ADD COLUMN product_type VARCHAR(50)")
+            self.schema_version = current
+            return current
+        except Exception as err:
+            logger.error(f"❌ 数据库迁移失败 ({self.backend}): {err}")
+            return None
+        finally:
+            if conn:
+                if locked:
+                    try:
+                        self._execute(cursor, "SELECT RELEASE_LOCK('live_assistant_schema')")
+                        cursor.fetchone()
+                    except Exception:
+                        pass
+                conn.close()
 
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'products' AND column_name = 'attributes'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE products ADD COLUMN attributes JSON")
-            except Exception as err:
-                logger.warning(f"⚠️ 无法确保 products 表字段完整: {err}")
+    def _read_schema_version(self, cursor):
+        try:
+            self._execute(cursor, "SELECT MAX(version) FROM schema_version")
+            row = cursor.fetchone()
+            return (row[0] if row else None) or 0
+        except (MySQLError, SQLiteError):
+            # 尚未创建 schema_version（新库或迁移框架之前的旧库），从头执行；各迁移均可重复执行
+            return 0
+
+    def _apply_migration_step(self, cursor, step):
+        kind = step[0]
+        if kind == "call":
+            getattr(self, f"{step[1]}_{self.backend}")(cursor)
+        elif kind == "sql":
+            self._execute(cursor, step[1][self.backend])
+        elif kind == "column":
+            _, table, column, definitions = step
+            if not self._column_exists(cursor, table, column):
+                self._execute(cursor, f"ALTER TABLE {table} ADD COLUMN {column} {definitions[self.backend]}")
+        elif kind == "index":
+            _, table, name, columns, unique = step
+            if not self._index_exists(cursor, table, name):
+                self._execute(cursor, f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({columns})")
+        elif kind == "drop_index":
+            _, table, name = step
+            if self._index_exists(cursor, table, name):
+                self._execute(cursor, f"DROP INDEX {name} ON {table}" if self.backend == "mysql" else f"DROP INDEX {name}")
+        else:
+            raise ValueError(f"未知的迁移步骤: {kind}")
 
+    def _column_exists(self, cursor, table, column):
+        if self.backend == "mysql":
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    user_message TEXT,
-                    ai_response TEXT,
-                    audio_url VARCHAR(255),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = %s AND column_name = %s",
+                (self.database, table, column),
             )
+            return cursor.fetchone()[0] > 0
+        return self._sqlite_table_has_column(cursor, table, column)
 
+    def _index_exists(self, cursor, table, name):
+        if self.backend == "mysql":
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS bullet_screen_queue (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    username VARCHAR(255),
-                    message TEXT NOT NULL,
-                    category VARCHAR(50) DEFAULT 'unknown',
-                    priority INT DEFAULT 0,
-                    is_processed BOOLEAN DEFAULT FALSE,
-                    confidence_score FLOAT DEFAULT 0.0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP NULL,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
-                    INDEX idx_session_processed (session_id, is_processed),
-                    INDEX idx_created (created_at)
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = %s AND table_name = %s AND index_name = %s",
+                (self.database, table, name),
+            )
+        else:
+            self._execute(cursor, "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s", (table, name))
+        return cursor.fetchone()[0] > 0
+
+    def _create_base_tables_mysql(self, cursor):
+        """迁移 1：基础表结构（兼容迁移框架之前创建的旧表，缺失的字段补齐）。"""
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id VARCHAR(36) PRIMARY KEY,
+                host_name VARCHAR(255) NOT NULL,
+                live_theme VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
             )
+            """,
+        )
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                product_name VARCHAR(255) NOT NULL,
+                price DECIMAL(10,2) NOT NULL,
+                unit VARCHAR(20) DEFAULT '元',
+                product_type VARCHAR(50),
+                attributes JSON,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
+            )
+            """,
+        )
 
+        try:
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS blacklist (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    pattern VARCHAR(255) NOT NULL,
-                    type VARCHAR(20) DEFAULT 'message',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
-                    INDEX idx_session_type (session_id, type)
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'products' AND column_name = 'unit'",
+                (self.database,),
             )
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE products ADD COLUMN unit VARCHAR(20) DEFAULT '元'")
 
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS whitelist (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    pattern VARCHAR(255) NOT NULL,
-                    answer TEXT NOT NULL,
-                    priority INT DEFAULT 0,
-                    product_types VARCHAR(255),
-                    hit_count INT DEFAULT 0,
-                    last_hit_at TIMESTAMP NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
-                    INDEX idx_session_pattern (session_id),
-                    INDEX idx_hit_count (hit_count)
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'products' AND column_name = 'product_type'",
+                (self.database,),
             )
-
-            try:
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'priority'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN priority INT DEFAULT 0 AFTER answer")
-                    logger.info("✅ 已添加 whitelist.priority 字段")
-
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'product_types'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN product_types VARCHAR(255) AFTER priority")
-                    logger.info("✅ 已添加 whitelist.product_types 字段")
-
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'hit_count'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN hit_count INT DEFAULT 0 AFTER product_types")
-                    logger.info("✅ 已添加 whitelist.hit_count 字段")
-
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'last_hit_at'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN last_hit_at TIMESTAMP NULL AFTER hit_count")
-                    logger.info("✅ 已添加 whitelist.last_hit_at 字段")
-            except Exception as err:
-                logger.warning(f"⚠️ 无法添加 whitelist 字段: {err}")
-
-            # 确保 conversations 和 qa_cache 表包含 audio_url 字段（兼容已有表）
-            try:
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'conversations' AND column_name = 'audio_url'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE conversations ADD COLUMN audio_url VARCHAR(255) NULL AFTER ai_response")
-                    logger.info("✅ 已添加 conversations.audio_url 字段")
-
-                self._execute(
-                    cursor,
-                    "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'qa_cache' AND column_name = 'audio_url'",
-                    (self.database,),
-                )
-                if cursor.fetchone()[0] == 0:
-                    self._execute(cursor, "ALTER TABLE qa_cache ADD COLUMN audio_url VARCHAR(255) NULL AFTER answer")
-                    logger.info("✅ 已添加 qa_cache.audio_url 字段")
-            except Exception as err:
-                logger.warning(f"⚠️ 无法确保 audio_url 字段存在: {err}")
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE products ADD COLUMN product_type VARCHAR(50)")
 
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS faq_templates (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    product_type VARCHAR(50) NOT NULL,
-                    pattern VARCHAR(255) NOT NULL,
-                    answer_template VARCHAR(500) NOT NULL,
-                    placeholder VARCHAR(100),
-                    priority INT DEFAULT 80,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_product_type (product_type)
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'products' AND column_name = 'attributes'",
+                (self.database,),
+            )
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE products ADD COLUMN attributes JSON")
+        except Exception as err:
+            logger.warning(f"⚠️ 无法确保 products 表字段完整: {err}")
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                user_message TEXT,
+                ai_response TEXT,
+                audio_url VARCHAR(255),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
+            )
+            """,
+        )
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS bullet_screen_queue (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                username VARCHAR(255),
+                message TEXT NOT NULL,
+                category VARCHAR(50) DEFAULT 'unknown',
+                priority INT DEFAULT 0,
+                is_processed BOOLEAN DEFAULT FALSE,
+                confidence_score FLOAT DEFAULT 0.0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processed_at TIMESTAMP NULL,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                INDEX idx_session_processed (session_id, is_processed),
+                INDEX idx_created (created_at)
+            )
+            """,
+        )
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS blacklist (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                pattern VARCHAR(255) NOT NULL,
+                type VARCHAR(20) DEFAULT 'message',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                INDEX idx_session_type (session_id, type)
+            )
+            """,
+        )
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS whitelist (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                pattern VARCHAR(255) NOT NULL,
+                answer TEXT NOT NULL,
+                priority INT DEFAULT 0,
+                product_types VARCHAR(255),
+                hit_count INT DEFAULT 0,
+                last_hit_at TIMESTAMP NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                INDEX idx_session_pattern (session_id),
+                INDEX idx_hit_count (hit_count)
             )
+            """,
+        )
 
+        try:
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS qa_cache (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    question TEXT NOT NULL,
-                    question_hash VARCHAR(64) NOT NULL,
-                    answer TEXT NOT NULL,
-                    audio_url VARCHAR(255),
-                    hit_count INT DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
-                    INDEX idx_session_hash (session_id, question_hash),
-                    INDEX idx_last_used (last_used_at)
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'priority'",
+                (self.database,),
             )
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN priority INT DEFAULT 0 AFTER answer")
+                logger.info("✅ 已添加 whitelist.priority 字段")
 
-            # 产品信息表：用于存储每个会话/商品的补充信息（如产地、产区、保养建议等）
             self._execute(
                 cursor,
-                """
-                CREATE TABLE IF NOT EXISTS product_info (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    session_id VARCHAR(36),
-                    product_id INT,
-                    product_name VARCHAR(255),
-                    info_key VARCHAR(100),
-                    info_value TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
-                    INDEX idx_session_product (session_id, product_name)
-                )
-                """,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'product_types'",
+                (self.database,),
             )
-
-            conn.commit()
-
-            self._execute(cursor, "SELECT COUNT(*) FROM faq_templates")
             if cursor.fetchone()[0] == 0:
-                self._init_faq_templates(cursor)
-                conn.commit()
-
-            logger.info("✅ 数据库表初始化成功 (MySQL)")
-        except Exception as err:
-            logger.error(f"❌ 数据库表初始化失败 (MySQL): {err}")
-        finally:
-            if conn:
-                conn.close()
-
-    def _sqlite_table_has_column(self, cursor, table, column):
-        cursor.execute(f"PRAGMA table_info({table})")
-        rows = cursor.fetchall()
-        names = {row[1] if isinstance(row, tuple) else row[1] for row in rows}
-        return column in names
-
-    def _init_tables_sqlite(self):
-        conn = None
-        try:
-            conn = self.get_connection()
-            if not conn:
-                return
-
-            cursor = self._get_cursor(conn)
-
-            cursor.execute("PRAGMA journal_mode=WAL")
-            cursor.execute("PRAGMA synchronous=NORMAL")
+                self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN product_types VARCHAR(255) AFTER priority")
+                logger.info("✅ 已添加 whitelist.product_types 字段")
 
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sessions (
-                    id TEXT PRIMARY KEY,
-                    host_name TEXT NOT NULL,
-                    live_theme TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
+            self._execute(
+                cursor,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'hit_count'",
+                (self.database,),
             )
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN hit_count INT DEFAULT 0 AFTER product_types")
+                logger.info("✅ 已添加 whitelist.hit_count 字段")
 
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    product_name TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    unit TEXT DEFAULT '元',
-                    product_type TEXT,
-                    attributes TEXT,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
+            self._execute(
+                cursor,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'whitelist' AND column_name = 'last_hit_at'",
+                (self.database,),
             )
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE whitelist ADD COLUMN last_hit_at TIMESTAMP NULL AFTER hit_count")
+                logger.info("✅ 已添加 whitelist.last_hit_at 字段")
+        except Exception as err:
+            logger.warning(f"⚠️ 无法添加 whitelist 字段: {err}")
 
-            if not self._sqlite_table_has_column(cursor, "products", "unit"):
-                cursor.execute("ALTER TABLE products ADD COLUMN unit TEXT DEFAULT '元'")
-            if not self._sqlite_table_has_column(cursor, "products", "product_type"):
-                cursor.execute("ALTER TABLE products ADD COLUMN product_type TEXT")
-            if not self._sqlite_table_has_column(cursor, "products", "attributes"):
-                cursor.execute("ALTER TABLE products ADD COLUMN attributes TEXT")
-
-            # 确保 conversations 表包含 audio_url 字段
-            if not self._sqlite_table_has_column(cursor, "conversations", "audio_url"):
-                try:
-                    cursor.execute("ALTER TABLE conversations ADD COLUMN audio_url TEXT")
-                    logger.info("✅ 已为 SQLite conversations 添加 audio_url 字段")
-                except Exception:
-                    pass
-
-            # 确保 qa_cache 表包含 audio_url 字段
-            if not self._sqlite_table_has_column(cursor, "qa_cache", "audio_url"):
-                try:
-                    cursor.execute("ALTER TABLE qa_cache ADD COLUMN audio_url TEXT")
-                    logger.info("✅ 已为 SQLite qa_cache 添加 audio_url 字段")
-                except Exception:
-                    pass
-
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    user_message TEXT,
-                    ai_response TEXT,
-                    audio_url TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
+        # 确保 conversations 和 qa_cache 表包含 audio_url 字段（兼容已有表）
+        try:
+            self._execute(
+                cursor,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'conversations' AND column_name = 'audio_url'",
+                (self.database,),
             )
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE conversations ADD COLUMN audio_url VARCHAR(255) NULL AFTER ai_response")
+                logger.info("✅ 已添加 conversations.audio_url 字段")
 
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS bullet_screen_queue (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    username TEXT,
-                    message TEXT NOT NULL,
-                    category TEXT DEFAULT 'unknown',
-                    priority INTEGER DEFAULT 0,
-                    is_processed INTEGER DEFAULT 0,
-                    confidence_score REAL DEFAULT 0.0,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    processed_at DATETIME,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
+            self._execute(
+                cursor,
+                "SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s AND table_name = 'qa_cache' AND column_name = 'audio_url'",
+                (self.database,),
             )
-
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_session_processed ON bullet_screen_queue (session_id, is_processed)"
+            if cursor.fetchone()[0] == 0:
+                self._execute(cursor, "ALTER TABLE qa_cache ADD COLUMN audio_url VARCHAR(255) NULL AFTER answer")
+                logger.info("✅ 已添加 qa_cache.audio_url 字段")
+        except Exception as err:
+            logger.warning(f"⚠️ 无法确保 audio_url 字段存在: {err}")
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS faq_templates (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                product_type VARCHAR(50) NOT NULL,
+                pattern VARCHAR(255) NOT NULL,
+                answer_template VARCHAR(500) NOT NULL,
+                placeholder VARCHAR(100),
+                priority INT DEFAULT 80,
+                is_active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_product_type (product_type)
             )
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_created ON bullet_screen_queue (created_at)"
+            """,
+        )
+
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS qa_cache (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                question TEXT NOT NULL,
+                question_hash VARCHAR(64) NOT NULL,
+                answer TEXT NOT NULL,
+                audio_url VARCHAR(255),
+                hit_count INT DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                INDEX idx_session_hash (session_id, question_hash),
+                INDEX idx_last_used (last_used_at)
             )
-
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS blacklist (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    pattern TEXT NOT NULL,
-                    type TEXT DEFAULT 'message',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
+            """,
+        )
+
+        # 产品信息表：用于存储每个会话/商品的补充信息（如产地、产区、保养建议等）
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE IF NOT EXISTS product_info (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                session_id VARCHAR(36),
+                product_id INT,
+                product_name VARCHAR(255),
+                info_key VARCHAR(100),
+                info_value TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                INDEX idx_session_product (session_id, product_name)
             )
+            """,
+        )
 
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_session_type ON blacklist (session_id, type)"
-            )
+        self._execute(cursor, "SELECT COUNT(*) FROM faq_templates")
+        if cursor.fetchone()[0] == 0:
+            self._init_faq_templates(cursor)
 
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS whitelist (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    pattern TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    priority INTEGER DEFAULT 0,
-                    product_types TEXT,
-                    hit_count INTEGER DEFAULT 0,
-                    last_hit_at DATETIME,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
-            )
+    def _sqlite_table_has_column(self, cursor, table, column):
+        cursor.execute(f"PRAGMA table_info({table})")
+        rows = cursor.fetchall()
+        names = {row[1] if isinstance(row, tuple) else row[1] for row in rows}
+        return column in names
 
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_session_pattern ON whitelist (session_id)"
+    def _create_base_tables_sqlite(self, cursor):
+        """迁移 1：基础表结构（SQLite）。"""
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                host_name TEXT NOT NULL,
+                live_theme TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_hit_count ON whitelist (hit_count)"
+            """
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                product_name TEXT NOT NULL,
+                price REAL NOT NULL,
+                unit TEXT DEFAULT '元',
+                product_type TEXT,
+                attributes TEXT,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
+            """
+        )
+
+        if not self._sqlite_table_has_column(cursor, "products", "unit"):
+            cursor.execute("ALTER TABLE products ADD COLUMN unit TEXT DEFAULT '元'")
+        if not self._sqlite_table_has_column(cursor, "products", "product_type"):
+            cursor.execute("ALTER TABLE products ADD COLUMN product_type TEXT")
+        if not self._sqlite_table_has_column(cursor, "products", "attributes"):
+            cursor.execute("ALTER TABLE products ADD COLUMN attributes TEXT")
+
+        # 确保 conversations 表包含 audio_url 字段
+        if not self._sqlite_table_has_column(cursor, "conversations", "audio_url"):
+            try:
+                cursor.execute("ALTER TABLE conversations ADD COLUMN audio_url TEXT")
+                logger.info("✅ 已为 SQLite conversations 添加 audio_url 字段")
+            except Exception:
+                pass
 
-            if not self._sqlite_table_has_column(cursor, "whitelist", "priority"):
-                cursor.execute("ALTER TABLE whitelist ADD COLUMN priority INTEGER DEFAULT 0")
-            if not self._sqlite_table_has_column(cursor, "whitelist", "product_types"):
-                cursor.execute("ALTER TABLE whitelist ADD COLUMN product_types TEXT")
-            if not self._sqlite_table_has_column(cursor, "whitelist", "hit_count"):
-                cursor.execute("ALTER TABLE whitelist ADD COLUMN hit_count INTEGER DEFAULT 0")
-            if not self._sqlite_table_has_column(cursor, "whitelist", "last_hit_at"):
-                cursor.execute("ALTER TABLE whitelist ADD COLUMN last_hit_at DATETIME")
-
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS faq_templates (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    product_type TEXT NOT NULL,
-                    pattern TEXT NOT NULL,
-                    answer_template TEXT NOT NULL,
-                    placeholder TEXT,
-                    priority INTEGER DEFAULT 80,
-                    is_active INTEGER DEFAULT 1,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
+        # 确保 qa_cache 表包含 audio_url 字段
+        if not self._sqlite_table_has_column(cursor, "qa_cache", "audio_url"):
+            try:
+                cursor.execute("ALTER TABLE qa_cache ADD COLUMN audio_url TEXT")
+                logger.info("✅ 已为 SQLite qa_cache 添加 audio_url 字段")
+            except Exception:
+                pass
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                user_message TEXT,
+                ai_response TEXT,
+                audio_url TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
-
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_product_type ON faq_templates (product_type)"
+            """
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bullet_screen_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                username TEXT,
+                message TEXT NOT NULL,
+                category TEXT DEFAULT 'unknown',
+                priority INTEGER DEFAULT 0,
+                is_processed INTEGER DEFAULT 0,
+                confidence_score REAL DEFAULT 0.0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                processed_at DATETIME,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
-
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS qa_cache (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    question TEXT NOT NULL,
-                    question_hash TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    audio_url TEXT,
-                    hit_count INTEGER DEFAULT 1,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
+            """
+        )
+
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_processed ON bullet_screen_queue (session_id, is_processed)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_created ON bullet_screen_queue (created_at)"
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blacklist (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                pattern TEXT NOT NULL,
+                type TEXT DEFAULT 'message',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
-
-            # SQLite: product_info 表
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS product_info (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    product_id INTEGER,
-                    product_name TEXT,
-                    info_key TEXT,
-                    info_value TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
-                )
-                """
+            """
+        )
+
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_type ON blacklist (session_id, type)"
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS whitelist (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                pattern TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                priority INTEGER DEFAULT 0,
+                product_types TEXT,
+                hit_count INTEGER DEFAULT 0,
+                last_hit_at DATETIME,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
-
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_session_hash ON qa_cache (session_id, question_hash)"
+            """
+        )
+
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_pattern ON whitelist (session_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_hit_count ON whitelist (hit_count)"
+        )
+
+        if not self._sqlite_table_has_column(cursor, "whitelist", "priority"):
+            cursor.execute("ALTER TABLE whitelist ADD COLUMN priority INTEGER DEFAULT 0")
+        if not self._sqlite_table_has_column(cursor, "whitelist", "product_types"):
+            cursor.execute("ALTER TABLE whitelist ADD COLUMN product_types TEXT")
+        if not self._sqlite_table_has_column(cursor, "whitelist", "hit_count"):
+            cursor.execute("ALTER TABLE whitelist ADD COLUMN hit_count INTEGER DEFAULT 0")
+        if not self._sqlite_table_has_column(cursor, "whitelist", "last_hit_at"):
+            cursor.execute("ALTER TABLE whitelist ADD COLUMN last_hit_at DATETIME")
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS faq_templates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_type TEXT NOT NULL,
+                pattern TEXT NOT NULL,
+                answer_template TEXT NOT NULL,
+                placeholder TEXT,
+                priority INTEGER DEFAULT 80,
+                is_active INTEGER DEFAULT 1,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_last_used ON qa_cache (last_used_at)"
+            """
+        )
+
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_product_type ON faq_templates (product_type)"
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS qa_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                question TEXT NOT NULL,
+                question_hash TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                audio_url TEXT,
+                hit_count INTEGER DEFAULT 1,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
+            """
+        )
+
+        # SQLite: product_info 表
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS product_info (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                product_id INTEGER,
+                product_name TEXT,
+                info_key TEXT,
+                info_value TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
+            )
+            """
+        )
 
-            conn.commit()
-
-            self._execute(cursor, "SELECT COUNT(*) FROM faq_templates")
-            if cursor.fetchone()[0] == 0:
-                self._init_faq_templates(cursor)
-                conn.commit()
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_hash ON qa_cache (session_id, question_hash)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_used ON qa_cache (last_used_at)"
+        )
 
-            logger.info("✅ 数据库表初始化成功 (SQLite)")
-        except Exception as err:
-            logger.error(f"❌ 数据库表初始化失败 (SQLite): {err}")
-        finally:
-            if conn:
-                conn.close()
+        self._execute(cursor, "SELECT COUNT(*) FROM faq_templates")
+        if cursor.fetchone()[0] == 0:
+            self._init_faq_templates(cursor)
 
     def _init_faq_templates(self, cursor):
         templates = [
@@ -775,6 +1265,7 @@ class Database:
                 )
 
             conn.commit()
+            self._after_commit(lambda: self.invalidate_session_facts(session_id), invalidation=True)
             logger.info(f"会话创建成功 - ID: {session_id}, 商品数量: {len(products)}")
             return True
         except Exception as err:
@@ -823,6 +1314,7 @@ class Database:
 
             applied_count = 0
             skipped_count = 0
+            applied = []
 
             for template in templates:
                 try:
@@ -841,46 +1333,176 @@ class Database:
                         "INSERT INTO whitelist (session_id, pattern, answer, priority, product_types) VALUES (%s, %s, %s, %s, %s)",
                         (session_id, template['pattern'], answer, template['priority'], product_type),
                     )
+                    applied.append({
+                        'id': cursor.lastrowid,
+                        'pattern': template['pattern'],
+                        'answer': answer,
+                        'priority': template['priority'],
+                        'product_types': product_type,
+                    })
                     applied_count += 1
                 except KeyError as err:
                     skipped_count += 1
                     logger.debug(f"FAQ模板缺少参数 {err}，跳过: {template['pattern']}")
                     continue
 
-            conn.commit()
-            logger.info(f"✅ 为会话 {session_id} 应用了 {applied_count} 条FAQ，跳过 {skipped_count} 条（缺少参数）")
-            return applied_count
+            conn.commit()
+
+            # 已编译的白名单匹配器直接追加新规则，无需整体重新编译
+            def add_compiled():
+                with self._compiled_patterns_lock:
+                    entry = self._compiled_patterns.get(('db_whitelist', session_id))
+                if entry is not None:
+                    for item in applied:
+                        entry[1].add(item['pattern'], item)
+            self._after_commit(add_compiled)
+            self._after_commit(lambda: self.invalidate_session_facts(session_id), invalidation=True)
+            logger.info(f"✅ 为会话 {session_id} 应用了 {applied_count} 条FAQ，跳过 {skipped_count} 条（缺少参数）")
+            return applied_count
+        except Exception as err:
+            logger.error(f"❌ 应用FAQ模板失败: {err}")
+            return 0
+        finally:
+            if conn:
+                conn.close()
+
+    def _get_session_product_types(self, session_id):
+        facts = self._get_cached_session_facts(session_id)
+        return set(facts['product_types']) if facts else set()
+
+    def _check_product_type_match(self, item_types, session_product_types):
+        if not item_types:
+            return True
+
+        if not session_product_types:
+            return True
+
+        item_type_list = [entry.strip() for entry in item_types.split(',')]
+        return any(item for item in item_type_list if item in session_product_types)
+
+    def session_exists(self, session_id):
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return False
+
+            cursor = self._get_cursor(conn)
+            self._execute(cursor, "SELECT 1 FROM sessions WHERE id = %s LIMIT 1", (session_id,))
+            return cursor.fetchone() is not None
+        except Exception as err:
+            logger.error(f"❌ 检查会话失败: {err}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def _load_products(self, cursor, session_id):
+        self._execute(cursor, "SELECT * FROM products WHERE session_id = %s", (session_id,))
+        products = self._rows_to_dicts(cursor.fetchall())
+        # 确保 products 中的 attributes 字段为 dict（若为 JSON 字符串则解析）
+        for p in products:
+            try:
+                attrs = p.get('attributes')
+                if isinstance(attrs, str) and attrs:
+                    p['attributes'] = json.loads(attrs)
+                elif attrs is None:
+                    p['attributes'] = {}
+            except Exception:
+                p['attributes'] = {}
+        return products
+
+    def get_session_meta(self, session_id):
+        """会话信息与商品列表（不含对话历史）。"""
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return None
+
+            cursor = self._get_cursor(conn, dictionary=True)
+
+            self._execute(cursor, "SELECT * FROM sessions WHERE id = %s", (session_id,))
+            session = self._row_to_dict(cursor.fetchone())
+
+            if session:
+                session['products'] = self._load_products(cursor, session_id)
+
+            return session
         except Exception as err:
-            logger.error(f"❌ 应用FAQ模板失败: {err}")
-            return 0
+            logger.error(f"❌ 获取会话失败: {err}")
+            return None
         finally:
             if conn:
                 conn.close()
 
-    def _get_session_product_types(self, session_id):
-        session = self.get_session(session_id)
-        if not session or 'products' not in session:
-            return set()
+    def get_session_facts(self, session_id):
+        """会话事实：{'version', 'session'（会话信息与原始商品）, 'products'（合并补充信息后的商品）,
+        'product_types'}，会话不存在时返回 None。返回副本，调用方可自由修改。"""
+        facts = self._get_cached_session_facts(session_id)
+        return copy.deepcopy(facts) if facts else None
+
+    def _get_cached_session_facts(self, session_id):
+        """读穿缓存；返回的是缓存中的共享对象，内部调用只读。"""
+        facts = self.session_facts.get(session_id)
+        if facts is not None:
+            return facts
+
+        # 先记下版本号再读库：读库期间发生写入时版本号已变化，不把旧结果放入缓存
+        with self._session_versions_lock:
+            version = self._session_versions.get(session_id, 0)
+        facts = self._load_session_facts(session_id, version)
+        if facts is None:
+            return None
+        with self._session_versions_lock:
+            if self._session_versions.get(session_id, 0) == version:
+                self.session_facts.set(session_id, facts)
+        return facts
+
+    def _load_session_facts(self, session_id, version):
+        session = self.get_session_meta(session_id)
+        if not session:
+            return None
 
-        product_types = set()
-        for product in session['products']:
-            product_type = product.get('product_type')
-            if product_type:
-                product_types.add(product_type)
+        # 每个商品的补充信息（包括 origin）已合并到 attributes
+        products = self.get_products_with_info(session_id)
+        product_types = {p.get('product_type') for p in session['products'] if p.get('product_type')}
+        return {'version': version, 'session': session, 'products': products, 'product_types': product_types}
 
-        return product_types
+    def invalidate_session_facts(self, session_id):
+        """会话信息或商品事实变化后调用：递增版本号并删除缓存条目。"""
+        with self._session_versions_lock:
+            self._session_versions[session_id] = self._session_versions.get(session_id, 0) + 1
+            self.session_facts.delete(session_id)
 
-    def _check_product_type_match(self, item_types, session_product_types):
-        if not item_types:
-            return True
+    def get_session_facts_stats(self):
+        return {**self.session_facts.stats(), 'tracked_versions': len(self._session_versions)}
 
-        if not session_product_types:
-            return True
+    def get_conversations(self, session_id, since_id=None, limit=50):
+        """按 id 游标分页读取对话记录：返回 id 大于 since_id 的前 limit 条（升序），limit 为 None 时返回全部。"""
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
 
-        item_type_list = [entry.strip() for entry in item_types.split(',')]
-        return any(item for item in item_type_list if item in session_product_types)
+            cursor = self._get_cursor(conn, dictionary=True)
+            sql = "SELECT * FROM conversations WHERE session_id = %s AND id > %s ORDER BY id"
+            params = (session_id, int(since_id or 0))
+            if limit is not None:
+                sql += " LIMIT %s"
+                params += (int(limit),)
+            self._execute(cursor, sql, params)
+            return self._rows_to_dicts(cursor.fetchall())
+        except Exception as err:
+            logger.error(f"❌ 获取对话记录失败: {err}")
+            return []
+        finally:
+            if conn:
+                conn.close()
 
     def get_session(self, session_id):
+        """会话信息、商品列表与完整对话历史。只需商品或判断是否存在时请用 get_session_meta / session_exists。"""
         conn = None
         try:
             conn = self.get_connection()
@@ -893,19 +1515,7 @@ class Database:
             session = self._row_to_dict(cursor.fetchone())
 
             if session:
-                self._execute(cursor, "SELECT * FROM products WHERE session_id = %s", (session_id,))
-                products = self._rows_to_dicts(cursor.fetchall())
-                # 确保 products 中的 attributes 字段为 dict（若为 JSON 字符串则解析）
-                for p in products:
-                    try:
-                        attrs = p.get('attributes')
-                        if isinstance(attrs, str) and attrs:
-                            p['attributes'] = json.loads(attrs)
-                        elif attrs is None:
-                            p['attributes'] = {}
-                    except Exception:
-                        p['attributes'] = {}
-                session['products'] = products
+                session['products'] = self._load_products(cursor, session_id)
 
                 self._execute(
                     cursor,
@@ -1044,6 +1654,11 @@ class Database:
                     logger.warning('更新 products.attributes 失败', exc_info=True)
 
             conn.commit()
+            # 商品事实已变化，该会话的事实缓存与 L1 缓存答案可能过期
+            def invalidate():
+                self.invalidate_session_facts(session_id)
+                self.qa_l1.delete_where(lambda key: key[0] == session_id)
+            self._after_commit(invalidate, invalidation=True)
             logger.info(f"✅ 保存商品信息 - 会话: {session_id}, product_id: {prod_id}, {info_key}={info_value}")
             return True
         except Exception as err:
@@ -1087,27 +1702,9 @@ class Database:
 
             # 从 product_info 表中读取补充信息并合并（支持 info_value 为 JSON 字符串）
             if prod_id:
-                self._execute(cursor, "SELECT info_key, info_value FROM product_info WHERE session_id = %s AND product_id = %s", (session_id, prod_id))
+                self._execute(cursor, "SELECT info_key, info_value FROM product_info WHERE session_id = %s AND product_id = %s ORDER BY id", (session_id, prod_id))
                 for r in cursor.fetchall():
-                    k = r['info_key'] if isinstance(r, dict) else r[0]
-                    raw_v = r['info_value'] if isinstance(r, dict) else r[1]
-                    if not k:
-                        continue
-                    # 尝试解析 info_value 为 JSON
-                    v = raw_v
-                    try:
-                        if isinstance(raw_v, str):
-                            s = raw_v.strip()
-                            if (s.startswith('{') and s.endswith('}')) or (s.startswith('[') and s.endswith(']')):
-                                v = json.loads(raw_v)
-                    except Exception:
-                        v = raw_v
-
-                    # 合并策略：如果 attrs 中已有且两者为 dict，则深度合并；否则以最新值覆盖/设置
-                    if k in attrs and isinstance(attrs[k], dict) and isinstance(v, dict):
-                        self._deep_merge_dicts(attrs[k], v)
-                    else:
-                        attrs[k] = v
+                    self._merge_info_value(attrs, r['info_key'], r['info_value'])
 
             return attrs
         except Exception as err:
@@ -1117,207 +1714,725 @@ class Database:
             if conn:
                 conn.close()
 
-    def add_bullet_screen(self, session_id, username, message, category='unknown', priority=0):
+    def get_products_with_info(self, session_id):
+        """会话全部商品，attributes 已合并 product_info 中的补充信息。
+
+        两次查询取代逐个商品调用 get_product_info：先读 products，再按会话一次读出全部补充信息，
+        按写入顺序合并（合并规则同 get_product_info）。
+        """
+        if not session_id:
+            return []
+
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
+
+            cursor = self._get_cursor(conn, dictionary=True)
+            products = self._load_products(cursor, session_id)
+            if not products:
+                return []
+
+            attrs_by_id = {p['id']: p['attributes'] for p in products}
+            self._execute(
+                cursor,
+                "SELECT product_id, info_key, info_value FROM product_info WHERE session_id = %s AND product_id IS NOT NULL ORDER BY product_id, id",
+                (session_id,),
+            )
+            for r in cursor.fetchall():
+                attrs = attrs_by_id.get(r['product_id'])
+                if attrs is not None:
+                    self._merge_info_value(attrs, r['info_key'], r['info_value'])
+
+            return products
+        except Exception as err:
+            logger.error(f"❌ 批量获取商品信息失败: {err}")
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    def _merge_info_value(self, attrs, key, raw_value):
+        """把一条 product_info 记录合并进 attrs：info_value 为 JSON 字符串时先解析；
+        已有值与新值均为 dict 时深度合并，否则以新值覆盖。"""
+        if not key:
+            return
+        value = raw_value
+        try:
+            if isinstance(raw_value, str):
+                s = raw_value.strip()
+                if (s.startswith('{') and s.endswith('}')) or (s.startswith('[') and s.endswith(']')):
+                    value = json.loads(raw_value)
+        except Exception:
+            value = raw_value
+
+        if key in attrs and isinstance(attrs[key], dict) and isinstance(value, dict):
+            self._deep_merge_dicts(attrs[key], value)
+        else:
+            attrs[key] = value
+
+    def add_bullet_screen(self, session_id, username, message, category='unknown', priority=0, dedupe_key=None,
+                          repeat_count=1):
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return None
+
+            cursor = self._get_cursor(conn)
+            self._execute(
+                cursor,
+                "INSERT INTO bullet_screen_queue (session_id, username, message, category, priority, dedupe_key, "
+                "repeat_count) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                (session_id, username, message, category, priority, dedupe_key, repeat_count),
+            )
+            conn.commit()
+            return cursor.lastrowid
+        except Exception as err:
+            logger.error(f"❌ 添加弹幕失败: {err}")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def add_bullet_screens(self, rows):
+        """批量写入弹幕：rows 为 (session_id, username, message, category, priority, dedupe_key, repeat_count)，
+        一次 executemany、一次提交。成功返回 True，失败时整批回滚并返回 False。"""
+        if not rows:
+            return True
+
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return False
+
+            cursor = self._get_cursor(conn)
+            self._executemany(
+                cursor,
+                "INSERT INTO bullet_screen_queue (session_id, username, message, category, priority, dedupe_key, "
+                "repeat_count) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                rows,
+            )
+            conn.commit()
+            return True
+        except Exception as err:
+            logger.error(f"❌ 批量添加弹幕失败: {err}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def record_bullet_repeat(self, session_id, dedupe_key, count=1):
+        """记被合并的重复弹幕，稍后批量加到该会话 dedupe_key 最新一行的 repeat_count。
+        该行须已落库；尚未写入的弹幕的重复由 bullet_ingest 随 INSERT 写入。"""
+        self.bullet_repeats.record((session_id, dedupe_key), count)
+
+    def _flush_bullet_repeats(self, pending):
+        """把 {(session_id, dedupe_key): (次数, 最近时间戳)} 写回 repeat_count；失败时抛出异常由计数器重试。"""
+        conn = self.get_connection()
+        if not conn:
+            raise RuntimeError("数据库连接不可用")
+        try:
+            cursor = self._get_cursor(conn)
+            # MySQL 不允许在 UPDATE 的子查询中直接读取同一张表，多包一层派生表
+            self._executemany(
+                cursor,
+                "UPDATE bullet_screen_queue SET repeat_count = repeat_count + %s WHERE id = ("
+                "SELECT id FROM (SELECT MAX(id) AS id FROM bullet_screen_queue "
+                "WHERE session_id = %s AND dedupe_key = %s) latest)",
+                [(count, session_id, dedupe_key) for (session_id, dedupe_key), (count, _) in pending.items()],
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def is_blacklisted(self, session_id, username, message):
+        compiled = self.blacklist_rules.current.compiled.get(session_id)
+        if compiled is not None:
+            usernames, matcher = compiled
+            if username in usernames or matcher.contains_any(message):
+                return True
+
+        try:
+            usernames, matcher = self._get_compiled(
+                ('db_blacklist', session_id),
+                self._db_pattern_version(),
+                lambda: self._compile_blacklist(self._load_db_blacklist(session_id)),
+            )
+            return username in usernames or matcher.contains_any(message)
+        except Exception as err:
+            logger.error(f"❌ 检查黑名单失败: {err}")
+            return False
+
+    def _load_db_blacklist(self, session_id):
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
+
+            cursor = self._get_cursor(conn, dictionary=True)
+            self._execute(
+                cursor,
+                "SELECT pattern, type FROM blacklist WHERE session_id = %s",
+                (session_id,),
+            )
+            return self._rows_to_dicts(cursor.fetchall())
+        finally:
+            if conn:
+                conn.close()
+
+    @staticmethod
+    def _compile_whitelist(items):
+        """编译 FAQ 规则，匹配值为规则本身（含 answer / priority / product_types，数据库规则另含 id）。"""
+        matcher = PatternMatcher()
+        for item in items:
+            if isinstance(item, dict) and item.get('pattern'):
+                matcher.add(item['pattern'], item)
+        return matcher
+
+    def _best_faq_match(self, matcher, message, session_product_types):
+        """按 (优先级, 模式长度) 选取与会话商品类型匹配的最佳 FAQ 规则。"""
+        match = matcher.best(
+            message,
+            score=lambda m: (int(m.value.get('priority') or 0), m.end - m.start),
+            accept=lambda m: self._check_product_type_match(m.value.get('product_types', ''), session_product_types),
+        )
+        return match.value if match else None
+
+    def get_whitelist_answer(self, session_id, message):
+        session_product_types = self._get_session_product_types(session_id)
+
+        matcher = self.whitelist_rules.current.compiled.get(session_id)
+        if matcher is not None:
+            item = self._best_faq_match(matcher, message, session_product_types)
+            if item and item.get('answer'):
+                return item['answer']
+
+        try:
+            matcher = self._get_compiled(
+                ('db_whitelist', session_id),
+                self._db_pattern_version(),
+                lambda: self._compile_whitelist(self._load_db_whitelist(session_id)),
+            )
+            item = self._best_faq_match(matcher, message, session_product_types)
+        except Exception as err:
+            logger.error(f"❌ 获取白名单答案失败: {err}")
+            return None
+
+        if not item or not item.get('answer'):
+            return None
+
+        self.faq_hits.record(item['id'])
+        return item['answer']
+
+    def _load_db_whitelist(self, session_id):
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
+
+            cursor = self._get_cursor(conn, dictionary=True)
+            self._execute(
+                cursor,
+                "SELECT id, pattern, answer, priority, product_types FROM whitelist WHERE session_id = %s",
+                (session_id,),
+            )
+            return self._rows_to_dicts(cursor.fetchall())
+        finally:
+            if conn:
+                conn.close()
+
+    def classify_bullet_screen(self, session_id, message):
+        """弹幕入库前分类，返回 Classification(category, priority)；分类失败时返回未分类。"""
+        try:
+            return self.bullet_classifier.classify(message, self._get_bullet_lexicon(session_id))
+        except Exception as err:
+            logger.error(f"❌ 弹幕分类失败: {err}")
+            return Classification('unknown', 0)
+
+    def bullet_topic(self, session_id, message):
+        """弹幕话题键（会话商品名 + 属性词），见 BulletClassifier.topic"""
+        try:
+            return self.bullet_classifier.topic(message, self._get_bullet_lexicon(session_id))
+        except Exception as err:
+            logger.error(f"❌ 提取弹幕话题失败: {err}")
+            return message
+
+    def _get_bullet_lexicon(self, session_id):
+        facts = self._get_cached_session_facts(session_id)
+        if facts is None:
+            return None
+        file_matcher = self.whitelist_rules.current.compiled.get(session_id)
+        version = (facts['version'], self._db_pattern_version(), self.whitelist_rules.current.version)
+
+        def build():
+            product_names = [p.get('product_name') or p.get('name') for p in facts['products']]
+            product_types = facts['product_types']
+            patterns = [
+                pattern for pattern, product_type in self._get_faq_template_patterns()
+                if not product_types or product_type in product_types
+            ]
+            patterns += [item.get('pattern') for item in self._load_db_whitelist(session_id)]
+            if file_matcher is not None:
+                patterns += file_matcher.patterns()
+            return compile_lexicon(product_names, patterns)
+
+        return self._get_compiled(('bullet_lexicon', session_id), version, build)
+
+    def _get_faq_template_patterns(self):
+        """全部启用的 FAQ 模板模式 [(pattern, product_type)]，按刷新周期重新读取。"""
+        def load():
+            conn = None
+            try:
+                conn = self.get_connection()
+                if not conn:
+                    return []
+                cursor = self._get_cursor(conn)
+                self._execute(cursor, "SELECT pattern, product_type FROM faq_templates WHERE is_active = TRUE")
+                return [tuple(row) for row in cursor.fetchall()]
+            finally:
+                if conn:
+                    conn.close()
+
+        return self._get_compiled('faq_template_patterns', self._db_pattern_version(), load)
+
+    def get_pending_bullet_screens(self, session_id, limit=10, min_priority=None):
+        """待处理弹幕（按优先级、时间排序）；min_priority 不为 None 时只返回优先级不低于它的弹幕。"""
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
+
+            cursor = self._get_cursor(conn, dictionary=True)
+            priority_filter, params = ("AND priority >= %s ", (min_priority,)) if min_priority is not None else ("", ())
+            self._execute(
+                cursor,
+                "SELECT * FROM bullet_screen_queue WHERE session_id = %s AND is_processed = FALSE AND dead_letter = FALSE "
+                f"{priority_filter}ORDER BY priority DESC, created_at ASC LIMIT %s",
+                (session_id, *params, limit),
+            )
+            return self._rows_to_dicts(cursor.fetchall())
+        except Exception as err:
+            logger.error(f"❌ 获取待处理弹幕失败: {err}")
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    def mark_bullet_screens_processed(self, bullet_screen_ids):
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return False
+
+            cursor = self._get_cursor(conn)
+            placeholders = ','.join(['%s'] * len(bullet_screen_ids))
+            timestamp_func = self._now_func()
+            self._execute(
+                cursor,
+                f"UPDATE bullet_screen_queue SET is_processed = TRUE, processed_at = {timestamp_func} WHERE id IN ({placeholders})",
+                tuple(bullet_screen_ids),
+            )
+            conn.commit()
+            return True
+        except Exception as err:
+            logger.error(f"❌ 标记弹幕已处理失败: {err}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def claim_bullet_screens(self, session_id, worker_id, limit=10, lease_seconds=30, min_priority=None):
+        """为 worker 原子认领最多 limit 条待处理弹幕并加租约，返回认领到的弹幕（按优先级、时间排序）。
+        min_priority 不为 None 时只认领优先级不低于它的弹幕。
+
+        未处理、未进死信且没有有效租约（从未认领或租约已过期）的弹幕可被认领，每次认领 attempts 加 1。
+        多个 worker 并发认领不会拿到同一条：MySQL 使用 SELECT ... FOR UPDATE SKIP LOCKED，
+        SQLite 使用单条 UPDATE ... RETURNING。认领前先把租约过期且投递次数已达上限的弹幕转入死信。
+        """
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
+
+            cursor = self._get_cursor(conn, dictionary=True)
+            self._dead_letter_expired_bullets(cursor, session_id)
+
+            claimable = (
+                "session_id = %s AND is_processed = FALSE AND dead_letter = FALSE "
+                "AND (lease_expires_at IS NULL OR lease_expires_at < {now})"
+            )
+            filter_params = (session_id,)
+            if min_priority is not None:
+                claimable += " AND priority >= %s"
+                filter_params += (min_priority,)
+            if self.backend == "mysql":
+                self._execute(
+                    cursor,
+                    f"SELECT id FROM bullet_screen_queue WHERE {claimable.format(now='NOW()')} "
+                    "ORDER BY priority DESC, created_at ASC LIMIT %s FOR UPDATE SKIP LOCKED",
+                    (*filter_params, limit),
+                )
+                ids = [row['id'] for row in cursor.fetchall()]
+                if not ids:
+                    conn.commit()
+                    return []
+                placeholders = ', '.join(['%s'] * len(ids))
+                self._execute(
+                    cursor,
+                    "UPDATE bullet_screen_queue SET claimed_by = %s, lease_expires_at = NOW() + INTERVAL %s SECOND, "
+                    f"attempts = attempts + 1, merged_into = NULL WHERE id IN ({placeholders})",
+                    (worker_id, int(lease_seconds), *ids),
+                )
+                self._execute(cursor, f"SELECT * FROM bullet_screen_queue WHERE id IN ({placeholders})", tuple(ids))
+            else:
+                self._execute(
+                    cursor,
+                    "UPDATE bullet_screen_queue SET claimed_by = %s, lease_expires_at = datetime('now', %s), "
+                    "attempts = attempts + 1, merged_into = NULL WHERE id IN ("
+                    f"SELECT id FROM bullet_screen_queue WHERE {claimable.format(now='CURRENT_TIMESTAMP')} "
+                    "ORDER BY priority DESC, created_at ASC LIMIT %s) RETURNING *",
+                    (worker_id, f"+{int(lease_seconds)} seconds", *filter_params, limit),
+                )
+            claimed = self._rows_to_dicts(cursor.fetchall())
+            conn.commit()
+            claimed.sort(key=lambda row: (-(row.get('priority') or 0), str(row.get('created_at')), row['id']))
+            return claimed
+        except Exception as err:
+            logger.error(f"❌ 认领弹幕失败: {err}")
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    def _dead_letter_expired_bullets(self, cursor, session_id):
+        now = self._now_func()
+        self._execute(
+            cursor,
+            "UPDATE bullet_screen_queue SET dead_letter = TRUE, claimed_by = NULL, lease_expires_at = NULL, "
+            "last_error = COALESCE(last_error, 'lease expired') "
+            "WHERE session_id = %s AND is_processed = FALSE AND dead_letter = FALSE AND attempts >= %s "
+            f"AND lease_expires_at IS NOT NULL AND lease_expires_at < {now}",
+            (session_id, self.bullet_max_attempts),
+        )
+
+    def ack_bullet_screens(self, worker_id, bullet_screen_ids):
+        """确认处理完成：只确认仍由该 worker 持有租约的弹幕，返回确认的条数。
+        调度时合并到这些弹幕的同话题弹幕（见 ``merge_bullet_screens``）一并标记为已处理。"""
+        if not bullet_screen_ids:
+            return 0
+
         conn = None
         try:
             conn = self.get_connection()
             if not conn:
-                return None
+                return 0
 
             cursor = self._get_cursor(conn)
+            placeholders = ', '.join(['%s'] * len(bullet_screen_ids))
+            self._execute(
+                cursor,
+                f"UPDATE bullet_screen_queue SET is_processed = TRUE, processed_at = {self._now_func()}, lease_expires_at = NULL "
+                f"WHERE claimed_by = %s AND is_processed = FALSE AND dead_letter = FALSE AND id IN ({placeholders})",
+                (worker_id, *bullet_screen_ids),
+            )
+            acked = cursor.rowcount
             self._execute(
                 cursor,
-                "INSERT INTO bullet_screen_queue (session_id, username, message, category, priority) VALUES (%s, %s, %s, %s, %s)",
-                (session_id, username, message, category, priority),
+                f"UPDATE bullet_screen_queue SET is_processed = TRUE, processed_at = {self._now_func()}, lease_expires_at = NULL "
+                f"WHERE claimed_by = %s AND is_processed = FALSE AND merged_into IN ({placeholders})",
+                (worker_id, *bullet_screen_ids),
             )
             conn.commit()
-            return cursor.lastrowid
+            return acked
         except Exception as err:
-            logger.error(f"❌ 添加弹幕失败: {err}")
-            return None
+            logger.error(f"❌ 确认弹幕失败: {err}")
+            return 0
         finally:
             if conn:
                 conn.close()
 
-    def is_blacklisted(self, session_id, username, message):
-        try:
-            data = self._load_json_file(self.blacklist_file)
-            session_list = data.get(session_id) or []
-            for item in session_list:
-                pattern = item.get('pattern')
-                item_type = item.get('type', 'message')
-                if item_type == 'username' and pattern == username:
-                    return True
-                if item_type == 'message' and pattern and pattern.lower() in (message or '').lower():
-                    return True
-        except Exception:
-            logger.debug("黑名单文件读取异常，回退到数据库查询")
+    def nack_bullet_screens(self, worker_id, bullet_screen_ids, requeue=True, error=None):
+        """处理失败：释放该 worker 的租约以便立即重新投递；requeue 为 False 或投递次数已达上限时转入死信。
+        合并到这些弹幕的同话题弹幕解除合并并释放租约，重新参与调度（不计投递次数）。
+        返回 {'requeued': 条数, 'dead_lettered': 条数}。"""
+        result = {'requeued': 0, 'dead_lettered': 0}
+        if not bullet_screen_ids:
+            return result
 
         conn = None
         try:
             conn = self.get_connection()
             if not conn:
-                return False
+                return result
 
             cursor = self._get_cursor(conn)
+            placeholders = ', '.join(['%s'] * len(bullet_screen_ids))
+            owned = f"claimed_by = %s AND is_processed = FALSE AND dead_letter = FALSE AND id IN ({placeholders})"
+            error = (error or '')[:255] or None
+
             self._execute(
                 cursor,
-                "SELECT COUNT(*) FROM blacklist WHERE session_id = %s AND type = 'username' AND pattern = %s",
-                (session_id, username),
+                "UPDATE bullet_screen_queue SET claimed_by = NULL, lease_expires_at = NULL, merged_into = NULL "
+                f"WHERE claimed_by = %s AND is_processed = FALSE AND merged_into IN ({placeholders})",
+                (worker_id, *bullet_screen_ids),
             )
-            if cursor.fetchone()[0] > 0:
-                return True
-
+            if requeue:
+                self._execute(
+                    cursor,
+                    "UPDATE bullet_screen_queue SET claimed_by = NULL, lease_expires_at = NULL, "
+                    f"last_error = COALESCE(%s, last_error) WHERE attempts < %s AND {owned}",
+                    (error, self.bullet_max_attempts, worker_id, *bullet_screen_ids),
+                )
+                result['requeued'] = cursor.rowcount
             self._execute(
                 cursor,
-                "SELECT pattern FROM blacklist WHERE session_id = %s AND type = 'message'",
-                (session_id,),
+                "UPDATE bullet_screen_queue SET dead_letter = TRUE, claimed_by = NULL, lease_expires_at = NULL, "
+                f"last_error = COALESCE(%s, last_error) WHERE {owned}",
+                (error, worker_id, *bullet_screen_ids),
             )
-            for row in cursor.fetchall():
-                pattern = row[0] if not isinstance(row, dict) else row['pattern']
-                if pattern and pattern.lower() in (message or '').lower():
-                    return True
-
-            return False
+            result['dead_lettered'] = cursor.rowcount
+            conn.commit()
+            return result
         except Exception as err:
-            logger.error(f"❌ 检查黑名单失败: {err}")
-            return False
+            logger.error(f"❌ 退回弹幕失败: {err}")
+            return result
         finally:
             if conn:
                 conn.close()
 
-    def get_whitelist_answer(self, session_id, message):
-        session_product_types = self._get_session_product_types(session_id)
-
+    def get_dead_letter_bullet_screens(self, session_id, limit=50):
+        conn = None
         try:
-            data = self._load_json_file(self.whitelist_file)
-            session_list = data.get(session_id) or []
-            best = None
-            best_score = (-1, -1)
-            for item in session_list:
-                pattern = item.get('pattern')
-                answer = item.get('answer')
-                priority = item.get('priority', 0)
-                item_types = item.get('product_types', '')
-
-                if not pattern:
-                    continue
-
-                if not self._check_product_type_match(item_types, session_product_types):
-                    continue
-
-                if pattern.lower() in (message or '').lower():
-                    score = (int(priority), len(pattern))
-                    if score > best_score:
-                        best = answer
-                        best_score = score
+            conn = self.get_connection()
+            if not conn:
+                return []
 
-            if best:
-                return best
-        except Exception:
-            logger.debug("白名单文件读取异常，回退到数据库查询")
+            cursor = self._get_cursor(conn, dictionary=True)
+            self._execute(
+                cursor,
+                "SELECT * FROM bullet_screen_queue WHERE session_id = %s AND dead_letter = TRUE ORDER BY id DESC LIMIT %s",
+                (session_id, limit),
+            )
+            return self._rows_to_dicts(cursor.fetchall())
+        except Exception as err:
+            logger.error(f"❌ 获取死信弹幕失败: {err}")
+            return []
+        finally:
+            if conn:
+                conn.close()
 
+    def _bullet_age_sql(self):
+        """弹幕已等待秒数的 SQL 表达式（在数据库侧计算，避免时区差异）"""
+        if self.backend == "mysql":
+            return "TIMESTAMPDIFF(SECOND, created_at, NOW())"
+        return "CAST((julianday('now') - julianday(created_at)) * 86400 AS INTEGER)"
+
+    def _bullet_unleased_sql(self):
+        """未处理、未进死信且没有有效租约的条件"""
+        now = self._now_func()
+        return (
+            "is_processed = FALSE AND dead_letter = FALSE "
+            f"AND (lease_expires_at IS NULL OR lease_expires_at < {now})"
+        )
+
+    def get_schedulable_bullet_screens(self, session_id, per_user=3, limit=500, min_priority=None):
+        """调度候选：每个用户最多 per_user 条（按优先级、时间取前几条）、合计最多 limit 条可认领的弹幕，
+        附带已等待秒数 age_seconds。单个用户刷屏不会占满候选窗口。"""
         conn = None
         try:
             conn = self.get_connection()
             if not conn:
-                return None
+                return []
+
             cursor = self._get_cursor(conn, dictionary=True)
+            priority_filter, params = ("AND priority >= %s ", (min_priority,)) if min_priority is not None else ("", ())
             self._execute(
                 cursor,
-                "SELECT id, pattern, answer, priority, product_types FROM whitelist WHERE session_id = %s",
-                (session_id,),
+                "SELECT * FROM ("
+                f"SELECT q.*, {self._bullet_age_sql()} AS age_seconds, "
+                "ROW_NUMBER() OVER (PARTITION BY username ORDER BY priority DESC, created_at ASC, id ASC) AS user_rank "
+                f"FROM bullet_screen_queue q WHERE session_id = %s AND {self._bullet_unleased_sql()} {priority_filter}"
+                ") ranked WHERE user_rank <= %s ORDER BY priority DESC, created_at ASC LIMIT %s",
+                (session_id, *params, per_user, limit),
             )
-            rows = cursor.fetchall()
-            if not rows:
-                return None
-
-            best = None
-            best_score = (-1, -1)
-            best_id = None
-
-            for row in rows:
-                pattern = row['pattern']
-                answer = row['answer']
-                priority = row['priority']
-                item_types = row['product_types']
-                faq_id = row['id']
-
-                if not pattern:
-                    continue
+            return self._rows_to_dicts(cursor.fetchall())
+        except Exception as err:
+            logger.error(f"❌ 获取调度候选弹幕失败: {err}")
+            return []
+        finally:
+            if conn:
+                conn.close()
 
-                if not self._check_product_type_match(item_types, session_product_types):
-                    continue
+    def claim_bullet_screens_by_id(self, worker_id, bullet_screen_ids, lease_seconds=30):
+        """为 worker 认领指定弹幕并加租约（已被其他 worker 认领或已处理的跳过），返回认领到的弹幕。"""
+        if not bullet_screen_ids:
+            return []
 
-                if pattern.lower() in (message or '').lower():
-                    score = (int(priority or 0), len(pattern))
-                    if score > best_score:
-                        best = answer
-                        best_score = score
-                        best_id = faq_id
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return []
 
-            if best and best_id:
-                try:
-                    timestamp_func = self._now_func()
-                    self._execute(
-                        cursor,
-                        f"UPDATE whitelist SET hit_count = hit_count + 1, last_hit_at = {timestamp_func} WHERE id = %s",
-                        (best_id,),
-                    )
+            cursor = self._get_cursor(conn, dictionary=True)
+            placeholders = ', '.join(['%s'] * len(bullet_screen_ids))
+            claimable = f"id IN ({placeholders}) AND {self._bullet_unleased_sql()}"
+            if self.backend == "mysql":
+                self._execute(
+                    cursor,
+                    f"SELECT id FROM bullet_screen_queue WHERE {claimable} FOR UPDATE SKIP LOCKED",
+                    tuple(bullet_screen_ids),
+                )
+                ids = [row['id'] for row in cursor.fetchall()]
+                if not ids:
                     conn.commit()
-                    logger.debug(f"✅ FAQ命中统计已更新 - ID: {best_id}")
-                except Exception as err:
-                    logger.warning(f"更新FAQ命中统计失败: {err}")
-
-            return best
+                    return []
+                placeholders = ', '.join(['%s'] * len(ids))
+                self._execute(
+                    cursor,
+                    "UPDATE bullet_screen_queue SET claimed_by = %s, lease_expires_at = NOW() + INTERVAL %s SECOND, "
+                    f"attempts = attempts + 1, merged_into = NULL WHERE id IN ({placeholders})",
+                    (worker_id, int(lease_seconds), *ids),
+                )
+                self._execute(cursor, f"SELECT * FROM bullet_screen_queue WHERE id IN ({placeholders})", tuple(ids))
+            else:
+                self._execute(
+                    cursor,
+                    "UPDATE bullet_screen_queue SET claimed_by = %s, lease_expires_at = datetime('now', %s), "
+                    f"attempts = attempts + 1, merged_into = NULL WHERE {claimable} RETURNING *",
+                    (worker_id, f"+{int(lease_seconds)} seconds", *bullet_screen_ids),
+                )
+            claimed = self._rows_to_dicts(cursor.fetchall())
+            conn.commit()
+            return claimed
         except Exception as err:
-            logger.error(f"❌ 获取白名单答案失败: {err}")
-            return None
+            logger.error(f"❌ 认领指定弹幕失败: {err}")
+            return []
         finally:
             if conn:
                 conn.close()
 
-    def get_pending_bullet_screens(self, session_id, limit=10):
+    def merge_bullet_screens(self, primary_id, bullet_screen_ids):
+        """把同话题弹幕合并到代表弹幕 primary_id，返回实际合并的 id 列表；代表弹幕既未回答也不在处理中
+        （已退回、过期或进入死信）时不合并并返回 None。
+
+        只合并未处理、未进死信且没有有效租约的弹幕（期间被其他 worker 认领的跳过）：
+        - 代表弹幕已确认：直接标记为已处理；
+        - 代表弹幕正由 worker 处理：继承其认领者与租约，随其确认（ack）完成；代表弹幕被退回（nack）时
+          解除合并，租约过期时与代表弹幕一起重新参与调度。
+        """
+        if not bullet_screen_ids:
+            return []
+
         conn = None
         try:
             conn = self.get_connection()
             if not conn:
-                return []
+                return None
 
             cursor = self._get_cursor(conn, dictionary=True)
+            now = self._now_func()
+            lock = " FOR UPDATE" if self.backend == "mysql" else ""
             self._execute(
                 cursor,
-                "SELECT * FROM bullet_screen_queue WHERE session_id = %s AND is_processed = FALSE ORDER BY priority DESC, created_at ASC LIMIT %s",
-                (session_id, limit),
+                "SELECT claimed_by, lease_expires_at, is_processed, dead_letter, last_error, "
+                f"(lease_expires_at IS NOT NULL AND lease_expires_at >= {now}) AS leased "
+                f"FROM bullet_screen_queue WHERE id = %s{lock}",
+                (primary_id,),
             )
-            return self._rows_to_dicts(cursor.fetchall())
+            primary = cursor.fetchone()
+            placeholders = ', '.join(['%s'] * len(bullet_screen_ids))
+            mergeable = f"id IN ({placeholders}) AND {self._bullet_unleased_sql()}"
+            if primary and primary['is_processed'] and not primary['dead_letter'] and primary['last_error'] != 'expired':
+                self._execute(
+                    cursor,
+                    f"UPDATE bullet_screen_queue SET is_processed = TRUE, processed_at = {now}, merged_into = %s "
+                    f"WHERE {mergeable}",
+                    (primary_id, *bullet_screen_ids),
+                )
+            elif primary and primary['leased'] and primary['claimed_by'] and not primary['is_processed'] and not primary['dead_letter']:
+                self._execute(
+                    cursor,
+                    f"UPDATE bullet_screen_queue SET merged_into = %s, claimed_by = %s, lease_expires_at = %s WHERE {mergeable}",
+                    (primary_id, primary['claimed_by'], primary['lease_expires_at'], *bullet_screen_ids),
+                )
+            else:
+                conn.commit()
+                return None
+            self._execute(
+                cursor,
+                f"SELECT id FROM bullet_screen_queue WHERE merged_into = %s AND id IN ({placeholders})",
+                (primary_id, *bullet_screen_ids),
+            )
+            merged = [row['id'] for row in cursor.fetchall()]
+            conn.commit()
+            return merged
         except Exception as err:
-            logger.error(f"❌ 获取待处理弹幕失败: {err}")
+            logger.error(f"❌ 合并弹幕失败: {err}")
             return []
         finally:
             if conn:
                 conn.close()
 
-    def mark_bullet_screens_processed(self, bullet_screen_ids):
+    def expire_bullet_screens(self, session_id, max_age_seconds):
+        """把等待超过 max_age_seconds 且未被认领的弹幕标记为已处理（last_error 记为 expired），返回条数。"""
         conn = None
         try:
             conn = self.get_connection()
             if not conn:
-                return False
+                return 0
 
             cursor = self._get_cursor(conn)
-            placeholders = ','.join(['%s'] * len(bullet_screen_ids))
-            timestamp_func = self._now_func()
+            if self.backend == "mysql":
+                cutoff, cutoff_param = "NOW() - INTERVAL %s SECOND", int(max_age_seconds)
+            else:
+                cutoff, cutoff_param = "datetime('now', %s)", f"-{int(max_age_seconds)} seconds"
             self._execute(
                 cursor,
-                f"UPDATE bullet_screen_queue SET is_processed = TRUE, processed_at = {timestamp_func} WHERE id IN ({placeholders})",
-                tuple(bullet_screen_ids),
+                f"UPDATE bullet_screen_queue SET is_processed = TRUE, processed_at = {self._now_func()}, "
+                "last_error = 'expired' "
+                f"WHERE session_id = %s AND {self._bullet_unleased_sql()} AND created_at < {cutoff}",
+                (session_id, cutoff_param),
             )
+            expired = cursor.rowcount
             conn.commit()
-            return True
+            return expired
         except Exception as err:
-            logger.error(f"❌ 标记弹幕已处理失败: {err}")
-            return False
+            logger.error(f"❌ 过期弹幕失败: {err}")
+            return 0
+        finally:
+            if conn:
+                conn.close()
+
+    def get_bullet_queue_depth(self, session_id, min_priority=None):
+        """可认领弹幕的队列深度：{'depth', 'users', 'oldest_age_seconds'}"""
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return None
+
+            cursor = self._get_cursor(conn)
+            priority_filter, params = ("AND priority >= %s", (min_priority,)) if min_priority is not None else ("", ())
+            self._execute(
+                cursor,
+                f"SELECT COUNT(*), COUNT(DISTINCT username), MAX({self._bullet_age_sql()}) FROM bullet_screen_queue "
+                f"WHERE session_id = %s AND {self._bullet_unleased_sql()} {priority_filter}",
+                (session_id, *params),
+            )
+            depth, users, oldest = cursor.fetchone()
+            return {'depth': depth or 0, 'users': users or 0, 'oldest_age_seconds': oldest}
+        except Exception as err:
+            logger.error(f"❌ 获取弹幕队列深度失败: {err}")
+            return None
         finally:
             if conn:
                 conn.close()
@@ -1325,21 +2440,104 @@ class Database:
     def get_cached_answer(self, session_id, question):
         return self.get_cached_answer_with_origin(session_id, question, None)
 
-    def get_cached_answer_with_origin(self, session_id, question, product_origin=None):
+    def _qa_cache_key(self, question, product_origin=None):
+        """返回 (归一化问题, 缓存键哈希)。product_origin 纳入缓存键，避免不同产地复用同一缓存答案。"""
         import hashlib
         import re
 
-        def normalize_question(text):
-            text = text.strip()
-            text = re.sub(r'[？?！!。.，,、；;：:""\'\'""（）()【】\[\]]', '', text)
-            text = re.sub(r'(吗|呢|啊|哦|嘛|呀|哇|哈)+', '', text)
-            text = text.replace('么', '吗')
-            return ' '.join(text.split()).lower()
+        text = (question or '').strip()
+        text = re.sub(r'[？?！!。.，,、；;：:""\'\'""（）()【】\[\]]', '', text)
+        text = re.sub(r'(吗|呢|啊|哦|嘛|呀|哇|哈)+', '', text)
+        text = text.replace('么', '吗')
+        question_normalized = ' '.join(text.split()).lower()
 
-        question_normalized = normalize_question(question)
-        # 将 product_origin 纳入缓存键，避免不同产地复用同一缓存答案
         composite = question_normalized + (f"|origin:{product_origin}" if product_origin else "")
         question_hash = hashlib.sha256(composite.encode('utf-8')).hexdigest()
+        return question_normalized, question_hash
+
+    def get_cached_answer_with_origin(self, session_id, question, product_origin=None):
+        cached, _ = self.lookup_cached_answer(session_id, question, product_origin)
+        return cached
+
+    def lookup_cached_answer(self, session_id, question, product_origin=None):
+        """查询问答缓存，返回 (cached, match)。
+
+        cached 为 {'answer', 'audio_url'} 或 None；match 描述匹配方式：
+        {'type': 'exact' | 'similar' | 'miss', 'score': 相似度, 'lookup_ms': 查询耗时}，
+        近似命中时另含 matched_question。
+        """
+        started = time.perf_counter()
+        question_normalized, question_hash = self._qa_cache_key(question, product_origin)
+
+        cached = self._get_cached_answer_by_hash(session_id, question_hash, question_normalized)
+        match = {'type': 'exact', 'score': 1.0}
+        if cached is None:
+            match = {'type': 'miss', 'score': 0.0}
+            if self.qa_similarity_threshold > 0:
+                cached, match = self._find_similar_cached_answer(session_id, question_normalized, product_origin)
+
+        match['score'] = round(match['score'], 4)
+        match['lookup_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        return cached, match
+
+    def _find_similar_cached_answer(self, session_id, question_normalized, product_origin=None):
+        self._ensure_qa_index(session_id)
+
+        # 缓存键包含产地，候选问题须在当前产地下算出相同的哈希才可复用
+        def same_origin(payload):
+            return self._qa_cache_key(payload[0], product_origin)[1] == payload[1]
+
+        score, payload = self.qa_index.search(session_id, question_normalized, accept=same_origin)
+        if payload is None or score < self.qa_similarity_threshold:
+            return None, {'type': 'miss', 'score': score}
+
+        matched_question, matched_hash = payload
+        cached = self._get_cached_answer_by_hash(session_id, matched_hash, question_normalized)
+        if cached is None:
+            # 对应缓存行已被清理
+            self.qa_index.remove(session_id, matched_hash)
+            return None, {'type': 'miss', 'score': score}
+
+        self._qa_similar_hits += 1
+        logger.info(f"✅ 问答缓存近似命中 - 会话: {session_id}, 相似度: {score:.3f}, 原问题: {matched_question[:20]}...")
+        return cached, {'type': 'similar', 'score': score, 'matched_question': matched_question}
+
+    def _ensure_qa_index(self, session_id):
+        """首次近似查询时载入该会话已缓存的问题；商品名用于区分询问对象不同的相似问题。"""
+        if self.qa_index.is_loaded(session_id):
+            return
+
+        conn = None
+        try:
+            conn = self.get_connection()
+            if not conn:
+                return
+
+            cursor = self._get_cursor(conn)
+            self._execute(cursor, "SELECT product_name FROM products WHERE session_id = %s", (session_id,))
+            product_names = [row[0] for row in cursor.fetchall()]
+            self._execute(
+                cursor,
+                "SELECT question, question_hash FROM qa_cache WHERE session_id = %s",
+                (session_id,),
+            )
+            rows = cursor.fetchall()
+            self.qa_index.load(session_id, (
+                (self._qa_cache_key(question)[0], question_hash, (question, question_hash))
+                for question, question_hash in rows
+            ), subject_terms=product_names)
+        except Exception as err:
+            logger.warning(f"载入问题相似度索引失败: {err}")
+        finally:
+            if conn:
+                conn.close()
+
+    def _get_cached_answer_by_hash(self, session_id, question_hash, question_normalized=''):
+        l1_entry = self.qa_l1.get((session_id, question_hash))
+        if l1_entry is not None:
+            self.qa_hits.record(l1_entry['id'])
+            logger.debug(f"✅ 问答缓存命中(L1) - 会话: {session_id}, 问题: {question_normalized[:20]}...")
+            return {'answer': l1_entry['answer'], 'audio_url': l1_entry['audio_url']}
 
         conn = None
         try:
@@ -1353,17 +2551,16 @@ class Database:
                 "SELECT answer, audio_url, id FROM qa_cache WHERE session_id = %s AND question_hash = %s ORDER BY last_used_at DESC LIMIT 1",
                 (session_id, question_hash),
             )
-            result = cursor.fetchone()
+            result = self._row_to_dict(cursor.fetchone())
 
             if result:
-                timestamp_func = self._now_func()
-                self._execute(
-                    cursor,
-                    f"UPDATE qa_cache SET hit_count = hit_count + 1, last_used_at = {timestamp_func} WHERE id = %s",
-                    (result['id'],),
-                )
-                conn.commit()
+                self.qa_hits.record(result['id'])
                 logger.info(f"✅ 问答缓存命中 - 会话: {session_id}, 问题: {question_normalized[:20]}...")
+                self.qa_l1.set((session_id, question_hash), {
+                    'id': result['id'],
+                    'answer': result['answer'],
+                    'audio_url': result.get('audio_url'),
+                })
                 # 返回包含 answer 与 audio_url，便于避免重复合成
                 return {'answer': result['answer'], 'audio_url': result.get('audio_url')}
 
@@ -1379,19 +2576,7 @@ class Database:
         return self.cache_qa_with_origin(session_id, question, answer, audio_url, None)
 
     def cache_qa_with_origin(self, session_id, question, answer, audio_url=None, product_origin=None):
-        import hashlib
-        import re
-
-        def normalize_question(text):
-            text = text.strip()
-            text = re.sub(r'[？?！!。.，,、；;：:""\'\'""（）()【】\[\]]', '', text)
-            text = re.sub(r'(吗|呢|啊|哦|嘛|呀|哇|哈)+', '', text)
-            text = text.replace('么', '吗')
-            return ' '.join(text.split()).lower()
-
-        question_normalized = normalize_question(question)
-        composite = question_normalized + (f"|origin:{product_origin}" if product_origin else "")
-        question_hash = hashlib.sha256(composite.encode('utf-8')).hexdigest()
+        question_normalized, question_hash = self._qa_cache_key(question, product_origin)
 
         conn = None
         try:
@@ -1399,39 +2584,48 @@ class Database:
             if not conn:
                 return False
 
+            # 单条 upsert：并发未命中同时写入同一问题时依赖唯一索引 uq_qa_cache_session_hash 合并为一行，
+            # 已有行更新 answer 与 audio_url（如果提供）并增加 hit_count
             cursor = self._get_cursor(conn)
-            self._execute(
-                cursor,
-                "SELECT id FROM qa_cache WHERE session_id = %s AND question_hash = %s",
-                (session_id, question_hash),
-            )
-            existing = cursor.fetchone()
-
-            if existing:
-                timestamp_func = self._now_func()
-                # 更新 answer 与 audio_url（如果提供）并增加 hit_count
-                if audio_url is not None:
-                    self._execute(
-                        cursor,
-                        f"UPDATE qa_cache SET answer = %s, audio_url = %s, hit_count = hit_count + 1, last_used_at = {timestamp_func} WHERE id = %s",
-                        (answer, audio_url, existing[0]),
-                    )
-                else:
-                    self._execute(
-                        cursor,
-                        f"UPDATE qa_cache SET answer = %s, hit_count = hit_count + 1, last_used_at = {timestamp_func} WHERE id = %s",
-                        (answer, existing[0]),
-                    )
+            if self.backend == "mysql":
+                # LAST_INSERT_ID(id) 让更新已有行时 lastrowid 也返回该行 id；rowcount 插入为 1、更新为 2
+                self._execute(
+                    cursor,
+                    "INSERT INTO qa_cache (session_id, question, question_hash, answer, audio_url) "
+                    "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id), "
+                    "answer = VALUES(answer), audio_url = COALESCE(VALUES(audio_url), audio_url), "
+                    "hit_count = hit_count + 1, last_used_at = NOW()",
+                    (session_id, question, question_hash, answer, audio_url),
+                )
+                row_id, inserted = cursor.lastrowid, cursor.rowcount == 1
             else:
+                # 新行 hit_count 为默认值 1，更新后至少为 2
                 self._execute(
                     cursor,
-                    "INSERT INTO qa_cache (session_id, question, question_hash, answer, audio_url) VALUES (%s, %s, %s, %s, %s)",
+                    "INSERT INTO qa_cache (session_id, question, question_hash, answer, audio_url) "
+                    "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (session_id, question_hash) DO UPDATE SET "
+                    "answer = excluded.answer, audio_url = COALESCE(excluded.audio_url, audio_url), "
+                    "hit_count = hit_count + 1, last_used_at = CURRENT_TIMESTAMP RETURNING id, hit_count",
                     (session_id, question, question_hash, answer, audio_url),
                 )
-
+                row_id, hit_count = cursor.fetchone()
+                inserted = hit_count == 1
             conn.commit()
+
+            # 写穿 L1：新行直接写入；已有行在 audio_url 未提供时保留原值，仅 L1 中存在时就地更新
+            def update_caches():
+                l1_key = (session_id, question_hash)
+                if inserted:
+                    self.qa_index.add(session_id, question_normalized, question_hash, (question, question_hash))
+                    self.qa_l1.set(l1_key, {'id': row_id, 'answer': answer, 'audio_url': audio_url})
+                    self._note_qa_cache_insert()
+                elif audio_url is not None:
+                    self.qa_l1.set(l1_key, {'id': row_id, 'answer': answer, 'audio_url': audio_url})
+                else:
+                    self.qa_l1.update(l1_key, lambda entry: {**entry, 'answer': answer})
+            self._after_commit(update_caches)
+
             logger.info(f"✅ 问答缓存已保存 - 会话: {session_id}, 问题: {question_normalized[:20]}...")
-            self._clean_qa_cache()
             return True
         except Exception as err:
             logger.error(f"❌ 缓存问答失败: {err}")
@@ -1440,61 +2634,186 @@ class Database:
             if conn:
                 conn.close()
 
-    def _clean_qa_cache(self, max_cache_size=1000):
+    def update_cached_audio_url(self, session_id, question, audio_url, product_origin=None):
+        """后台语音合成完成后回写 qa_cache.audio_url（不影响 hit_count）。"""
+        _, question_hash = self._qa_cache_key(question, product_origin)
+
         conn = None
         try:
             conn = self.get_connection()
             if not conn:
-                return
+                return False
 
             cursor = self._get_cursor(conn)
-            cursor.execute("SELECT COUNT(*) FROM qa_cache")
-            count = cursor.fetchone()[0]
+            self._execute(
+                cursor,
+                "UPDATE qa_cache SET audio_url = %s WHERE session_id = %s AND question_hash = %s",
+                (audio_url, session_id, question_hash),
+            )
+            conn.commit()
+            self._after_commit(lambda: self.qa_l1.update(
+                (session_id, question_hash), lambda entry: {**entry, 'audio_url': audio_url}))
+            return cursor.rowcount > 0
+        except Exception as err:
+            logger.error(f"❌ 回写缓存语音地址失败: {err}")
+            return False
+        finally:
+            if conn:
+                conn.close()
 
-            if count > max_cache_size:
+    def _format_timestamp(self, ts):
+        """把时间戳格式化为与 NOW()（MySQL，本地时间）/ CURRENT_TIMESTAMP（SQLite，UTC）一致的字符串。"""
+        if self.backend == "mysql":
+            return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+        return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _flush_hit_counts(self, table, time_column, pending):
+        """把 {id: (次数, 最近命中时间戳)} 用多行 CASE UPDATE 批量写回；失败时抛出异常由计数器重试。"""
+        conn = self.get_connection()
+        if not conn:
+            raise RuntimeError("数据库连接不可用")
+        try:
+            cursor = self._get_cursor(conn)
+            items = list(pending.items())
+            # 每批 150 行（750 个参数），低于旧版 SQLite 999 个参数的上限
+            for start in range(0, len(items), 150):
+                chunk = items[start:start + 150]
+                cases = ' '.join(['WHEN %s THEN %s'] * len(chunk))
+                params = [v for row_id, (count, _) in chunk for v in (row_id, count)]
+                params += [v for row_id, (_, at) in chunk for v in (row_id, self._format_timestamp(at))]
+                params += [row_id for row_id, _ in chunk]
                 self._execute(
                     cursor,
-                    """
-                    DELETE FROM qa_cache 
-                    WHERE id NOT IN (
-                        SELECT id FROM (
-                            SELECT id FROM qa_cache 
-                            ORDER BY last_used_at DESC 
-                            LIMIT %s
-                        ) AS tmp
-                    )
-                    """,
-                    (max_cache_size,),
+                    f"UPDATE {table} SET hit_count = hit_count + CASE id {cases} END, "
+                    f"{time_column} = CASE id {cases} END "
+                    f"WHERE id IN ({', '.join(['%s'] * len(chunk))})",
+                    tuple(params),
                 )
-                deleted = cursor.rowcount
-                conn.commit()
-                if deleted > 0:
-                    logger.info(f"✅ 已清理 {deleted} 条旧的问答缓存，保留最近 {max_cache_size} 条")
-        except Exception as err:
-            logger.warning(f"清理问答缓存失败: {err}")
+            conn.commit()
         finally:
-            if conn:
-                conn.close()
+            conn.close()
+
+    def flush_hit_counters(self):
+        """立即写回全部未写回的命中计数（进程退出时自动调用）。"""
+        self.qa_hits.flush()
+        self.faq_hits.flush()
+        self.bullet_repeats.flush()
+
+    def get_qa_cache_stats(self):
+        return {
+            'l1': self.qa_l1.stats(),
+            'hit_counter': self.qa_hits.stats(),
+            'max_size': self.qa_cache_max_size,
+            'eviction': {
+                **self._qa_eviction_stats,
+                'policy': self.qa_evict_policy,
+                'session_quota': self.qa_cache_session_quota,
+                'global_cap': self.qa_cache_max_size,
+            },
+            'similarity': {
+                **self.qa_index.stats(),
+                'threshold': self.qa_similarity_threshold,
+                'similar_hits': self._qa_similar_hits,
+            },
+        }
+
+    def get_rule_file_stats(self):
+        return {'blacklist': self.blacklist_rules.stats(), 'whitelist': self.whitelist_rules.stats()}
+
+    def _note_qa_cache_insert(self):
+        """写路径只计数：每 qa_evict_every 次新增唤醒一次后台淘汰。"""
+        self._qa_inserts += 1
+        if self._qa_inserts % self.qa_evict_every == 0:
+            self.qa_evictor.trigger()
+
+    def evict_qa_cache(self):
+        """按会话配额与全局上限淘汰 qa_cache，返回本轮删除的行数。
+
+        先把每个会话裁到 qa_cache_session_quota 以内；仍超过全局上限时，每次从当前条目最多的
+        会话淘汰，避免一个热门直播间挤掉其他会话的缓存。
+        """
+        started = time.perf_counter()
+        # 先写回未写回的命中次数，LFU 策略才能看到最新的 hit_count
+        self.qa_hits.flush()
+
+        conn = self.get_connection()
+        if not conn:
+            return 0
+
+        evicted_quota = evicted_global = 0
+        try:
+            cursor = self._get_cursor(conn)
+            self._execute(cursor, "SELECT session_id, COUNT(*) FROM qa_cache GROUP BY session_id")
+            counts = {row[0]: row[1] for row in cursor.fetchall()}
+
+            for session_id, count in counts.items():
+                excess = count - self.qa_cache_session_quota
+                if excess > 0:
+                    deleted = self._evict_qa_rows(conn, cursor, session_id, excess)
+                    counts[session_id] -= deleted
+                    evicted_quota += deleted
+
+            excess = sum(counts.values()) - self.qa_cache_max_size
+            while excess > 0:
+                session_id = max(counts, key=counts.get)
+                runner_up = max((c for sid, c in counts.items() if sid != session_id), default=0)
+                deleted = self._evict_qa_rows(
+                    conn, cursor, session_id, min(excess, max(1, counts[session_id] - runner_up))
+                )
+                if not deleted:
+                    break
+                counts[session_id] -= deleted
+                excess -= deleted
+                evicted_global += deleted
+        finally:
+            conn.close()
+
+        stats = self._qa_eviction_stats
+        stats['runs'] += 1
+        stats['evicted_quota'] += evicted_quota
+        stats['evicted_global'] += evicted_global
+        stats['last_run_at'] = time.time()
+        stats['last_duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        if evicted_quota or evicted_global:
+            logger.info(f"✅ 问答缓存淘汰 {evicted_quota + evicted_global} 条（会话配额 {evicted_quota}，全局上限 {evicted_global}）")
+        return evicted_quota + evicted_global
+
+    def _evict_qa_rows(self, conn, cursor, session_id, limit):
+        """按淘汰策略删除会话中最多 limit 行，每批不超过 qa_evict_batch 行并单独提交。"""
+        order_by = QA_EVICTION_ORDER[self.qa_evict_policy]
+        deleted = 0
+        while deleted < limit:
+            self._execute(
+                cursor,
+                f"SELECT id, question_hash FROM qa_cache WHERE session_id = %s ORDER BY {order_by} LIMIT %s",
+                (session_id, min(self.qa_evict_batch, limit - deleted)),
+            )
+            victims = cursor.fetchall()
+            if not victims:
+                break
+            self._execute(
+                cursor,
+                f"DELETE FROM qa_cache WHERE id IN ({', '.join(['%s'] * len(victims))})",
+                tuple(row[0] for row in victims),
+            )
+            conn.commit()
+            for _, question_hash in victims:
+                self.qa_l1.delete((session_id, question_hash))
+                self.qa_index.remove(session_id, question_hash)
+            deleted += len(victims)
+        return deleted
 
     def check_sensitive_words(self, message):
         if not message:
             return False, []
 
         try:
-            data = self._load_json_file(self.blacklist_file)
-            global_list = data.get('_global', [])
-
-            if not global_list:
+            matcher = self.blacklist_rules.current.compiled.get('_global')
+            if not matcher:
                 return False, []
 
-            msg_lower = message.lower().strip()
-            matched_words = []
-
-            for word in global_list:
-                if not word:
-                    continue
-                if word.lower().strip() in msg_lower:
-                    matched_words.append(word)
+            # 同一敏感词多次出现只报告一次，保持首次出现的顺序
+            matched_words = list(dict.fromkeys(m.value for m in matcher.find_all(message.strip())))
 
             if matched_words:
                 logger.warning(f"⚠️ 敏感词命中: {matched_words} - 消息: {message}")
@@ -1535,7 +2854,7 @@ class Database:
                 self._execute(
                     cursor,
                     """
-                    SELECT pattern, answer, hit_count, last_hit_at, product_types
+                    SELECT id, pattern, answer, hit_count, last_hit_at, product_types
                     FROM whitelist 
                     WHERE session_id = %s AND hit_count > 0
                     ORDER BY hit_count DESC 
@@ -1548,22 +2867,23 @@ class Database:
                 self._execute(
                     cursor,
                     """
-                    SELECT pattern, answer, product_types
+                    SELECT id, pattern, answer, product_types
                     FROM whitelist 
                     WHERE session_id = %s AND hit_count = 0
                     ORDER BY created_at DESC
-                    LIMIT 10
+                    LIMIT %s
                     """,
-                    (session_id,),
+                    # 多取几行，合并未写回的命中后仍能凑满 10 条
+                    (session_id, 10 + len(self.faq_hits.pending())),
                 )
                 unused_faqs = self._rows_to_dicts(cursor.fetchall())
 
-                return {
+                return self._merge_pending_faq_hits(cursor, {
                     'session_id': session_id,
                     'statistics': stats,
                     'hot_faqs': hot_faqs,
                     'unused_faqs': unused_faqs,
-                }
+                }, session_id)
 
             self._execute(
                 cursor,
@@ -1581,7 +2901,7 @@ class Database:
             self._execute(
                 cursor,
                 """
-                SELECT w.pattern, w.answer, w.hit_count, w.product_types, s.host_name, s.live_theme
+                SELECT w.id, w.pattern, w.answer, w.hit_count, w.product_types, s.host_name, s.live_theme
                 FROM whitelist w
                 LEFT JOIN sessions s ON w.session_id = s.id
                 WHERE w.hit_count > 0
@@ -1591,10 +2911,10 @@ class Database:
             )
             hot_faqs = self._rows_to_dicts(cursor.fetchall())
 
-            return {
+            return self._merge_pending_faq_hits(cursor, {
                 'statistics': stats,
                 'hot_faqs': hot_faqs,
-            }
+            })
         except Exception as err:
             logger.error(f"❌ 获取FAQ统计失败: {err}")
             return None
@@ -1602,6 +2922,64 @@ class Database:
             if conn:
                 conn.close()
 
+    def _merge_pending_faq_hits(self, cursor, result, session_id=None):
+        """把尚未写回数据库的 FAQ 命中增量合并进 get_faq_statistics 的结果。"""
+        pending = self.faq_hits.pending()
+        if not pending:
+            if 'unused_faqs' in result:
+                result['unused_faqs'] = result['unused_faqs'][:10]
+            return result
+
+        self._execute(
+            cursor,
+            f"""
+            SELECT w.id, w.session_id, w.pattern, w.answer, w.hit_count, w.last_hit_at, w.product_types,
+                   s.host_name, s.live_theme
+            FROM whitelist w
+            LEFT JOIN sessions s ON w.session_id = s.id
+            WHERE w.id IN ({', '.join(['%s'] * len(pending))})
+            """,
+            tuple(pending),
+        )
+        rows = [
+            row for row in self._rows_to_dicts(cursor.fetchall())
+            if not session_id or row['session_id'] == session_id
+        ]
+
+        stats = result['statistics'] or {}
+        newly_used = 0
+        for row in rows:
+            count, at = pending[row['id']]
+            if not row['hit_count']:
+                newly_used += 1
+            row['hit_count'] = int(row['hit_count'] or 0) + count
+            row['last_hit_at'] = self._format_timestamp(at)
+
+        if rows:
+            stats['total_hits'] = int(stats.get('total_hits') or 0) + sum(pending[row['id']][0] for row in rows)
+            if stats.get('total_faqs'):
+                stats['avg_hits'] = stats['total_hits'] / int(stats['total_faqs'])
+        if session_id and rows:
+            stats['max_hits'] = max([int(stats.get('max_hits') or 0)] + [row['hit_count'] for row in rows])
+            stats['used_faqs'] = int(stats.get('used_faqs') or 0) + newly_used
+            stats['unused_faqs'] = int(stats.get('unused_faqs') or 0) - newly_used
+
+        # 热门 FAQ：原前 N 条与有增量的行合并后重新排序，字段与原查询保持一致
+        limit = 10 if session_id else 20
+        fields = list(result['hot_faqs'][0].keys()) if result['hot_faqs'] else (
+            ['id', 'pattern', 'answer', 'hit_count', 'last_hit_at', 'product_types'] if session_id
+            else ['id', 'pattern', 'answer', 'hit_count', 'product_types', 'host_name', 'live_theme']
+        )
+        hot = {faq['id']: faq for faq in result['hot_faqs']}
+        for row in rows:
+            hot[row['id']] = {field: row.get(field) for field in fields}
+        result['hot_faqs'] = sorted(hot.values(), key=lambda faq: faq['hit_count'], reverse=True)[:limit]
+
+        if 'unused_faqs' in result:
+            used_ids = {row['id'] for row in rows}
+            result['unused_faqs'] = [faq for faq in result['unused_faqs'] if faq['id'] not in used_ids][:10]
+        return result
+
     def get_faq_recommendations(self, session_id, min_hit_count=10):
         conn = None
         try:
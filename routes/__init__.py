@@ -6,5 +6,7 @@ from .faq_routes import faq_bp
 from .chat_routes import chat_bp  
 from .stats_routes import stats_bp
 from .meta_routes import meta_bp
+from .tts_routes import tts_bp
+from .metrics_routes import metrics_bp
 
-__all__ = ['session_bp', 'faq_bp', 'chat_bp', 'stats_bp', 'meta_bp']
+__all__ = ['session_bp', 'faq_bp', 'chat_bp', 'stats_bp', 'meta_bp', 'tts_bp', 'metrics_bp']
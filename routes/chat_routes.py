@@ -1,35 +1,289 @@
 """
 聊天路由 - 处理AI对话
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 import uuid
 import json
 from db_backend import db
+from config import Config
 from services import ai_service
 from utils.logger import get_logger
-import os
+from utils.flood_control import flood_key
+from utils.helpers import calculate_hash, normalize_question
+from utils.singleflight import SingleFlight
 from services import bullet_ws as _bullet_ws
-from services import baidu_tts
+from services.bullet_ingest import bullet_collapser, bullet_ingest, bullet_limiter
+from services.bullet_scheduler import bullet_scheduler
+from services.tts_jobs import tts_jobs
+from services.tts_pipeline import SpeechPipeline
 
 logger = get_logger(__name__)
 
 chat_bp = Blueprint('chat', __name__, url_prefix='/api')
 
+# 相同问题的并发AI调用合并（秒杀时大量观众同时问“多少钱”）
+chat_flights = SingleFlight()
+
+
+def _schedule_audio_for_text(session_id, question, text, product_origin=None, cached_audio_url=None):
+    """为回答文本提交后台语音合成任务，立即返回 (audio_job_id, audio_url, audio_pending)；
+    提交失败返回 (None, None, False)。相同文本的音频已在缓存中时 audio_pending 为 False。
+
+    合成成功后把 audio_url 回写到问答缓存，后续命中同一问题时可直接复用音频；
+    cached_audio_url 为问答缓存中已记录的地址，与结果相同时不再回写。
+    """
+    def _on_done(job):
+        if job.get('status') != 'done' or job.get('audio_url') == cached_audio_url:
+            return
+        try:
+            db.update_cached_audio_url(session_id, question, job.get('audio_url'), product_origin)
+        except Exception:
+            logger.debug('回写缓存 audio_url 失败', exc_info=True)
 
-def _synthesize_audio_for_text(text: str):
-    """尝试为给定文本合成短语音，保存到 static/audio 并返回可访问的 URL；失败返回 None。"""
     try:
-        out_dir = os.path.join(os.getcwd(), 'static', 'audio')
-        os.makedirs(out_dir, exist_ok=True)
-        filename = f"tts_{uuid.uuid4().hex}.wav"
-        out_path = os.path.join(out_dir, filename)
-        # baidu_tts.synthesize 会在成功时返回 out_path 或抛错
-        baidu_tts.synthesize(text, out_path=out_path)
-        return f"/static/audio/{filename}"
+        job = tts_jobs.submit(text, session_id=session_id, on_done=_on_done)
+        return job['job_id'], job['audio_url'], job['status'] != 'done'
     except Exception as e:
-        logger.warning(f'Baidu TTS 合成失败: {e}', exc_info=True)
-        return None
+        logger.warning(f'提交语音合成任务失败: {e}', exc_info=True)
+        return None, None, False
+
+
+def _validate_chat_request(data):
+    """校验聊天请求，返回 (session_id, message, None)；校验失败时第三项为 (错误信息, 状态码)。"""
+    if not data:
+        return None, None, ("请求数据不能为空", 400)
+
+    session_id = data.get('session_id')
+    message = data.get('message')
+
+    # 验证session_id格式
+    if not session_id:
+        return None, None, ("会话ID不能为空", 400)
+
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        return None, None, ("无效的会话ID格式", 400)
+
+    # 验证消息
+    if not message or not isinstance(message, str):
+        return None, None, ("消息不能为空", 400)
+
+    message = message.strip()
+    if not message:
+        return None, None, ("消息不能为空", 400)
+
+    if len(message) > 500:
+        return None, None, ("消息长度不能超过500字符", 400)
+
+    return session_id, message, None
+
+
+def _select_target_product(data, products):
+    """确定目标商品（优先使用请求里显式指明的 product_index/product_id/product_name）"""
+    target_product = None
+    if isinstance(data.get('product_index'), int) or (isinstance(data.get('product_index'), str) and data.get('product_index').isdigit()):
+        try:
+            idx = int(data.get('product_index'))
+            if 0 <= idx < len(products):
+                target_product = products[idx]
+        except Exception:
+            target_product = None
+    elif data.get('product_id'):
+        pid = data.get('product_id')
+        for p in products:
+            if str(p.get('id')) == str(pid) or str(p.get('session_id')) == str(pid):
+                target_product = p
+                break
+    elif data.get('product_name'):
+        pname = data.get('product_name')
+        for p in products:
+            if p.get('product_name') == pname or p.get('name') == pname:
+                target_product = p
+                break
+    elif len(products) == 1:
+        target_product = products[0]
+    return target_product
+
 
+def _extract_product_facts(target_product):
+    """解析 product attributes（可能存为 JSON 字符串），并提取常用字段：origin, sweetness, price, type"""
+    facts = {'origin': None, 'price': None, 'type': None, 'sweetness': None}
+    if not target_product:
+        return facts
+
+    attrs = target_product.get('attributes') or {}
+    try:
+        if isinstance(attrs, str) and attrs:
+            attrs = json.loads(attrs)
+    except Exception:
+        attrs = {}
+    # 常用字段
+    facts['origin'] = attrs.get('origin') or attrs.get('产地') or attrs.get('place_of_origin')
+    facts['sweetness'] = attrs.get('sweetness') or attrs.get('甜度')
+    # 价格与类型可能在顶层或attributes里
+    facts['price'] = target_product.get('price') if target_product.get('price') not in (None, '') else attrs.get('price')
+    facts['type'] = target_product.get('product_type') or target_product.get('type') or attrs.get('type')
+    return facts
+
+
+def _answer_from_shortcuts(session_id, message, product_origin):
+    """依次检查FAQ白名单与问答缓存，返回 (响应体或 None, 缓存匹配信息)。
+
+    缓存匹配信息为 {"type": "exact"/"similar"/"miss", "score", "lookup_ms"}，FAQ 命中时为 None。
+    """
+    # ========== 检查FAQ白名单 ==========
+    faq_answer = db.get_whitelist_answer(session_id, message)
+    if faq_answer:
+        logger.info(f"✅ 返回FAQ答案 - 会话: {session_id}")
+        # 先写缓存再提交后台语音合成，合成完成后由任务回调回写 audio_url
+        try:
+            db.cache_qa_with_origin(session_id, message, faq_answer, None, product_origin)
+        except Exception:
+            # 保持向后兼容
+            try:
+                db.cache_qa(session_id, message, faq_answer)
+            except Exception:
+                logger.debug('缓存 FAQ 答案失败')
+        audio_job_id, audio_url, audio_pending = _schedule_audio_for_text(session_id, message, faq_answer, product_origin)
+        db.save_conversation(session_id, message, faq_answer, audio_url)
+        return {
+            "response": faq_answer,
+            "faq": True,
+            "audio_url": audio_url,
+            "audio_job_id": audio_job_id,
+            "audio_pending": audio_pending
+        }, None
+
+    # ========== 检查问答缓存（包含商品产地作为缓存键；精确未命中时按相似度匹配） ==========
+    cached, cache_match = db.lookup_cached_answer(session_id, message, product_origin)
+    if cached:
+        answer = cached.get('answer')
+        logger.info(f"✅ 返回缓存答案 - 会话: {session_id}, 匹配: {cache_match['type']}")
+        # 始终经语音任务取音频：按内容寻址，文件仍在时直接命中并刷新 LRU 位置，
+        # 已被淘汰或缓存中没有 audio_url 时重新合成，完成后由任务回调回写缓存
+        audio_job_id, audio_url, audio_pending = _schedule_audio_for_text(
+            session_id, message, answer, product_origin, cached_audio_url=cached.get('audio_url'))
+        db.save_conversation(session_id, message, answer, audio_url)
+        return {
+            "response": answer,
+            "cached": True,
+            "cache_match": cache_match,
+            "audio_url": audio_url,
+            "audio_job_id": audio_job_id,
+            "audio_pending": audio_pending
+        }, cache_match
+
+    return None, cache_match
+
+
+def _detect_need_info(message, products, facts):
+    """如果用户在询问产地/甜度/价格但当前商品缺少该字段，返回需要补充的信息描述，否则返回 None。
+
+    不直接让模型编造答案，而是提示前端向用户提问并把结果存起来。
+    """
+    need_info_flag = None
+    product_candidates = [p.get('product_name') or p.get('name') for p in products]
+
+    origin_query_keywords = ['产地', '哪里', '来自', '哪里的']
+    if (any(k in message for k in origin_query_keywords)) and (not facts['origin']):
+        # 记录需要补充的信息，但继续让AI基于现有信息尝试回答
+        need_info_flag = {
+            "info_key": "origin",
+            "prompt": "请告知该商品的产地，我会保存并在后续回答中使用。",
+            "product_candidates": product_candidates
+        }
+
+    # 检查甜度（仅对水果生效）
+    sweetness_query_keywords = ['甜度', '甜', '多甜', '甜吗']
+    product_type = facts['type']
+    if product_type and str(product_type).lower() == 'fruit' and any(k in message for k in sweetness_query_keywords) and (not facts['sweetness']):
+        need_info_flag = {
+            "info_key": "sweetness",
+            "prompt": "请告诉我该水果的甜度（例如：微甜/适中/很甜），我会保存并在后续回答中使用。",
+            "product_candidates": product_candidates
+        }
+
+    # 检查价格询问关键字
+    price_query_keywords = ['价格', '多少钱', '价钱', '价位']
+    if any(k in message for k in price_query_keywords) and (facts['price'] in (None, '', 0)):
+        need_info_flag = {
+            "info_key": "price",
+            "prompt": "该商品的价格目前未提供，请输入价格（数字即可，例如：39.9），我会保存并在后续回答中使用。",
+            "product_candidates": product_candidates
+        }
+
+    return need_info_flag
+
+
+def _flight_key(session_id, message, facts):
+    """单飞合并键：会话 + 归一化问题 + 目标商品事实"""
+    facts_key = json.dumps(facts, sort_keys=True, ensure_ascii=False, default=str)
+    return session_id, normalize_question(message), facts_key
+
+
+def _call_ai_coalesced(session_id, session, message, facts):
+    """调用AI；同一会话内相同问题与相同商品事实的并发请求只调用一次，其余请求等待并共享结果。
+
+    等待超时抛出 TimeoutError；leader 抛出的异常会传递给所有等待者。
+    """
+    def _call():
+        return ai_service.call_api(message, session)
+
+    ai_response, shared = chat_flights.do(
+        _flight_key(session_id, message, facts), _call, timeout=Config.CHAT_COALESCE_TIMEOUT
+    )
+    if shared:
+        logger.info(f"✅ 复用进行中的相同问题结果 - 会话: {session_id}")
+    return ai_response
+
+
+def _finalize_ai_answer(session_id, message, ai_response, need_info_flag=None, audio_segments=None, cache_match=None,
+                        product_origin=None):
+    """缓存AI回答、提交语音合成并保存对话，返回响应体。
+
+    流式接口已按句提交语音时传入 audio_segments，此时不再为整段回答单独合成。
+    product_origin 须与查询缓存时一致（同为目标商品产地），否则写入的缓存键永远不会被命中。
+    """
+    db.cache_qa_with_origin(session_id, message, ai_response, None, product_origin)
+    if audio_segments is None:
+        # 文本先返回，语音在后台合成，完成后由任务回调把 audio_url 回写缓存
+        audio_job_id, audio_url, audio_pending = _schedule_audio_for_text(session_id, message, ai_response, product_origin)
+    else:
+        audio_job_id, audio_url, audio_pending = None, None, False
+    db.save_conversation(session_id, message, ai_response, audio_url)
+
+    resp_body = {
+        "response": ai_response,
+        "status": "success",
+        "audio_url": audio_url,
+        "audio_job_id": audio_job_id,
+        "audio_pending": audio_pending
+    }
+    if audio_segments is not None:
+        resp_body['audio_segments'] = audio_segments
+    if cache_match is not None:
+        resp_body['cache_match'] = cache_match
+    # 若先前检测到需要补充的字段，附带该标记以便前端可以提示用户（但不阻止返回回答）
+    if need_info_flag:
+        resp_body['need_info'] = True
+        resp_body['info_key'] = need_info_flag.get('info_key')
+        resp_body['prompt'] = need_info_flag.get('prompt')
+        resp_body['product_candidates'] = need_info_flag.get('product_candidates')
+
+    return resp_body
+
+
+def _sse(event, payload):
+    """编码一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(generator):
+    return Response(generator, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 
 @chat_bp.route('/chat', methods=['POST'])
@@ -37,32 +291,9 @@ def chat():
     """与AI对话"""
     try:
         data = request.json
-        
-        if not data:
-            return jsonify({"error": "请求数据不能为空"}), 400
-        
-        session_id = data.get('session_id')
-        message = data.get('message')
-        
-        # 验证session_id格式
-        if not session_id:
-            return jsonify({"error": "会话ID不能为空"}), 400
-        
-        try:
-            uuid.UUID(session_id)
-        except ValueError:
-            return jsonify({"error": "无效的会话ID格式"}), 400
-        
-        # 验证消息
-        if not message or not isinstance(message, str):
-            return jsonify({"error": "消息不能为空"}), 400
-        
-        message = message.strip()
-        if not message:
-            return jsonify({"error": "消息不能为空"}), 400
-        
-        if len(message) > 500:
-            return jsonify({"error": "消息长度不能超过500字符"}), 400
+        session_id, message, error = _validate_chat_request(data)
+        if error:
+            return jsonify({"error": error[0]}), error[1]
         
         logger.info(f"收到聊天请求 - 会话: {session_id}, 消息长度: {len(message)}")
         
@@ -75,169 +306,35 @@ def chat():
                 "sensitive": True
             }), 400
         
-        # 在继续之前获取会话信息（以便读取商品属性、防止 AI 编造）
-        session = db.get_session(session_id)
-        if not session:
+        # 在继续之前获取会话信息（以便读取商品属性、防止 AI 编造）；稳态下来自会话事实缓存
+        session_facts = db.get_session_facts(session_id)
+        if not session_facts:
             return jsonify({"error": "会话不存在"}), 404
+        session = session_facts['session']
 
-        # 确定目标商品（优先使用请求里显式指明的 product_index/product_id/product_name）
         products = session.get('products', [])
-        target_product = None
-        if isinstance(data.get('product_index'), int) or (isinstance(data.get('product_index'), str) and data.get('product_index').isdigit()):
-            try:
-                idx = int(data.get('product_index'))
-                if 0 <= idx < len(products):
-                    target_product = products[idx]
-            except Exception:
-                target_product = None
-        elif data.get('product_id'):
-            pid = data.get('product_id')
-            for p in products:
-                if str(p.get('id')) == str(pid) or str(p.get('session_id')) == str(pid):
-                    target_product = p
-                    break
-        elif data.get('product_name'):
-            pname = data.get('product_name')
-            for p in products:
-                if p.get('product_name') == pname or p.get('name') == pname:
-                    target_product = p
-                    break
-        elif len(products) == 1:
-            target_product = products[0]
-
-        # 解析 product attributes（可能存为 JSON 字符串），并提取常用字段：origin, sweetness, price, type
-        product_origin = None
-        product_price = None
-        product_type = None
-        product_sweetness = None
-        if target_product:
-            attrs = target_product.get('attributes') or {}
-            try:
-                if isinstance(attrs, str) and attrs:
-                    attrs = json.loads(attrs)
-            except Exception:
-                attrs = {}
-            # 常用字段
-            product_origin = attrs.get('origin') or attrs.get('产地') or attrs.get('place_of_origin')
-            product_sweetness = attrs.get('sweetness') or attrs.get('甜度')
-            # 价格与类型可能在顶层或attributes里
-            product_price = target_product.get('price') if target_product.get('price') not in (None, '') else attrs.get('price')
-            product_type = target_product.get('product_type') or target_product.get('type') or attrs.get('type')
-
-        # ========== 第二步：检查FAQ白名单 ==========
-        faq_answer = db.get_whitelist_answer(session_id, message)
-        if faq_answer:
-            logger.info(f"✅ 返回FAQ答案 - 会话: {session_id}")
-            # 始终为返回文本合成语音（失败则返回 null），并把 audio_url 一并保存到缓存与会话
-            audio_url = _synthesize_audio_for_text(faq_answer)
-            try:
-                db.cache_qa_with_origin(session_id, message, faq_answer, audio_url, product_origin)
-            except Exception:
-                # 保持向后兼容
-                try:
-                    db.cache_qa(session_id, message, faq_answer, audio_url)
-                except Exception:
-                    logger.debug('缓存 FAQ 答案失败')
-            db.save_conversation(session_id, message, faq_answer, audio_url)
-            return jsonify({"response": faq_answer, "faq": True, "audio_url": audio_url})
-        
-        # ========== 第三步：检查问答缓存 ==========
-        # ========== 第三步：检查问答缓存（包含商品产地作为缓存键） ==========
-        try:
-            cached = db.get_cached_answer_with_origin(session_id, message, product_origin)
-        except AttributeError:
-            # 兼容旧接口
-            cached = db.get_cached_answer(session_id, message)
-        if cached:
-            # cached 现在为 {'answer': ..., 'audio_url': ...}
-            answer = cached.get('answer') if isinstance(cached, dict) else cached
-            audio_url = cached.get('audio_url') if isinstance(cached, dict) else None
-            logger.info(f"✅ 返回缓存答案 - 会话: {session_id}")
-            # 若缓存中没有 audio_url，则合成并回写缓存
-            if not audio_url:
-                audio_url = _synthesize_audio_for_text(answer)
-                try:
-                    db.cache_qa_with_origin(session_id, message, answer, audio_url, product_origin)
-                except Exception:
-                    try:
-                        db.cache_qa(session_id, message, answer, audio_url)
-                    except Exception:
-                        logger.debug('更新缓存 audio_url 失败')
-            db.save_conversation(session_id, message, answer, audio_url)
-            return jsonify({"response": answer, "cached": True, "audio_url": audio_url})
+        facts = _extract_product_facts(_select_target_product(data, products))
+
+        # ========== 第二、三步：检查FAQ白名单与问答缓存 ==========
+        shortcut, cache_match = _answer_from_shortcuts(session_id, message, facts['origin'])
+        if shortcut:
+            return jsonify(shortcut)
         
         # ========== 第四步：调用AI API ==========
         logger.info(f"调用AI API - 会话: {session_id}")
 
-        # 如果用户在询问产地但当前商品没有 origin，我们不直接让模型编造答案，
-        # 而是提示前端向用户提问并把结果存起来。
-        origin_query_keywords = ['产地', '哪里', '来自', '哪里的']
-        need_info_flag = None
-        if (any(k in message for k in origin_query_keywords)) and (not product_origin):
-            # 记录需要补充的信息，但继续让AI基于现有信息尝试回答
-            product_candidates = [p.get('product_name') or p.get('name') for p in products]
-            need_info_flag = {
-                "info_key": "origin",
-                "prompt": "请告知该商品的产地，我会保存并在后续回答中使用。",
-                "product_candidates": product_candidates
-            }
-
-        # 检查甜度（仅对水果生效）
-        sweetness_query_keywords = ['甜度', '甜', '多甜', '甜吗']
-        if product_type and str(product_type).lower() == 'fruit' and any(k in message for k in sweetness_query_keywords) and (not product_sweetness):
-            product_candidates = [p.get('product_name') or p.get('name') for p in products]
-            need_info_flag = {
-                "info_key": "sweetness",
-                "prompt": "请告诉我该水果的甜度（例如：微甜/适中/很甜），我会保存并在后续回答中使用。",
-                "product_candidates": product_candidates
-            }
-
-        # 检查价格询问关键字
-        price_query_keywords = ['价格', '多少钱', '价钱', '价位']
-        if any(k in message for k in price_query_keywords) and (product_price in (None, '', 0)):
-            product_candidates = [p.get('product_name') or p.get('name') for p in products]
-            need_info_flag = {
-                "info_key": "price",
-                "prompt": "该商品的价格目前未提供，请输入价格（数字即可，例如：39.9），我会保存并在后续回答中使用。",
-                "product_candidates": product_candidates
-            }
-
-        # 将每个商品的补充信息（包括 origin）合并到 session.products 的 attributes
-        try:
-            merged_products = []
-            for p in session.get('products', []):
-                # 兼容不同字段名
-                pname = p.get('product_name') or p.get('name')
-                pid = p.get('id')
-                merged_attrs = {}
-                try:
-                    merged_attrs = db.get_product_info(session_id, product_name=pname, product_id=pid) or {}
-                except Exception:
-                    merged_attrs = {}
+        need_info_flag = _detect_need_info(message, products, facts)
 
-                # existing attrs可能为字符串或dict
-                existing = p.get('attributes') or {}
-                try:
-                    if isinstance(existing, str) and existing:
-                        existing = json.loads(existing)
-                except Exception:
-                    existing = {}
-
-                # 合并：以 product_info 中的键为准（已由 save_product_info 保证不覆盖用户已有值）
-                merged = dict(existing)
-                for k, v in (merged_attrs or {}).items():
-                    if k and v is not None:
-                        merged[k] = v
+        # 等待 AI 响应期间不占用数据库连接
+        if not db.checkpoint():
+            return jsonify({"error": "保存数据失败，请稍后重试"}), 500
 
-                newp = dict(p)
-                newp['attributes'] = merged
-                merged_products.append(newp)
-
-            session['products'] = merged_products
-        except Exception:
-            logger.debug('合并产品信息失败，继续使用原始 session')
-
-        ai_response = ai_service.call_api(message, session)
+        try:
+            # 提示词使用合并了补充信息（包括 origin）的商品
+            ai_session = {**session, 'products': session_facts['products']}
+            ai_response = _call_ai_coalesced(session_id, ai_session, message, facts)
+        except TimeoutError:
+            return jsonify({"error": "AI服务繁忙，请稍后重试"}), 503
 
         if not ai_response:
             return jsonify({"error": "AI服务暂时不可用，请稍后重试"}), 503
@@ -245,30 +342,157 @@ def chat():
         logger.info(f"✅ AI响应成功 - 会话: {session_id}")
 
         # ========== 第五步：缓存问答对 ==========
-        # 先合成语音并把 audio_url 一并保存到缓存与会话，避免重复合成
-        audio_url = _synthesize_audio_for_text(ai_response)
-        db.cache_qa(session_id, message, ai_response, audio_url)
-        db.save_conversation(session_id, message, ai_response, audio_url)
-
-        resp_body = {
-            "response": ai_response,
-            "status": "success",
-            "audio_url": audio_url
-        }
-        # 若先前检测到需要补充的字段，附带该标记以便前端可以提示用户（但不阻止返回回答）
-        if need_info_flag:
-            resp_body['need_info'] = True
-            resp_body['info_key'] = need_info_flag.get('info_key')
-            resp_body['prompt'] = need_info_flag.get('prompt')
-            resp_body['product_candidates'] = need_info_flag.get('product_candidates')
-
-        return jsonify(resp_body)
+        return jsonify(_finalize_ai_answer(
+            session_id, message, ai_response, need_info_flag, cache_match=cache_match, product_origin=facts['origin']
+        ))
         
     except Exception as e:
         logger.error(f"聊天处理异常: {str(e)}", exc_info=True)
         return jsonify({"error": f"服务器错误: {str(e)}"}), 500
 
 
+@chat_bp.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """与AI对话（流式）：以 SSE 逐段推送模型输出。
+
+    事件类型：delta（增量文本 {"content"}）、audio_segment（分句语音片段 {"index", "text",
+    "audio_url", "audio_job_id", "audio_pending"}）、done（最终响应体，字段同 /api/chat，
+    模型回答另含按序的 audio_segments 播放列表）、error。
+    FAQ 与缓存命中时直接推送一条完整的 delta 后结束。
+    """
+    try:
+        data = request.json
+        session_id, message, error = _validate_chat_request(data)
+        if error:
+            return jsonify({"error": error[0]}), error[1]
+
+        logger.info(f"收到流式聊天请求 - 会话: {session_id}, 消息长度: {len(message)}")
+
+        is_sensitive, matched_words = db.check_sensitive_words(message)
+        if is_sensitive:
+            logger.warning(f"⚠️ 消息包含敏感词: {matched_words}")
+            return jsonify({
+                "error": "您的消息包含不当内容，请文明用语。",
+                "sensitive": True
+            }), 400
+
+        session_facts = db.get_session_facts(session_id)
+        if not session_facts:
+            return jsonify({"error": "会话不存在"}), 404
+        session = session_facts['session']
+
+        products = session.get('products', [])
+        facts = _extract_product_facts(_select_target_product(data, products))
+
+        shortcut, cache_match = _answer_from_shortcuts(session_id, message, facts['origin'])
+        if shortcut:
+            def generate_shortcut():
+                yield _sse('delta', {"content": shortcut['response']})
+                yield _sse('done', shortcut)
+            return _sse_response(generate_shortcut())
+
+        need_info_flag = _detect_need_info(message, products, facts)
+
+        flight_key = _flight_key(session_id, message, facts)
+        ai_session = {**session, 'products': session_facts['products']}
+        # 流式输出期间不占用数据库连接；响应开始后无法再返回错误状态，在此之前提交
+        if not db.checkpoint():
+            return jsonify({"error": "保存数据失败，请稍后重试"}), 500
+
+        def generate():
+            parts = []
+            # 每生成一个完整句子就提交语音合成，首句音频与后续文本生成并行
+            speech = SpeechPipeline(session_id)
+            # 相同问题已有请求在生成时，等待其完整回答后一次性推送。在生成器内登记：
+            # 响应开始迭代前失败或客户端断开时不会留下无人完成的调用
+            call, leader = chat_flights.acquire(flight_key)
+            if not leader:
+                try:
+                    shared_response = chat_flights.wait(call, Config.CHAT_COALESCE_TIMEOUT)
+                except Exception as e:
+                    logger.warning(f"等待相同问题结果失败 - 会话: {session_id}: {e}")
+                    yield _sse('error', {"error": "AI服务暂时不可用，请稍后重试"})
+                    return
+                logger.info(f"✅ 复用进行中的相同问题结果 - 会话: {session_id}")
+                if shared_response:
+                    parts.append(shared_response)
+                    yield _sse('delta', {"content": shared_response})
+                    for segment in speech.feed(shared_response):
+                        yield _sse('audio_segment', segment)
+            else:
+                try:
+                    for delta in ai_service.stream_api(message, ai_session):
+                        parts.append(delta)
+                        yield _sse('delta', {"content": delta})
+                        for segment in speech.feed(delta):
+                            yield _sse('audio_segment', segment)
+                    chat_flights.resolve(flight_key, call, ''.join(parts))
+                except Exception as e:
+                    # 流中断时不缓存不完整的回答
+                    chat_flights.reject(flight_key, call, e)
+                    logger.error(f"流式AI响应中断 - 会话: {session_id}: {e}")
+                    yield _sse('error', {"error": "AI服务暂时不可用，请稍后重试"})
+                    return
+                finally:
+                    # 客户端断开等情况下也要释放等待中的相同请求
+                    if not call.done:
+                        chat_flights.reject(flight_key, call, RuntimeError('流式请求已中止'))
+
+            ai_response = ''.join(parts)
+            if not ai_response:
+                yield _sse('error', {"error": "AI服务暂时不可用，请稍后重试"})
+                return
+
+            for segment in speech.finish():
+                yield _sse('audio_segment', segment)
+
+            logger.info(f"✅ 流式AI响应完成 - 会话: {session_id}, 语音分段: {len(speech.playlist)}")
+            yield _sse('done', _finalize_ai_answer(
+                session_id, message, ai_response, need_info_flag,
+                audio_segments=speech.playlist, cache_match=cache_match, product_origin=facts['origin']
+            ))
+
+        return _sse_response(stream_with_context(generate()))
+
+    except Exception as e:
+        logger.error(f"流式聊天处理异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+def _check_blacklist(session_id, username, message):
+    """检查是否在黑名单（兼容 db.is_blacklisted 返回 bool 或 (bool, reason)），返回 (is_blocked, reason)"""
+    try:
+        res = db.is_blacklisted(session_id, username, message)
+        if isinstance(res, (list, tuple)):
+            return res[0], (res[1] if len(res) > 1 else None)
+        return bool(res), None
+    except Exception as e:
+        logger.warning(f"检查黑名单时出错: {e}")
+        return False, None
+
+
+def _check_flood(session_id, username, message):
+    """刷屏控制，返回 (status, dedupe_key)：status 为 None 时正常写入，否则为 rate_limited（该用户发送过快，丢弃）
+    或 collapsed（窗口内已有相同弹幕，只给那一行的 repeat_count 加 1）"""
+    if not bullet_limiter.allow((session_id, username)):
+        return 'rate_limited', None
+    dedupe_key = calculate_hash(flood_key(message))
+    if bullet_collapser.is_duplicate((session_id, dedupe_key)):
+        # 第一条尚未落库时计在待写入的行上，否则写回已有行
+        if not bullet_ingest.add_repeat(session_id, dedupe_key):
+            db.record_bullet_repeat(session_id, dedupe_key)
+        return 'collapsed', dedupe_key
+    bullet_ingest.reserve(session_id, dedupe_key)
+    return None, dedupe_key
+
+
+def _undo_flood_check(session_id, username, dedupe_key):
+    """弹幕最终没有写入时退回令牌并撤销合并登记（已计入的重复一并丢弃），客户端重试时不会被误判为刷屏"""
+    bullet_limiter.refund((session_id, username))
+    bullet_collapser.forget((session_id, dedupe_key))
+    bullet_ingest.release(session_id, dedupe_key)
+
+
 @chat_bp.route('/bullet-screen', methods=['POST'])
 def add_bullet_screen():
     """添加弹幕"""
@@ -293,23 +517,20 @@ def add_bullet_screen():
         
         logger.info(f"收到弹幕 - 会话: {session_id}, 用户: {username}")
         
-        # 检查是否在黑名单（兼容 db.is_blacklisted 返回 bool 或 (bool, reason)）
-        try:
-            res = db.is_blacklisted(session_id, username, message)
-            if isinstance(res, (list, tuple)):
-                is_blocked, reason = res[0], (res[1] if len(res) > 1 else None)
-            else:
-                is_blocked, reason = bool(res), None
-        except Exception as e:
-            logger.warning(f"检查黑名单时出错: {e}")
-            is_blocked, reason = False, None
-
+        is_blocked, reason = _check_blacklist(session_id, username, message)
         if is_blocked:
             logger.warning(f"⚠️ 弹幕被拦截 - 原因: {reason}")
             return jsonify({"status": "blocked", "reason": reason})
         
+        flood_status, dedupe_key = _check_flood(session_id, username, message)
+        if flood_status:
+            return jsonify({"status": flood_status})
+
+        # 入库前分类，问候、刷屏等低优先级弹幕不会被 pending/claim 取出交给 AI
+        category, priority = db.classify_bullet_screen(session_id, message)
+
         # 添加弹幕
-        if db.add_bullet_screen(session_id, username, message):
+        if bullet_ingest.insert((session_id, username, message, category, priority, dedupe_key)):
             # 广播到 WebSocket 客户端（若已启用）以实现实时推送
             try:
                 if _bullet_ws:
@@ -317,24 +538,126 @@ def add_bullet_screen():
                         'type': 'bullet',
                         'session_id': session_id,
                         'username': username,
-                        'message': message
+                        'message': message,
+                        'category': category
                     })
             except Exception:
                 logger.warning('弹幕广播失败', exc_info=True)
-            return jsonify({"status": "success"})
+            return jsonify({"status": "success", "category": category, "priority": priority})
         else:
+            _undo_flood_check(session_id, username, dedupe_key)
             return jsonify({"error": "添加弹幕失败"}), 500
             
     except Exception as e:
         logger.error(f"添加弹幕异常: {str(e)}", exc_info=True)
         return jsonify({"error": f"服务器错误: {str(e)}"}), 500
 
+@chat_bp.route('/bullet-screen/batch', methods=['POST'])
+def add_bullet_screens_batch():
+    """批量添加弹幕
+
+    请求体：{"session_id", "bullets": [{"username", "message"}, ...]}；
+    与单条接口一致，每条弹幕在入库前由服务端分类并设置优先级（客户端传入的 category/priority 被忽略）。
+    通过黑名单与刷屏检查的弹幕进入批量写入缓冲，与其他请求的弹幕合并提交，落库后返回；
+    results 与 bullets 一一对应，status 为 accepted / blocked / rate_limited / collapsed / failed。
+    缓冲已满时返回 429，客户端应按 Retry-After 稍后重试整批。
+    """
+    try:
+        data = request.json
+
+        if not data:
+            return jsonify({"error": "请求数据不能为空"}), 400
+
+        session_id = data.get('session_id')
+        bullets = data.get('bullets')
+
+        if not session_id or not isinstance(bullets, list) or not bullets:
+            return jsonify({"error": "缺少必要参数"}), 400
+        if len(bullets) > Config.BULLET_BATCH_MAX:
+            return jsonify({"error": f"单次最多 {Config.BULLET_BATCH_MAX} 条弹幕"}), 400
+
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            return jsonify({"error": "无效的会话ID"}), 400
+
+        for item in bullets:
+            if not isinstance(item, dict) or not item.get('username') or not item.get('message'):
+                return jsonify({"error": "每条弹幕都需要 username 与 message"}), 400
+
+        # 会话不存在时整批写入会因外键失败，提前拒绝
+        if not db.session_exists(session_id):
+            return jsonify({"error": "会话不存在"}), 404
+
+        results = []
+        rows = []
+        for item in bullets:
+            is_blocked, reason = _check_blacklist(session_id, item['username'], item['message'])
+            if is_blocked:
+                results.append({"status": "blocked", "reason": reason})
+                continue
+            flood_status, dedupe_key = _check_flood(session_id, item['username'], item['message'])
+            if flood_status:
+                results.append({"status": flood_status})
+                continue
+            results.append(None)
+            category, priority = db.classify_bullet_screen(session_id, item['message'])
+            rows.append((session_id, item['username'], item['message'], category, priority, dedupe_key))
+
+        # 等待落库期间不占用本请求的数据库连接
+        if not db.checkpoint():
+            for row in rows:
+                _undo_flood_check(session_id, row[1], row[5])
+            return jsonify({"error": "保存数据失败，请稍后重试"}), 500
+
+        written = []
+        if rows:
+            ticket = bullet_ingest.submit(rows)
+            if ticket is None:
+                for row in rows:
+                    _undo_flood_check(session_id, row[1], row[5])
+                logger.warning(f"⚠️ 弹幕缓冲已满，拒绝 {len(rows)} 条 - 会话: {session_id}")
+                return jsonify({"error": "弹幕过多，请稍后重试"}), 429, {"Retry-After": "1"}
+            written = ticket.wait(Config.BULLET_COMMIT_TIMEOUT)
+            if written is None:
+                return jsonify({"error": "弹幕写入超时"}), 503
+
+        accepted = iter(zip(rows, written))
+        for index, result in enumerate(results):
+            if result is not None:
+                continue
+            row, ok = next(accepted)
+            if not ok:
+                _undo_flood_check(session_id, row[1], row[5])
+            results[index] = {"status": "accepted", "category": row[3], "priority": row[4]} if ok else {"status": "failed"}
+            if ok and _bullet_ws:
+                try:
+                    _bullet_ws.broadcast({
+                        'type': 'bullet',
+                        'session_id': session_id,
+                        'username': row[1],
+                        'message': row[2],
+                        'category': row[3]
+                    })
+                except Exception:
+                    logger.warning('弹幕广播失败', exc_info=True)
+
+        accepted_count = sum(1 for r in results if r['status'] == 'accepted')
+        logger.info(f"批量弹幕 - 会话: {session_id}, 共 {len(bullets)} 条, 写入 {accepted_count} 条")
+        return jsonify({"status": "success", "accepted": accepted_count, "results": results})
+
+    except Exception as e:
+        logger.error(f"批量添加弹幕异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
 @chat_bp.route('/bullet-screen/pending', methods=['GET'])
 def get_pending_bullet_screens():
-    """获取待处理的弹幕"""
+    """获取待处理的弹幕；默认只返回优先级不低于 BULLET_AI_MIN_PRIORITY 的弹幕（可用 min_priority 参数覆盖）"""
     try:
         session_id = request.args.get('session_id')
         limit = request.args.get('limit', 10, type=int)
+        min_priority = request.args.get('min_priority', Config.BULLET_AI_MIN_PRIORITY, type=int)
         
         if not session_id:
             return jsonify({"error": "缺少session_id参数"}), 400
@@ -348,7 +671,7 @@ def get_pending_bullet_screens():
         logger.info(f"获取待处理弹幕 - 会话: {session_id}, 限制: {limit}")
         
         # 获取弹幕
-        bullet_screens = db.get_pending_bullet_screens(session_id, limit)
+        bullet_screens = db.get_pending_bullet_screens(session_id, limit, min_priority)
         
         return jsonify({
             "session_id": session_id,
@@ -361,4 +684,184 @@ def get_pending_bullet_screens():
         return jsonify({"error": f"服务器错误: {str(e)}"}), 500
 
 
-# 语音模块已移除：/api/tts 文件与状态端点不再提供。
+def _parse_worker_request(data):
+    """解析 ack/nack 请求体，返回 (worker_id, ids, error)"""
+    if not data:
+        return None, None, ("请求数据不能为空", 400)
+    worker_id = data.get('worker_id')
+    ids = data.get('ids')
+    if not worker_id or not isinstance(ids, list) or not ids:
+        return None, None, ("缺少必要参数", 400)
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return None, None, ("ids 必须为整数列表", 400)
+    return str(worker_id), ids, None
+
+
+@chat_bp.route('/bullet-screen/claim', methods=['POST'])
+def claim_bullet_screens():
+    """认领待处理弹幕
+
+    请求体：{"session_id", "worker_id", "limit"?（1-100，默认10）, "lease_seconds"?, "min_priority"?}。
+    min_priority 默认为 BULLET_AI_MIN_PRIORITY，只认领值得交给 AI 回答的弹幕。
+    认领到的弹幕在租约期内不会再投递给其他 worker；处理完成后调用 ack，失败调用 nack，
+    租约过期未确认的弹幕会被重新投递，投递次数达到上限后转入死信。
+    """
+    try:
+        data = request.json
+
+        if not data:
+            return jsonify({"error": "请求数据不能为空"}), 400
+
+        session_id = data.get('session_id')
+        worker_id = data.get('worker_id')
+        if not session_id or not worker_id:
+            return jsonify({"error": "缺少必要参数"}), 400
+
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            return jsonify({"error": "无效的会话ID"}), 400
+
+        try:
+            limit = int(data.get('limit', 10))
+            lease_seconds = int(data.get('lease_seconds') or db.bullet_lease_seconds)
+            min_priority = int(data.get('min_priority', Config.BULLET_AI_MIN_PRIORITY))
+        except (TypeError, ValueError):
+            return jsonify({"error": "limit、lease_seconds 与 min_priority 必须为整数"}), 400
+        if not 1 <= limit <= 100 or not 1 <= lease_seconds <= 3600:
+            return jsonify({"error": "limit 取值 1-100，lease_seconds 取值 1-3600"}), 400
+
+        bullet_screens = db.claim_bullet_screens(session_id, str(worker_id), limit, lease_seconds, min_priority)
+        logger.info(f"认领弹幕 - 会话: {session_id}, worker: {worker_id}, 数量: {len(bullet_screens)}")
+
+        return jsonify({
+            "session_id": session_id,
+            "worker_id": worker_id,
+            "lease_seconds": lease_seconds,
+            "bullet_screens": bullet_screens,
+            "count": len(bullet_screens)
+        })
+
+    except Exception as e:
+        logger.error(f"认领弹幕异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@chat_bp.route('/bullet-screen/next', methods=['POST'])
+def next_bullet_screens():
+    """调度下一批要回答的弹幕
+
+    请求体：{"session_id", "worker_id", "limit"?（1-20，默认1）, "lease_seconds"?, "min_priority"?}。
+    与 claim 不同，按用户加权公平排队选取（单个用户刷屏不会挤占其他人），同话题弹幕只回答一条
+    （其余合并到该条，merged_ids 为合并的弹幕，随该条 ack 完成、nack 或租约过期时重新排队），等待过久的弹幕直接过期；
+    超出每分钟回答预算时返回空列表与 retry_after。选中的弹幕以租约方式认领，处理后调用 ack/nack。
+    """
+    try:
+        data = request.json
+
+        if not data:
+            return jsonify({"error": "请求数据不能为空"}), 400
+
+        session_id = data.get('session_id')
+        worker_id = data.get('worker_id')
+        if not session_id or not worker_id:
+            return jsonify({"error": "缺少必要参数"}), 400
+
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            return jsonify({"error": "无效的会话ID"}), 400
+
+        try:
+            limit = int(data.get('limit', 1))
+            lease_seconds = int(data.get('lease_seconds') or db.bullet_lease_seconds)
+            min_priority = int(data.get('min_priority', Config.BULLET_AI_MIN_PRIORITY))
+        except (TypeError, ValueError):
+            return jsonify({"error": "limit、lease_seconds 与 min_priority 必须为整数"}), 400
+        if not 1 <= limit <= 20 or not 1 <= lease_seconds <= 3600:
+            return jsonify({"error": "limit 取值 1-20，lease_seconds 取值 1-3600"}), 400
+
+        result = bullet_scheduler.next_batch(session_id, str(worker_id), limit, lease_seconds, min_priority)
+        logger.info(
+            f"调度弹幕 - 会话: {session_id}, worker: {worker_id}, 选中: {len(result['bullet_screens'])}, "
+            f"合并: {result['merged']}, 过期: {result['expired']}"
+        )
+
+        return jsonify({
+            "session_id": session_id,
+            "worker_id": worker_id,
+            "lease_seconds": lease_seconds,
+            **result,
+            "count": len(result['bullet_screens'])
+        })
+
+    except Exception as e:
+        logger.error(f"调度弹幕异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@chat_bp.route('/bullet-screen/ack', methods=['POST'])
+def ack_bullet_screens():
+    """确认弹幕已处理：{"worker_id", "ids"}；租约已被其他 worker 接手的弹幕不计入 acked"""
+    try:
+        worker_id, ids, error = _parse_worker_request(request.json)
+        if error:
+            return jsonify({"error": error[0]}), error[1]
+
+        acked = db.ack_bullet_screens(worker_id, ids)
+        return jsonify({"status": "success", "acked": acked, "requested": len(ids)})
+
+    except Exception as e:
+        logger.error(f"确认弹幕异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@chat_bp.route('/bullet-screen/nack', methods=['POST'])
+def nack_bullet_screens():
+    """退回处理失败的弹幕：{"worker_id", "ids", "requeue"?（默认 true）, "error"?}
+
+    requeue 为 true 时立即重新投递（投递次数已达上限的转入死信），为 false 时直接转入死信。
+    """
+    try:
+        data = request.json
+        worker_id, ids, error = _parse_worker_request(data)
+        if error:
+            return jsonify({"error": error[0]}), error[1]
+
+        result = db.nack_bullet_screens(
+            worker_id, ids, requeue=bool(data.get('requeue', True)), error=data.get('error')
+        )
+        return jsonify({"status": "success", **result, "requested": len(ids)})
+
+    except Exception as e:
+        logger.error(f"退回弹幕异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@chat_bp.route('/bullet-screen/dead-letter', methods=['GET'])
+def get_dead_letter_bullet_screens():
+    """获取进入死信的弹幕（最新在前）"""
+    try:
+        session_id = request.args.get('session_id')
+        limit = request.args.get('limit', 50, type=int)
+
+        if not session_id:
+            return jsonify({"error": "缺少session_id参数"}), 400
+
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            return jsonify({"error": "无效的会话ID"}), 400
+
+        bullet_screens = db.get_dead_letter_bullet_screens(session_id, max(1, min(limit, 500)))
+        return jsonify({
+            "session_id": session_id,
+            "bullet_screens": bullet_screens,
+            "count": len(bullet_screens)
+        })
+
+    except Exception as e:
+        logger.error(f"获取死信弹幕异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
@@ -102,8 +102,7 @@ def import_faqs():
             return jsonify({"error": "无效的会话ID"}), 400
         
         # 验证会话是否存在
-        session = db.get_session(session_id)
-        if not session:
+        if not db.session_exists(session_id):
             return jsonify({"error": "会话不存在"}), 404
         
         logger.info(f"批量导入FAQ - 会话: {session_id}")
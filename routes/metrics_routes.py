@@ -0,0 +1,91 @@
+"""
+指标路由 - 缓存与内部组件运行指标
+"""
+import uuid
+
+from flask import Blueprint, jsonify, request
+from config import Config
+from db_backend import db
+from services.bullet_ingest import bullet_collapser, bullet_ingest, bullet_limiter
+from services import bullet_ws
+from services.bullet_scheduler import bullet_scheduler
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+metrics_bp = Blueprint('metrics', __name__, url_prefix='/api/metrics')
+
+
+@metrics_bp.route('/cache', methods=['GET'])
+def get_cache_metrics():
+    """问答缓存与会话事实缓存指标（L1 命中/未命中、容量、淘汰与失效次数）"""
+    try:
+        return jsonify({"qa_cache": db.get_qa_cache_stats(), "session_facts": db.get_session_facts_stats()})
+    except Exception as e:
+        logger.error(f"获取缓存指标异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@metrics_bp.route('/rules', methods=['GET'])
+def get_rule_metrics():
+    """规则文件快照指标（黑名单/白名单重新载入次数、失败次数与最近载入时间）"""
+    try:
+        return jsonify(db.get_rule_file_stats())
+    except Exception as e:
+        logger.error(f"获取规则文件指标异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@metrics_bp.route('/db', methods=['GET'])
+def get_db_metrics():
+    """数据库连接指标（当前后端、连接池占用/排队/等待耗时直方图、熔断器状态与回退/恢复次数）"""
+    try:
+        return jsonify(db.get_pool_stats())
+    except Exception as e:
+        logger.error(f"获取数据库指标异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@metrics_bp.route('/ingest', methods=['GET'])
+def get_ingest_metrics():
+    """弹幕批量写入缓冲指标（缓冲占用、429 拒绝数、批次数与平均批大小、写入失败数），
+    以及刷屏控制指标（按用户限流、重复合并与待写回的重复次数）"""
+    try:
+        return jsonify({
+            **bullet_ingest.stats(),
+            "rate_limit": bullet_limiter.stats(),
+            "collapse": bullet_collapser.stats(),
+            "repeat_counts": db.bullet_repeats.stats(),
+        })
+    except Exception as e:
+        logger.error(f"获取弹幕写入指标异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@metrics_bp.route('/scheduler', methods=['GET'])
+def get_scheduler_metrics():
+    """弹幕回答调度指标（回答预算使用、调度/合并/过期条数、等待时长直方图）；
+    带 session_id 参数时另返回该会话的队列深度、排队用户数与最久等待秒数"""
+    try:
+        result = bullet_scheduler.stats()
+        session_id = request.args.get('session_id')
+        if session_id:
+            try:
+                uuid.UUID(session_id)
+            except ValueError:
+                return jsonify({"error": "无效的会话ID"}), 400
+            result['queue'] = db.get_bullet_queue_depth(session_id, Config.BULLET_AI_MIN_PRIORITY)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"获取调度指标异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@metrics_bp.route('/ws', methods=['GET'])
+def get_ws_metrics():
+    """WebSocket 推送指标（连接/房间/订阅数、合并帧数与扇出数、丢弃帧数、发送队列深度、驱逐数）"""
+    try:
+        return jsonify(bullet_ws.stats())
+    except Exception as e:
+        logger.error(f"获取 WebSocket 推送指标异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
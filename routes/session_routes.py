@@ -146,20 +146,40 @@ def create_session():
 
 @session_bp.route('/<session_id>', methods=['GET'])
 def get_session(session_id):
-    """获取会话信息"""
+    """获取会话信息
+
+    返回会话、商品与完整的对话记录 ``conversations``。传入 ``limit`` 或 ``since_id`` 时改为分页：
+    ``since_id`` 为游标（返回 id 更大的记录），``limit`` 为每页条数（默认50，最大500），响应中的
+    ``conversations_next_since_id`` 为下一页游标，没有更多记录时为 null。``include`` 指定附带的可选部分
+    （逗号分隔，目前只有 conversations），不传时默认附带；只需会话与商品时传空的 ``?include=``。
+    """
     try:
         # 验证session_id格式
         try:
             uuid.UUID(session_id)
         except ValueError:
             return jsonify({"error": "无效的会话ID"}), 400
-        
+
+        include = {part.strip() for part in request.args.get('include', 'conversations').split(',') if part.strip()}
+        paginate = 'limit' in request.args or 'since_id' in request.args
+        limit = request.args.get('limit', 50, type=int)
+        since_id = request.args.get('since_id', 0, type=int)
+        if limit < 1 or limit > 500 or since_id < 0:
+            return jsonify({"error": "limit 须在 1-500 之间，since_id 不能为负数"}), 400
+
         logger.info(f"查询会话 - ID: {session_id}")
         
         # 获取会话
-        session = db.get_session(session_id)
+        session = db.get_session_meta(session_id)
         if not session:
             return jsonify({"error": "会话不存在"}), 404
+
+        if 'conversations' in include and paginate:
+            conversations = db.get_conversations(session_id, since_id=since_id, limit=limit)
+            session['conversations'] = conversations
+            session['conversations_next_since_id'] = conversations[-1]['id'] if len(conversations) == limit else None
+        elif 'conversations' in include:
+            session['conversations'] = db.get_conversations(session_id, limit=None)
         # 规范化返回结构：确保 products 中字段一致，attributes 为对象
         try:
             prods = session.get('products') or []
@@ -21,8 +21,7 @@ def get_faq_statistics(session_id):
             return jsonify({"error": "无效的会话ID"}), 400
         
         # 验证会话是否存在
-        session = db.get_session(session_id)
-        if not session:
+        if not db.session_exists(session_id):
             return jsonify({"error": "会话不存在"}), 404
         
         logger.info(f"获取FAQ统计 - 会话: {session_id}")
@@ -51,8 +50,7 @@ def get_faq_recommendations(session_id):
             return jsonify({"error": "无效的会话ID"}), 400
         
         # 验证会话是否存在
-        session = db.get_session(session_id)
-        if not session:
+        if not db.session_exists(session_id):
             return jsonify({"error": "会话不存在"}), 404
         
         min_hit_count = request.args.get('min_hit_count', 10, type=int)
@@ -0,0 +1,48 @@
+"""
+语音路由 - 查询后台语音合成任务状态
+"""
+from flask import Blueprint, request, jsonify
+from services.tts_jobs import tts_jobs, STATUS_DONE
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+tts_bp = Blueprint('tts', __name__, url_prefix='/api/tts')
+
+
+@tts_bp.route('/status', methods=['GET'])
+def get_tts_status():
+    """查询语音合成状态，支持 ?job_id= 或 ?file=tts-<id>.wav"""
+    try:
+        job_id = request.args.get('job_id')
+        filename = request.args.get('file')
+
+        if not job_id and not filename:
+            return jsonify({"error": "缺少job_id或file参数"}), 400
+
+        job = tts_jobs.get(job_id) if job_id else tts_jobs.get_by_file(filename)
+
+        if job:
+            return jsonify({
+                "job_id": job['job_id'],
+                "status": job['status'],
+                "ready": job['status'] == STATUS_DONE,
+                "audio_url": job['audio_url'],
+                "error": job['error']
+            })
+
+        # 任务表已清理（或进程重启）时，以磁盘文件为准
+        if filename and tts_jobs.file_exists(filename):
+            return jsonify({"status": STATUS_DONE, "ready": True, "file": filename})
+
+        return jsonify({"error": "语音任务不存在", "ready": False}), 404
+
+    except Exception as e:
+        logger.error(f"查询语音状态异常: {str(e)}", exc_info=True)
+        return jsonify({"error": f"服务器错误: {str(e)}"}), 500
+
+
+@tts_bp.route('/stats', methods=['GET'])
+def get_tts_stats():
+    """语音合成任务队列与音频缓存统计（命中、字节数、淘汰次数）"""
+    return jsonify(tts_jobs.stats())
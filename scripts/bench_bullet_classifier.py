@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+弹幕分类器准确率与吞吐基准测试
+用 data/bullet_corpus.json 中的标注弹幕（含会话商品列表）在当前配置的数据库中创建测试会话，
+统计每个类别的精确率/召回率与混淆情况，并测量 db.classify_bullet_screen（含会话词典缓存查找）
+与只调用分类器两种方式的每秒分类条数。
+
+用法: python scripts/bench_bullet_classifier.py [重复轮数，默认200]
+注意: 测试会话会保留在数据库中。
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+
+# 添加父目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_backend import db
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bullet_corpus.json')
+
+
+def report_accuracy(samples, predict):
+    confusion = Counter()
+    for sample in samples:
+        confusion[(sample['label'], predict(sample['text']))] += 1
+
+    labels = sorted({sample['label'] for sample in samples})
+    correct = sum(count for (label, predicted), count in confusion.items() if label == predicted)
+    print(f'准确率: {correct}/{len(samples)} = {correct / len(samples):.1%}\n')
+    print(f'{"类别":<20}{"精确率":>8}{"召回率":>8}{"样本数":>8}')
+    for label in labels:
+        tp = confusion[(label, label)]
+        predicted = sum(count for (_, p), count in confusion.items() if p == label)
+        actual = sum(count for (l, _), count in confusion.items() if l == label)
+        precision = tp / predicted if predicted else 0.0
+        print(f'{label:<20}{precision:>9.1%}{tp / actual:>9.1%}{actual:>8}')
+
+    errors = [(label, predicted, count) for (label, predicted), count in confusion.items() if label != predicted]
+    if errors:
+        print('\n误分类（标注 -> 预测: 条数）:')
+        for label, predicted, count in sorted(errors):
+            print(f'  {label} -> {predicted}: {count}')
+
+
+def measure(name, texts, rounds, classify):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            classify(text)
+    elapsed = time.perf_counter() - started
+    total = rounds * len(texts)
+    print(f'{name}: {total / elapsed:,.0f} 条/s, 平均 {elapsed / total * 1e6:.1f} µs/条')
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        corpus = json.load(f)
+    samples = corpus['samples']
+    texts = [sample['text'] for sample in samples]
+
+    session_id = str(uuid.uuid4())
+    if not db.create_session(session_id, '基准测试', '弹幕分类', corpus['products']):
+        print('创建测试会话失败')
+        sys.exit(1)
+
+    print(f'样本 {len(samples)} 条, 会话商品 {len(corpus["products"])} 个\n')
+    report_accuracy(samples, lambda text: db.classify_bullet_screen(session_id, text).category)
+
+    print(f'\n吞吐（{rounds} 轮 x {len(texts)} 条）:')
+    lexicon = db._get_bullet_lexicon(session_id)
+    measure('db.classify_bullet_screen', texts, rounds, lambda text: db.classify_bullet_screen(session_id, text))
+    measure('仅分类器            ', texts, rounds, lambda text: db.bullet_classifier.classify(text, lexicon))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+弹幕写入吞吐基准测试
+用 Flask 测试客户端在多个线程中持续提交弹幕，对比逐条接口 /api/bullet-screen 与批量接口
+/api/bullet-screen/batch（group commit）的持续吞吐（条/秒）、请求延迟与 429 次数。
+
+用法: python scripts/bench_bullet_ingest.py [持续秒数，默认5] [并发线程数，默认8] [每批条数，默认50]
+注意: 使用当前配置的数据库，测试会话与弹幕会保留在数据库中。
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+# 添加父目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from db_backend import db
+from services.bullet_ingest import bullet_collapser, bullet_ingest, bullet_limiter
+
+
+def run(name, duration, threads, send):
+    counts = {'messages': 0, 'requests': 0, 'rejected': 0, 'errors': 0}
+    latencies = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker(idx):
+        client = app.test_client()
+        n = 0
+        while not stop.is_set():
+            n += 1
+            started = time.perf_counter()
+            status, messages = send(client, idx, n)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                counts['requests'] += 1
+                if status == 200:
+                    counts['messages'] += messages
+                elif status == 429:
+                    counts['rejected'] += 1
+                else:
+                    counts['errors'] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(f'{name}: {counts["messages"] / elapsed:.0f} 条/秒, 请求 {counts["requests"]} 次, '
+          f'P99 延迟 {p99:.1f} ms, 429 {counts["rejected"]} 次, 错误 {counts["errors"]} 次')
+    return counts['messages'] / elapsed
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    batch = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    logging.disable(logging.WARNING)
+    # 只测写入吞吐：每个线程固定一个用户名，关闭按用户限流与重复合并
+    bullet_limiter.rate = 0
+    bullet_collapser.window = 0
+    session_id = str(uuid.uuid4())
+    if not db.create_session(session_id, '基准测试', '弹幕写入', [{'name': '苹果', 'price': 5}]):
+        print('创建测试会话失败')
+        return
+
+    def send_single(client, idx, n):
+        resp = client.post('/api/bullet-screen', json={
+            'session_id': session_id, 'username': f'user{idx}', 'message': f'苹果多少钱{n}'})
+        return resp.status_code, 1
+
+    def send_batch(client, idx, n):
+        bullets = [{'username': f'user{idx}', 'message': f'苹果多少钱{n}-{i}'} for i in range(batch)]
+        resp = client.post('/api/bullet-screen/batch', json={'session_id': session_id, 'bullets': bullets})
+        return resp.status_code, batch
+
+    print(f'后端: {db.backend}, 持续 {duration}s, 并发 {threads}, 每批 {batch} 条\n')
+    single = run('逐条接口', duration, threads, send_single)
+    batched = run('批量接口', duration, threads, send_batch)
+    print(f'\n吞吐提升: {batched / single:.1f}x')
+    print(f'写入缓冲: {bullet_ingest.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebSocket 推送压测
+在本进程启动 services.bullet_ws 的推送服务，另起一个进程建立 N 个客户端连接（平均分布在若干会话房间），
+连接全部建立后按固定速率向各房间广播带时间戳的弹幕，统计送达率、端到端延迟（p50/p99/最大）、
+服务端与客户端进程的 CPU 占用以及推送服务的合并/扇出/丢弃指标。
+
+--slow 个客户端订阅第一个房间但从不读取数据，用于观察慢客户端的丢帧与驱逐不影响其他客户端
+（需要配合较大的 --payload 才能填满 TCP 缓冲）。
+
+用法: python scripts/bench_bullet_ws.py [--clients 5000] [--rooms 10] [--rate 50] [--duration 10]
+                                        [--payload 32] [--slow 0] [--port 6790]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# 添加父目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONNECT_CONCURRENCY = 100
+
+
+def raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_clients(url, clients, rooms, slow, ready, stop, results):
+    """客户端进程：建立连接并接收消息，结束后通过 results 返回统计。"""
+    import websockets
+
+    raise_fd_limit(clients + slow + 1000)
+
+    async def main():
+        latencies = []
+        received = 0
+        connected = 0
+        failed = 0
+        connections = []
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def reader(ws):
+            nonlocal received
+            try:
+                async for frame in ws:
+                    now = time.time()
+                    data = json.loads(frame)
+                    for message in data.get('messages', ()):
+                        latencies.append(now - message['ts'])
+                        received += 1
+            except websockets.ConnectionClosed:
+                pass
+
+        async def open_one(index, is_slow):
+            nonlocal connected, failed
+            room = 0 if is_slow else index % rooms
+            async with semaphore:
+                for _ in range(3):
+                    try:
+                        ws = await websockets.connect(f'{url}?session_id=room-{room}', compression=None,
+                                                      ping_interval=None, open_timeout=60)
+                        break
+                    except Exception:
+                        await asyncio.sleep(0.5)
+                else:
+                    failed += 1
+                    return
+            connected += 1
+            connections.append(ws)
+            if is_slow:
+                ws.transport.pause_reading()
+            else:
+                asyncio.ensure_future(reader(ws))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(open_one(i, False) for i in range(clients)),
+                             *(open_one(i, True) for i in range(slow)))
+        connect_seconds = time.perf_counter() - started
+        ready.set()
+
+        cpu_started = time.process_time()
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        cpu_seconds = time.process_time() - cpu_started
+        results.put({
+            'connected': connected,
+            'failed': failed,
+            'connect_seconds': connect_seconds,
+            'received': received,
+            'latencies': sorted(latencies),
+            'cpu_seconds': cpu_seconds,
+        })
+        for ws in connections:
+            ws.transport.abort()
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket 推送压测')
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=50, help='每秒广播的弹幕总数（轮流发往各房间）')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--payload', type=int, default=32, help='每条弹幕的文本长度')
+    parser.add_argument('--slow', type=int, default=0, help='只连接不读取的慢客户端数量')
+    parser.add_argument('--port', type=int, default=6790)
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients + args.slow + 1000)
+    from services import bullet_ws
+
+    if not bullet_ws.start_server('127.0.0.1', args.port):
+        print('推送服务启动失败（缺少 websockets 库或端口被占用）')
+        sys.exit(1)
+
+    ctx = multiprocessing.get_context('spawn')
+    ready, stop, results = ctx.Event(), ctx.Event(), ctx.Queue()
+    client_process = ctx.Process(target=run_clients, args=(
+        f'ws://127.0.0.1:{args.port}/', args.clients, args.rooms, args.slow, ready, stop, results))
+    client_process.start()
+    if not ready.wait(600):
+        print('客户端连接超时')
+        client_process.terminate()
+        sys.exit(1)
+    deadline = time.monotonic() + 10
+    while bullet_ws.stats()['connections'] < args.clients + args.slow and time.monotonic() < deadline:
+        time.sleep(0.1)
+    stats = bullet_ws.stats()
+    print(f'连接数: {stats["connections"]}, 房间数: {stats["rooms"]}, 订阅数: {stats["subscriptions"]}')
+
+    # 各房间的（快）客户端数量
+    members = [args.clients // args.rooms + (1 if room < args.clients % args.rooms else 0) for room in range(args.rooms)]
+    published = [0] * args.rooms
+    text = '弹' * args.payload
+    interval = 1.0 / args.rate
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    sent = 0
+    while time.perf_counter() - wall_started < args.duration:
+        room = sent % args.rooms
+        bullet_ws.broadcast({'type': 'bullet', 'session_id': f'room-{room}', 'username': f'user{sent}',
+                             'message': text, 'ts': time.time()})
+        published[room] += 1
+        sent += 1
+        time.sleep(max(0.0, wall_started + sent * interval - time.perf_counter()))
+    time.sleep(2)  # 等待最后一批送达
+    wall_seconds = time.perf_counter() - wall_started
+    server_cpu = time.process_time() - cpu_started
+    stop.set()
+    result = results.get(timeout=120)
+    client_process.join(30)
+
+    stats = bullet_ws.stats()
+    expected = sum(count * size for count, size in zip(published, members))
+    latencies = result['latencies']
+    print(f'客户端: {result["connected"]} 个已连接, {result["failed"]} 个失败, 建立连接耗时 {result["connect_seconds"]:.1f}s')
+    print(f'广播: {sent} 条 / {args.duration:.0f}s, 应送达 {expected:,} 条, 实际 {result["received"]:,} 条 '
+          f'({result["received"] / expected:.2%})' if expected else '广播: 0 条')
+    print(f'延迟: p50 {percentile(latencies, 0.5) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms, '
+          f'最大 {(latencies[-1] if latencies else 0) * 1000:.1f}ms')
+    print(f'CPU: 服务端 {server_cpu:.1f}s ({server_cpu / wall_seconds:.0%}), '
+          f'客户端 {result["cpu_seconds"]:.1f}s, 墙钟 {wall_seconds:.1f}s, CPU 核数 {os.cpu_count()}')
+    print(f'推送服务: 合并帧 {stats["frames_built"]:,}, 扇出 {stats["fanout"]:,}, 已发送 {stats["frames_sent"]:,}, '
+          f'丢弃 {stats["frames_dropped"]:,}, 驱逐 {stats["evicted_stalled"]}, '
+          f'最大队列深度 {stats["max_queue_depth"]}, 合并发送平均 {stats["avg_flush_ms"]}ms / 最大 {stats["max_flush_ms"]}ms')
+
+
+if __name__ == '__main__':
+    main()
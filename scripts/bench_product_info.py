@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+商品补充信息读取基准测试
+在当前配置的数据库中创建一个含 N 个商品（每个商品若干条补充信息）的测试会话，对比逐个商品调用
+get_product_info 与一次调用 get_products_with_info 的连接获取次数、SQL 次数与耗时，并校验批量结果与
+save_product_info 深度合并写入 products.attributes 的结果一致（逐个商品的旧合并方式对嵌套 dict 整体覆盖，会丢键）。
+
+用法: python scripts/bench_product_info.py [商品数量，默认40] [每个商品的补充信息条数，默认5]
+注意: 测试会话会保留在数据库中（会话 ID 以 bench- 开头）。
+"""
+
+import os
+import sys
+import time
+import uuid
+
+# 添加父目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_backend import db
+
+ROUNDS = 50
+
+
+class CallCounter:
+    """统计 db.get_connection 与 db._execute 的调用次数"""
+
+    def __init__(self):
+        self.connections = 0
+        self.queries = 0
+        self._get_connection = db.get_connection
+        self._execute = db._execute
+
+    def __enter__(self):
+        def get_connection():
+            self.connections += 1
+            return self._get_connection()
+
+        def execute(cursor, query, params=None):
+            self.queries += 1
+            return self._execute(cursor, query, params)
+
+        db.get_connection = get_connection
+        db._execute = execute
+        return self
+
+    def __exit__(self, *exc):
+        db.get_connection = self._get_connection
+        db._execute = self._execute
+
+
+def per_product(session_id):
+    products = []
+    for p in db.get_session_meta(session_id)['products']:
+        extra = db.get_product_info(session_id, product_name=p['product_name'], product_id=p['id'])
+        merged = dict(p['attributes'])
+        merged.update({k: v for k, v in extra.items() if v is not None})
+        products.append(merged)
+    return products
+
+
+def batched(session_id):
+    db.get_session_meta(session_id)
+    return [p['attributes'] for p in db.get_products_with_info(session_id)]
+
+
+def run(name, fn, session_id):
+    with CallCounter() as counter:
+        result = fn(session_id)
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(session_id)
+    elapsed = (time.perf_counter() - started) * 1000 / ROUNDS
+    print(f'{name}: 连接 {counter.connections} 次, SQL {counter.queries} 条, 平均 {elapsed:.2f} ms')
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    infos = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    session_id = f'bench-{uuid.uuid4()}'
+    products = [{'name': f'商品{i}', 'price': 10 + i, 'product_type': 'fruit', 'attributes': {'规格': {'重量': '5斤'}}}
+                for i in range(count)]
+    if not db.create_session(session_id, '基准测试', '补充信息', products):
+        print('创建测试会话失败')
+        return
+    for i in range(count):
+        for j in range(infos):
+            db.save_product_info(session_id, product_name=f'商品{i}', info_key=f'key{j}', info_value=f'值{j}')
+        db.save_product_info(session_id, product_name=f'商品{i}', info_key='规格', info_value={'产地': '烟台'})
+
+    print(f'后端: {db.backend}, 商品 {count} 个, 每个商品补充信息 {infos + 1} 条\n')
+    old = run('逐个商品 get_product_info', per_product, session_id)
+    new = run('批量 get_products_with_info', batched, session_id)
+    stored = [p['attributes'] for p in db.get_session_meta(session_id)['products']]
+    print(f'\n批量结果与 products.attributes 一致: {new == stored}')
+    print(f'逐个商品结果与 products.attributes 一致: {old == stored}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+问题相似度索引基准测试
+在单个会话中载入 N 条合成问题，统计近似查询的平均/P99 耗时，并打印几组示例的相似度。
+
+用法: python scripts/bench_question_index.py [问题数量，默认10000]
+"""
+
+import os
+import random
+import sys
+import time
+
+# 添加父目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.helpers import normalize_question
+from utils.question_index import QuestionIndex
+
+FRUITS = ['苹果', '香蕉', '橙子', '梨', '葡萄', '芒果', '西瓜', '草莓', '榴莲', '猕猴桃', '樱桃', '荔枝', '桃子', '柚子', '菠萝']
+TEMPLATES = ['{}多少钱一斤', '{}甜不甜', '{}产地是哪里', '{}能放几天', '{}怎么保存', '{}有没有优惠', '{}是今年的新货吗',
+             '{}包邮吗', '{}一箱几个', '{}坏果包赔吗', '{}什么时候发货', '{}个头大吗', '{}新鲜吗', '{}酸不酸', '{}是什么品种']
+PREFIXES = ['', '请问', '主播', '这个', '你家', '咱们']
+SUFFIXES = ['', '呀', '呢', '？', '谢谢', '急', '在线等', '亲', '宝宝们', '有人吗']
+
+EXAMPLES = [
+    ('这个苹果多少钱一斤', '苹果一斤多少钱'),
+    ('苹果产地是哪里', '请问一下苹果的产地是哪里'),
+    ('苹果产地是哪里', '梨产地是哪里'),
+    ('苹果一箱多少斤', '苹果一箱多少钱'),
+]
+
+
+def build_questions(count, seed=1):
+    rng = random.Random(seed)
+    questions = set()
+    while len(questions) < count:
+        questions.add(rng.choice(PREFIXES) + rng.choice(TEMPLATES).format(rng.choice(FRUITS))
+                      + rng.choice(SUFFIXES) + str(rng.randint(0, 99)))
+    return list(questions)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    questions = build_questions(count)
+
+    index = QuestionIndex()
+    started = time.perf_counter()
+    index.load('bench', ((normalize_question(q), q, q) for q in questions), subject_terms=FRUITS)
+    print(f'载入 {count} 条问题耗时: {(time.perf_counter() - started) * 1000:.1f} ms')
+
+    rng = random.Random(2)
+    queries = [rng.choice(PREFIXES) + rng.choice(TEMPLATES).format(rng.choice(FRUITS)) for _ in range(5000)]
+    timings = []
+    for q in queries:
+        started = time.perf_counter()
+        index.search('bench', normalize_question(q))
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f'查询 {len(queries)} 次: 平均 {sum(timings) / len(timings):.3f} ms, '
+          f'P50 {timings[len(timings) // 2]:.3f} ms, P99 {timings[int(len(timings) * 0.99)]:.3f} ms')
+
+    print('\n示例相似度（阈值见 QA_SIMILARITY_THRESHOLD）:')
+    for cached, asked in EXAMPLES:
+        pair = QuestionIndex()
+        pair.load('pair', [(normalize_question(cached), cached, cached)], subject_terms=FRUITS)
+        score, _ = pair.search('pair', normalize_question(asked))
+        print(f'  {cached} <- {asked}: {score:.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite 后端吞吐基准测试
+分别在「旧行为」（每次操作新建连接、回滚日志、每次执行都转换 SQL）与「调优」（WAL、每线程复用连接、
+SQL 转换缓存）下，用若干写线程（add_bullet_screen）与读线程（get_pending_bullet_screens、get_session_meta）
+并发运行固定时长，统计每秒完成的操作数与 database is locked 失败次数。
+
+每种模式使用临时目录中的独立数据库文件，不影响 data/local_db.sqlite3。
+用法: python scripts/bench_sqlite.py [持续秒数，默认5] [写线程数，默认4] [读线程数，默认4]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# 添加父目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_backend import db
+
+
+def legacy_normalize_query(query):
+    """调优前的 SQL 转换：每次执行都做字符串替换"""
+    for source, target in {"NOW()": "CURRENT_TIMESTAMP", "BOOLEAN": "INTEGER"}.items():
+        query = query.replace(source, target)
+    return query.replace("%s", "?")
+
+
+def run_mode(name, tuned, path, duration, writers, readers):
+    db.backend = "sqlite"
+    db.sqlite_tuned = tuned
+    db.sqlite_path = path
+    if tuned:
+        db.__dict__.pop("_normalize_query", None)
+    else:
+        db._normalize_query = legacy_normalize_query
+    db.migrate()
+
+    session_id = str(uuid.uuid4())
+    db.create_session(session_id, '基准测试', '吞吐', [{'name': '苹果', 'price': 5, 'product_type': 'fruit'}])
+
+    counts = {'write': 0, 'read': 0, 'failed': 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def count(kind, ok):
+        with lock:
+            counts[kind if ok else 'failed'] += 1
+
+    def writer(idx):
+        n = 0
+        while not stop.is_set():
+            n += 1
+            count('write', db.add_bullet_screen(session_id, f'user{idx}', f'苹果多少钱{n}', 'question', 1))
+
+    def reader():
+        while not stop.is_set():
+            count('read', isinstance(db.get_pending_bullet_screens(session_id, 10), list))
+            count('read', db.get_session_meta(session_id) is not None)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    total = counts['write'] + counts['read']
+    print(f'{name}: 写 {counts["write"] / elapsed:.0f}/s, 读 {counts["read"] / elapsed:.0f}/s, '
+          f'合计 {total / elapsed:.0f} ops/s, 失败 {counts["failed"]}')
+    return total / elapsed
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    # 失败的写入会记录错误日志，这里只看统计结果
+    logging.disable(logging.ERROR)
+    print(f'持续 {duration}s, 写线程 {writers}, 读线程 {readers}\n')
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = run_mode('旧行为', False, os.path.join(tmp, 'legacy.sqlite3'), duration, writers, readers)
+        tuned = run_mode('调优  ', True, os.path.join(tmp, 'tuned.sqlite3'), duration, writers, readers)
+    print(f'\n吞吐提升: {tuned / legacy:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 """
 AI服务模块 - 处理与DeepSeek API的交互
 """
+import json
 import requests
 from config import Config
 from utils.logger import get_logger
@@ -27,24 +28,7 @@ class AIService:
             AI回复内容，失败返回None
         """
         try:
-            # 构建系统提示词
-            system_prompt = self._build_system_prompt(session_context)
-            
-            # 构建请求
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.api_key}'
-            }
-            
-            payload = {
-                'model': self.model,
-                'messages': [
-                    {'role': 'system', 'content': system_prompt},
-                    {'role': 'user', 'content': prompt}
-                ],
-                'temperature': 0.7,
-                'max_tokens': 500
-            }
+            headers, payload = self._build_request(prompt, session_context)
             
             logger.info(f"调用AI API - 模型: {self.model}")
             
@@ -78,6 +62,82 @@ class AIService:
             logger.error(f"AI API调用异常: {str(e)}", exc_info=True)
             return None
     
+    def stream_api(self, prompt, session_context=None):
+        """
+        以流式方式调用DeepSeek API（stream: true），逐段产出回复文本
+        
+        Args:
+            prompt: 用户问题
+            session_context: 会话上下文（主播、主题、商品等）
+            
+        Yields:
+            增量文本片段；请求失败或流中断时记录日志并抛出异常，由调用方决定如何告知前端
+        """
+        headers, payload = self._build_request(prompt, session_context, stream=True)
+
+        logger.info(f"调用AI API（流式） - 模型: {self.model}")
+
+        try:
+            with requests.post(
+                self.api_url,
+                headers=headers,
+                json=payload,
+                timeout=(10, 30),
+                stream=True
+            ) as response:
+                response.raise_for_status()
+                # 按字节读取并手动以 UTF-8 解码，避免 text/event-stream 缺省编码导致中文乱码
+                for raw_line in response.iter_lines():
+                    if not raw_line:
+                        continue
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    chunk = line[len('data:'):].strip()
+                    if chunk == '[DONE]':
+                        break
+                    event = json.loads(chunk)
+                    choices = event.get('choices') or []
+                    if not choices:
+                        continue
+                    delta = (choices[0].get('delta') or {}).get('content')
+                    if delta:
+                        yield delta
+            logger.info(f"✅ AI API流式调用完成")
+        except requests.exceptions.Timeout:
+            logger.error("AI API流式调用超时")
+            raise
+        except requests.exceptions.RequestException as e:
+            logger.error(f"AI API流式请求失败: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"AI API流式调用异常: {str(e)}", exc_info=True)
+            raise
+
+    def _build_request(self, prompt, session_context=None, stream=False):
+        """构建请求头与请求体"""
+        # 构建系统提示词
+        system_prompt = self._build_system_prompt(session_context)
+        
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.api_key}'
+        }
+        
+        payload = {
+            'model': self.model,
+            'messages': [
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': prompt}
+            ],
+            'temperature': 0.7,
+            'max_tokens': 500
+        }
+        if stream:
+            payload['stream'] = True
+
+        return headers, payload
+
     def _build_system_prompt(self, session_context):
         """构建系统提示词"""
         if not session_context:
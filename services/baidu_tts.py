@@ -1,49 +1,42 @@
 """
 Baidu TTS helper
 
-Provides a simple function to obtain an access token and synthesize short text
-using Baidu's text2audio endpoint. Saves the audio to a file and returns the
-path. Reads credentials from environment variables (see project `.env`).
+Provides a reusable `BaiduTTSClient` plus module-level convenience functions to
+obtain an access token and synthesize short text using Baidu's text2audio
+endpoint. Saves the audio to a file and returns the path. Reads credentials
+from environment variables (see project `.env`).
+
+The client caches the OAuth access token until shortly before ``expires_in``,
+refreshes it in the background, and reuses a keep-alive `requests.Session` so
+each utterance costs a single HTTPS request on a warm connection.
 
 Note: Baidu's TTS `aue` mapping may vary by account/region. This helper uses
 reasonable defaults and returns raw bytes when successful.
 """
 import os
+import threading
+import time
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+
+from utils.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
 BAIDU_OAUTH_URL = 'https://aip.baidubce.com/oauth/2.0/token'
 BAIDU_TTS_URL = 'https://tsn.baidu.com/text2audio'
 
+# err_no values meaning the access token is invalid/expired and should be refreshed:
+# 502 (text2audio token check failed), 110/111 (generic AIP token invalid/expired).
+TOKEN_ERROR_CODES = {502, 110, 111}
 
-def _get_env(key, default=None):
-    return os.environ.get(key, default)
+# How long callers wait for a token fetch already in flight (the OAuth request itself times out after 10s).
+TOKEN_WAIT_TIMEOUT = 15
 
 
-def get_access_token(api_key=None, secret_key=None):
-    """Get Baidu access token from API Key and Secret Key.
-
-    Returns access_token string on success or raises RuntimeError on failure.
-    """
-    api_key = api_key or _get_env('BAIDU_TTS_API_KEY')
-    secret_key = secret_key or _get_env('BAIDU_TTS_SECRET_KEY')
-    if not api_key or not secret_key:
-        raise RuntimeError('BAIDU_TTS_API_KEY or BAIDU_TTS_SECRET_KEY not set')
-
-    params = {
-        'grant_type': 'client_credentials',
-        'client_id': api_key,
-        'client_secret': secret_key,
-    }
-    r = requests.post(BAIDU_OAUTH_URL, params=params, timeout=10)
-    r.raise_for_status()
-    j = r.json()
-    token = j.get('access_token')
-    if not token:
-        raise RuntimeError(f'Failed to obtain Baidu access token: {j}')
-    return token
+def _get_env(key, default=None):
+    return os.environ.get(key, default)
 
 
 def _format_to_aue(format_name: str):
@@ -53,53 +46,166 @@ def _format_to_aue(format_name: str):
     return 3
 
 
-def synthesize(text: str,
-               out_path: str = None,
-               voice: int = None,
-               fmt: str = None,
-               sample_rate: int = None,
-               token: str = None,
-               rate: float = None):
-    """Synthesize `text` to audio using Baidu TTS.
+def resolve_params(voice: int = None,
+                   fmt: str = None,
+                   sample_rate: int = None,
+                   rate: float = None):
+    """Fill unset synthesis parameters from the environment.
 
-    If `out_path` is provided the audio will be saved there and the path is
-    returned. Otherwise the function returns the audio bytes.
+    Returns a dict with ``voice``, ``fmt``, ``sample_rate`` and ``rate``; used by
+    `synthesize` and by callers that need the effective parameters (e.g. to
+    build an audio cache key).
     """
-    if not text:
-        raise ValueError('text must be provided')
-
-    token = token or get_access_token()
-
-    voice = voice or int(_get_env('BAIDU_TTS_VOICE', 0))
-    fmt = fmt or _get_env('BAIDU_TTS_FORMAT', 'wav')
-    sample_rate = sample_rate or int(_get_env('BAIDU_TTS_SAMPLE_RATE', 24000))
-    rate = rate or float(_get_env('BAIDU_TTS_RATE', 1.0))
-
-    aue = _format_to_aue(fmt)
-
-    params = {
-        'tex': text,
-        'tok': token,
-        'cuid': _get_env('BAIDU_TTS_CUID', 'pj-local'),
-        'ctp': 1,
-        'lan': 'zh',
-        'per': voice,
-        'aue': aue,
-        'spd': int(max(0, min(9, round(rate * 5)))),
+    return {
+        'voice': voice or int(_get_env('BAIDU_TTS_VOICE', 0)),
+        'fmt': fmt or _get_env('BAIDU_TTS_FORMAT', 'wav'),
+        'sample_rate': sample_rate or int(_get_env('BAIDU_TTS_SAMPLE_RATE', 24000)),
+        'rate': rate or float(_get_env('BAIDU_TTS_RATE', 1.0)),
     }
 
-    try:
-        params['tex'] = text
-        r = requests.get(BAIDU_TTS_URL, params=params, timeout=30)
-        content_type = r.headers.get('Content-Type', '')
-        if 'application/json' in content_type or r.status_code != 200:
+
+class BaiduTTSError(RuntimeError):
+    """Error response from text2audio; ``err_no`` is set when Baidu returned JSON."""
+
+    def __init__(self, message, err_no=None):
+        super().__init__(message)
+        self.err_no = err_no
+
+
+class BaiduTTSClient:
+    """Baidu TTS client with a cached access token and a pooled HTTP session.
+
+    - The token is reused until ``refresh_margin`` seconds before it expires and
+      a daemon timer refreshes it proactively, so requests never wait on OAuth
+      in steady state. When a fetch is needed, concurrent callers share a single
+      OAuth request; the lock only guards reading and storing the cached token.
+    - A single keep-alive `requests.Session` is shared by all callers; its
+      connection pool is sized for the TTS worker pool.
+    - Responses carrying a token error code invalidate the token and are
+      retried with bounded exponential backoff.
+    """
+
+    def __init__(self,
+                 api_key: str = None,
+                 secret_key: str = None,
+                 pool_size: int = None,
+                 refresh_margin: int = 300,
+                 max_retries: int = 2,
+                 backoff: float = 0.2,
+                 max_backoff: float = 2.0):
+        self.api_key = api_key or _get_env('BAIDU_TTS_API_KEY')
+        self.secret_key = secret_key or _get_env('BAIDU_TTS_SECRET_KEY')
+        self.refresh_margin = refresh_margin
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        pool_size = pool_size or int(_get_env('BAIDU_TTS_POOL_SIZE', 8))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh_timer = None
+        self._token_flight = SingleFlight()
+
+    def get_access_token(self, force: bool = False):
+        """Return a valid access token, fetching a new one only when needed."""
+        if not force:
+            with self._lock:
+                if self._token and time.time() < self._expires_at - self.refresh_margin:
+                    return self._token
+        token, _ = self._token_flight.do('token', self._fetch_token, timeout=TOKEN_WAIT_TIMEOUT)
+        return token
+
+    def _fetch_token(self):
+        if not self.api_key or not self.secret_key:
+            raise RuntimeError('BAIDU_TTS_API_KEY or BAIDU_TTS_SECRET_KEY not set')
+
+        params = {
+            'grant_type': 'client_credentials',
+            'client_id': self.api_key,
+            'client_secret': self.secret_key,
+        }
+        r = self.session.post(BAIDU_OAUTH_URL, params=params, timeout=10)
+        r.raise_for_status()
+        j = r.json()
+        token = j.get('access_token')
+        if not token:
+            raise RuntimeError(f'Failed to obtain Baidu access token: {j}')
+
+        expires_in = int(j.get('expires_in') or 0) or 30 * 24 * 3600
+        with self._lock:
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            self._schedule_refresh_locked(expires_in)
+        logger.info(f'Baidu access token refreshed, expires in {expires_in}s')
+        return token
+
+    def _schedule_refresh_locked(self, expires_in):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        delay = max(1, expires_in - self.refresh_margin)
+        self._refresh_timer = threading.Timer(delay, self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.get_access_token(force=True)
+        except Exception as e:
+            # 下一次请求会在前台重试获取
+            logger.warning(f'Background Baidu token refresh failed: {e}')
+
+    def invalidate_token(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def synthesize(self,
+                   text: str,
+                   out_path: str = None,
+                   voice: int = None,
+                   fmt: str = None,
+                   sample_rate: int = None,
+                   token: str = None,
+                   rate: float = None):
+        """Synthesize `text`; see module-level `synthesize` for the contract.
+
+        When ``token`` is given it is used as-is and token errors are not retried.
+        """
+        if not text:
+            raise ValueError('text must be provided')
+
+        resolved = resolve_params(voice, fmt, sample_rate, rate)
+        params = {
+            'tex': text,
+            'cuid': _get_env('BAIDU_TTS_CUID', 'pj-local'),
+            'ctp': 1,
+            'lan': 'zh',
+            'per': resolved['voice'],
+            'aue': _format_to_aue(resolved['fmt']),
+            'spd': int(max(0, min(9, round(resolved['rate'] * 5)))),
+        }
+
+        attempt = 0
+        while True:
+            params['tok'] = token or self.get_access_token()
             try:
-                j = r.json()
-            except Exception:
-                j = {'status_code': r.status_code, 'text': r.text}
-            raise RuntimeError(f'Baidu TTS error: {j}')
+                audio = self._request_audio(params)
+                break
+            except BaiduTTSError as e:
+                if token or e.err_no not in TOKEN_ERROR_CODES or attempt >= self.max_retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+                logger.info(f'Baidu TTS token rejected (err_no={e.err_no}), refreshing and retrying in {delay:.2f}s')
+                self.invalidate_token()
+                time.sleep(delay)
+                attempt += 1
 
-        audio = r.content
         if out_path:
             out_dir = os.path.dirname(out_path)
             if out_dir and not os.path.exists(out_dir):
@@ -109,5 +215,78 @@ def synthesize(text: str,
             logger.info(f'Baidu TTS saved to {out_path}')
             return out_path
         return audio
-    except requests.RequestException as e:
-        raise RuntimeError(f'Network error when calling Baidu TTS: {e}')
+
+    def _request_audio(self, params):
+        try:
+            r = self.session.get(BAIDU_TTS_URL, params=params, timeout=30)
+        except requests.RequestException as e:
+            raise RuntimeError(f'Network error when calling Baidu TTS: {e}')
+
+        content_type = r.headers.get('Content-Type', '')
+        if 'application/json' in content_type or r.status_code != 200:
+            try:
+                j = r.json()
+            except Exception:
+                j = {'status_code': r.status_code, 'text': r.text}
+            err_no = j.get('err_no') if isinstance(j, dict) else None
+            raise BaiduTTSError(f'Baidu TTS error: {j}', err_no=err_no)
+        return r.content
+
+    def close(self):
+        with self._lock:
+            if self._refresh_timer:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+        self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide client built from environment variables."""
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = BaiduTTSClient()
+    return _default_client
+
+
+def get_access_token(api_key=None, secret_key=None):
+    """Get Baidu access token from API Key and Secret Key.
+
+    Without explicit keys the cached token of the shared client is returned.
+    Returns access_token string on success or raises RuntimeError on failure.
+    """
+    if api_key or secret_key:
+        client = BaiduTTSClient(api_key, secret_key)
+        try:
+            return client.get_access_token()
+        finally:
+            client.close()
+    return get_client().get_access_token()
+
+
+def synthesize(text: str,
+               out_path: str = None,
+               voice: int = None,
+               fmt: str = None,
+               sample_rate: int = None,
+               token: str = None,
+               rate: float = None):
+    """Synthesize `text` to audio using Baidu TTS.
+
+    If `out_path` is provided the audio will be saved there and the path is
+    returned. Otherwise the function returns the audio bytes.
+    """
+    return get_client().synthesize(
+        text,
+        out_path=out_path,
+        voice=voice,
+        fmt=fmt,
+        sample_rate=sample_rate,
+        token=token,
+        rate=rate,
+    )
@@ -0,0 +1,249 @@
+"""
+弹幕批量写入缓冲（group commit）
+
+/api/bullet-screen/batch 把通过黑名单检查的弹幕放入有界内存缓冲，由一个写线程每隔
+``flush_interval`` 毫秒或攒够 ``flush_rows`` 条时用一次 executemany + 一次提交写入数据库，
+请求线程等待自己的弹幕落库后返回。缓冲已满时 ``submit`` 返回 None，由路由返回 429。
+
+批量写入失败（例如某条弹幕的会话已被删除）时退回逐条写入，只让有问题的弹幕失败。
+
+刷屏合并的重复次数：新弹幕通过合并检查时先 ``reserve`` 其 dedupe_key，此后到达的重复由 ``add_repeat``
+记在这条尚未落库的弹幕上，随 INSERT 一起写入 repeat_count；写入进行中到达的重复在提交成功后才交给
+``record_repeats`` 批量写回（此时行已存在），写入失败或 ``release`` 撤销时一并丢弃。``insert`` 在请求线程中写入，
+请求级工作单元里 INSERT 只释放到保存点，因此先用 ``commit`` 提交再移除登记，``record_repeats`` 在其他连接上才能看到这一行。
+
+写入前的刷屏控制（``bullet_limiter`` 按会话 + 用户限流、``bullet_collapser`` 合并重复弹幕）也在这里
+创建，空闲 key 由后台任务定期清理。
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from config import Config
+from db_backend import db
+from utils.flood_control import DuplicateCollapser, TokenBucketLimiter
+from utils.periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+class IngestTicket:
+    """一次 submit 的写入结果：``wait()`` 返回每条弹幕是否已落库（按提交顺序）。"""
+
+    def __init__(self, count):
+        self.results = [None] * count
+        self._remaining = count
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if count == 0:
+            self._done.set()
+
+    def _set(self, index, ok):
+        with self._lock:
+            self.results[index] = ok
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._done.set()
+
+    def wait(self, timeout=None):
+        """等待全部落库；超时返回 None。"""
+        if not self._done.wait(timeout):
+            return None
+        return list(self.results)
+
+
+# 登记后超过该秒数仍未写入也未撤销的 dedupe_key（请求异常中断）由 sweep 清理
+RESERVATION_TTL = 60
+
+
+class BulletIngestBuffer:
+    def __init__(self, write_batch, write_one, capacity=10000, flush_interval_ms=20, flush_rows=500,
+                 record_repeats=None, commit=None):
+        self.write_batch = write_batch
+        self.write_one = write_one
+        self.record_repeats = record_repeats
+        self.commit = commit
+        self.capacity = max(1, int(capacity))
+        self.flush_interval = max(1, int(flush_interval_ms)) / 1000.0
+        self.flush_rows = max(1, int(flush_rows))
+        self._buffer = deque()  # (ticket, 下标, 行, 登记项)
+        self._reserved = {}  # (session_id, dedupe_key) -> [重复次数, 登记时间]，行写入完成前有效
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.accepted = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batch_failures = 0
+
+    def reserve(self, session_id, dedupe_key):
+        """登记一条即将写入的新弹幕的 dedupe_key，写入前到达的重复计入它的 repeat_count。"""
+        if dedupe_key:
+            with self._lock:
+                self._reserved[(session_id, dedupe_key)] = [0, time.monotonic()]
+
+    def add_repeat(self, session_id, dedupe_key):
+        """对应弹幕尚未写入完成时把重复计在它上面并返回 True；否则返回 False（由调用方写回已落库的行）。"""
+        with self._lock:
+            entry = self._reserved.get((session_id, dedupe_key))
+            if entry is None:
+                return False
+            entry[0] += 1
+            return True
+
+    def release(self, session_id, dedupe_key):
+        """撤销登记（弹幕最终不写入），已计入的重复一并丢弃。"""
+        with self._lock:
+            self._reserved.pop((session_id, dedupe_key), None)
+
+    def sweep(self):
+        """清理登记后超时仍未写入也未撤销的 dedupe_key，返回清理数量。"""
+        cutoff = time.monotonic() - RESERVATION_TTL
+        with self._lock:
+            stale = [key for key, (_, reserved_at) in self._reserved.items() if reserved_at < cutoff]
+            for key in stale:
+                del self._reserved[key]
+        return len(stale)
+
+    def _reservation_locked(self, row):
+        return self._reserved.get((row[0], row[5])) if row[5] else None
+
+    @staticmethod
+    def _with_repeats(row, entry):
+        """返回 (带 repeat_count 的行, 已计入的重复次数)"""
+        repeats = entry[0] if entry is not None else 0
+        return (*row[:6], 1 + repeats), repeats
+
+    def _finish(self, row, entry, written_repeats, ok):
+        """行写入结束：移除登记；写入进行中到达的重复在写入成功时交给 record_repeats，失败时丢弃。"""
+        if entry is None:
+            return
+        key = (row[0], row[5])
+        with self._lock:
+            if self._reserved.get(key) is entry:
+                del self._reserved[key]
+            late = entry[0] - written_repeats
+        if ok and late and self.record_repeats:
+            self.record_repeats(row[0], row[5], late)
+
+    def insert(self, row):
+        """同步写入单条弹幕（不经缓冲），与缓冲中的行一样带上已计入的重复次数；返回 write_one 的结果，
+        提交失败时返回 None。"""
+        with self._lock:
+            entry = self._reservation_locked(row)
+            full_row, repeats = self._with_repeats(row, entry)
+        result = self.write_one(*full_row)
+        if result and self.commit and not self.commit():
+            result = None
+        self._finish(row, entry, repeats, bool(result))
+        return result
+
+    def submit(self, rows):
+        """放入一组 (session_id, username, message, category, priority, dedupe_key)，返回 IngestTicket；
+        缓冲剩余空间不足以放下整组时返回 None（整组拒绝，不部分写入）。"""
+        self._ensure_started()
+        ticket = IngestTicket(len(rows))
+        with self._lock:
+            if len(self._buffer) + len(rows) > self.capacity:
+                self.rejected += len(rows)
+                return None
+            for index, row in enumerate(rows):
+                self._buffer.append((ticket, index, row, self._reservation_locked(row)))
+            self.accepted += len(rows)
+            full = len(self._buffer) >= self.flush_rows
+        if full:
+            self._wake.set()
+        return ticket
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='bullet-ingest', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                while self.flush() >= self.flush_rows:
+                    # 积压较多时连续写入，不等待下一个周期
+                    pass
+            except Exception as err:
+                logger.error(f"弹幕批量写入线程异常: {err}", exc_info=True)
+
+    def flush(self):
+        """写入缓冲中最多 flush_rows 条弹幕，返回本次处理的条数。"""
+        with self._lock:
+            count = min(len(self._buffer), self.flush_rows)
+            batch = [self._buffer.popleft() for _ in range(count)]
+            # 取出时的重复次数随 INSERT 写入，此后到达的在写入完成后另行写回
+            prepared = [self._with_repeats(row, entry) for _, _, row, entry in batch]
+        if not batch:
+            return 0
+
+        full_rows = [full_row for full_row, _ in prepared]
+        if self.write_batch(full_rows):
+            results = [True] * len(batch)
+        else:
+            self.batch_failures += 1
+            logger.warning(f"弹幕批量写入失败，逐条重试 {len(batch)} 条")
+            results = [bool(self.write_one(*full_row)) for full_row in full_rows]
+
+        self.flushes += 1
+        for (ticket, index, row, entry), (_, repeats), ok in zip(batch, prepared, results):
+            self._finish(row, entry, repeats, ok)
+            ticket._set(index, ok)
+            if ok:
+                self.rows_written += 1
+            else:
+                self.rows_failed += 1
+        return len(batch)
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._buffer)
+            reserved = len(self._reserved)
+        return {
+            'buffered': buffered,
+            'reserved_keys': reserved,
+            'capacity': self.capacity,
+            'flush_interval_ms': int(self.flush_interval * 1000),
+            'flush_rows': self.flush_rows,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'rows_failed': self.rows_failed,
+            'batch_failures': self.batch_failures,
+            'avg_batch_rows': round((self.rows_written + self.rows_failed) / self.flushes, 1) if self.flushes else 0.0,
+        }
+
+
+# 单例
+bullet_ingest = BulletIngestBuffer(
+    db.add_bullet_screens,
+    db.add_bullet_screen,
+    capacity=Config.BULLET_BUFFER_SIZE,
+    flush_interval_ms=Config.BULLET_FLUSH_MS,
+    flush_rows=Config.BULLET_FLUSH_ROWS,
+    record_repeats=db.record_bullet_repeat,
+    commit=db.checkpoint,
+)
+
+# 刷屏控制
+bullet_limiter = TokenBucketLimiter(
+    rate=Config.BULLET_USER_RATE, burst=Config.BULLET_USER_BURST, max_keys=Config.BULLET_FLOOD_MAX_KEYS
+)
+bullet_collapser = DuplicateCollapser(window=Config.BULLET_COLLAPSE_WINDOW, max_keys=Config.BULLET_FLOOD_MAX_KEYS)
+flood_sweeper = PeriodicTask(
+    lambda: (bullet_limiter.sweep(), bullet_collapser.sweep(), bullet_ingest.sweep()), interval=30,
+    name='bullet-flood-sweeper'
+)
+flood_sweeper.start()
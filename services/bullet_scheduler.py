@@ -0,0 +1,249 @@
+"""
+弹幕回答调度（按用户加权公平排队）
+
+弹幕多于模型能回答的数量时，由调度器决定下一批回答哪些弹幕，而不是严格按优先级/时间先后：
+
+- 公平：候选窗口中每个用户最多 ``per_user`` 条；按用户做加权公平排队（start-time fair queueing），
+  用户每被回答一条，其虚拟完成时间增加 1/权重，权重随弹幕优先级与重复次数（repeat_count）增大，
+  刷屏用户无法挤占其他用户的回答机会；
+- 话题合并：同一话题（会话商品名 + 属性词，见 ``BulletClassifier.topic``）本轮只回答一条，
+  ``topic_window`` 秒内已回答过的话题直接合并，合并条数作为热度随结果返回。被合并的弹幕随代表弹幕
+  确认（ack）而完成，代表弹幕被退回或租约过期时重新参与调度（见 ``db.merge_bullet_screens``）；
+- 过期：等待超过 ``max_age`` 秒的弹幕标记为已处理（last_error 为 expired），不再迟到数分钟后回答；
+- 预算：全局每分钟最多回答 ``answers_per_minute`` 条（模型调用能力），超出时返回空批次与 retry_after。
+
+选中的弹幕以租约方式认领给 worker，处理完成后照常调用 ack/nack。调度状态保存在进程内存中。
+"""
+import bisect
+import math
+import threading
+import time
+from collections import deque
+
+from config import Config
+from db_backend import db
+from utils.ttl_cache import TTLCache
+
+# 等待时长直方图的桶上界（秒），最后一个桶为 +Inf
+WAIT_BUCKETS_S = (1, 5, 10, 30, 60, 120, 300)
+BUDGET_WINDOW = 60.0
+
+
+class _SessionState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.virtual_time = 0.0
+        self.finish = {}   # 用户 -> 虚拟完成时间
+        self.topics = {}   # 话题 -> (最近一次回答的时间, 代表弹幕 id)
+
+
+class FairScheduler:
+    def __init__(self, answers_per_minute=30, max_age=120, topic_window=60, per_user=3, window=500):
+        self.answers_per_minute = max(0, int(answers_per_minute))
+        self.max_age = max(0, int(max_age))
+        self.topic_window = max(0, int(topic_window))
+        self.per_user = max(1, int(per_user))
+        self.window = max(1, int(window))
+        self._sessions = TTLCache(max_size=1000, ttl=3600)
+        self._sessions_lock = threading.Lock()
+        self._budget_lock = threading.Lock()
+        self._dispatched_at = deque()  # 最近一分钟每次回答的时间
+        self._stats_lock = threading.Lock()
+        self.rounds = 0
+        self.dispatched = 0
+        self.merged = 0
+        self.expired = 0
+        self.budget_limited = 0
+        self._wait_counts = [0] * (len(WAIT_BUCKETS_S) + 1)
+        self._wait_total = 0.0
+        self.max_wait = 0
+
+    @staticmethod
+    def weight(bullet):
+        """优先级不高于 0 的权重为 1，优先级每高 50 权重加 1（商品属性提问 80 分的权重为 2.6）；
+        被刷屏合并过的弹幕按重复次数再乘 1 + log2(repeat_count)，问的人越多越先回答"""
+        base = 1.0 + max(0, bullet.get('priority') or 0) / 50.0
+        return base * (1.0 + math.log2(max(1, bullet.get('repeat_count') or 1)))
+
+    def _state(self, session_id):
+        with self._sessions_lock:
+            state = self._sessions.get(session_id)
+            if state is None:
+                state = _SessionState()
+                self._sessions.set(session_id, state)
+            return state
+
+    def _reserve_budget(self, wanted):
+        """预占预算，返回 (本次最多可回答条数, 预算用尽时的 retry_after 秒数)；未用完的部分由
+        ``_release_budget`` 退回，多个会话并发调度也不会超出预算。"""
+        if not self.answers_per_minute:
+            return wanted, None
+        now = time.monotonic()
+        with self._budget_lock:
+            while self._dispatched_at and self._dispatched_at[0] <= now - BUDGET_WINDOW:
+                self._dispatched_at.popleft()
+            available = self.answers_per_minute - len(self._dispatched_at)
+            if available <= 0:
+                return 0, max(0.0, self._dispatched_at[0] + BUDGET_WINDOW - now)
+            allowed = min(wanted, available)
+            self._dispatched_at.extend([now] * allowed)
+            return allowed, None
+
+    def _release_budget(self, count):
+        if not self.answers_per_minute or count <= 0:
+            return
+        with self._budget_lock:
+            for _ in range(min(count, len(self._dispatched_at))):
+                self._dispatched_at.pop()
+
+    def _select(self, state, candidates, topics, limit, now):
+        """加权公平排队选出最多 limit 条，返回 (选中列表, {选中弹幕 id: [被合并的弹幕 id]},
+        {已回答话题的代表弹幕 id: [被合并的弹幕 id]})"""
+        # 代表弹幕重新成为候选（已退回或租约过期）时，该话题不再视为已回答
+        candidate_ids = {bullet['id'] for bullet in candidates}
+        recent = {t: primary for t, (at, primary) in state.topics.items()
+                  if now - at < self.topic_window and primary not in candidate_ids}
+        queues = {}
+        already_answered = {}
+        for bullet in candidates:
+            primary = recent.get(topics[bullet['id']])
+            if primary is not None:
+                already_answered.setdefault(primary, []).append(bullet['id'])
+            else:
+                queues.setdefault(bullet['username'], deque()).append(bullet)
+
+        selected, merged_into, chosen_topics = [], {}, {}
+        while queues and len(selected) < limit:
+            best_user, best_tags = None, None
+            for user, queue in queues.items():
+                head = queue[0]
+                start = max(state.virtual_time, state.finish.get(user, 0.0))
+                tags = (start + 1.0 / self.weight(head), -(head.get('age_seconds') or 0), head['id'])
+                if best_tags is None or tags < best_tags:
+                    best_user, best_tags = user, tags
+            queue = queues[best_user]
+            head = queue.popleft()
+            if not queue:
+                del queues[best_user]
+
+            topic = topics[head['id']]
+            if topic in chosen_topics:
+                merged_into[chosen_topics[topic]].append(head['id'])
+                continue
+            state.virtual_time = max(state.virtual_time, state.finish.get(best_user, 0.0))
+            state.finish[best_user] = best_tags[0]
+            chosen_topics[topic] = head['id']
+            merged_into[head['id']] = []
+            selected.append(head)
+
+        # 未轮到的候选中与本轮选中话题相同的，一并合并
+        for queue in queues.values():
+            for bullet in queue:
+                primary = chosen_topics.get(topics[bullet['id']])
+                if primary is not None:
+                    merged_into[primary].append(bullet['id'])
+        # 虚拟完成时间不晚于当前虚拟时间的用户与新用户等价，清理以限制内存
+        state.finish = {u: f for u, f in state.finish.items() if f > state.virtual_time}
+        return selected, merged_into, already_answered
+
+    def next_batch(self, session_id, worker_id, limit=1, lease_seconds=30, min_priority=None):
+        """为 worker 调度并认领下一批要回答的弹幕。
+
+        返回 {'bullet_screens': [...], 'expired', 'merged', 'retry_after'}；每条弹幕附带 topic、
+        age_seconds 与 merged_ids（本轮合并到这一条的同话题弹幕，随这一条的 ack 完成）。
+        """
+        state = self._state(session_id)
+        with state.lock:
+            expired = db.expire_bullet_screens(session_id, self.max_age) if self.max_age else 0
+            allowed, retry_after = self._reserve_budget(limit)
+            if not allowed:
+                with self._stats_lock:
+                    self.rounds += 1
+                    self.expired += expired
+                    self.budget_limited += 1
+                return {'bullet_screens': [], 'expired': expired, 'merged': 0, 'retry_after': round(retry_after, 1)}
+
+            try:
+                candidates = db.get_schedulable_bullet_screens(session_id, self.per_user, self.window, min_priority)
+                topics = {bullet['id']: db.bullet_topic(session_id, bullet['message']) for bullet in candidates}
+                now = time.monotonic()
+                selected, merged_into, already_answered = self._select(state, candidates, topics, allowed, now)
+
+                claimed = db.claim_bullet_screens_by_id(worker_id, [b['id'] for b in selected], lease_seconds)
+                by_id = {bullet['id']: bullet for bullet in selected}
+                merged_count = 0
+                # 合并到此前已回答话题的代表弹幕；代表弹幕已退回或过期时该话题不再视为已回答
+                for primary, ids in already_answered.items():
+                    merged = db.merge_bullet_screens(primary, ids)
+                    if merged is None:
+                        state.topics = {t: v for t, v in state.topics.items() if v[1] != primary}
+                    else:
+                        merged_count += len(merged)
+                results = []
+                for row in claimed:
+                    source = by_id[row['id']]
+                    topic = topics[row['id']]
+                    state.topics[topic] = (now, row['id'])
+                    merged = db.merge_bullet_screens(row['id'], merged_into[row['id']]) or []
+                    merged_count += len(merged)
+                    results.append({
+                        **row,
+                        'topic': topic,
+                        'age_seconds': source.get('age_seconds'),
+                        'merged_ids': merged,
+                    })
+                # 认领失败（已被其他 worker 认领）的弹幕，其同话题弹幕留待下一轮
+                state.topics = {t: v for t, v in state.topics.items() if now - v[0] < self.topic_window}
+            except Exception:
+                self._release_budget(allowed)
+                raise
+
+        order = {bullet['id']: index for index, bullet in enumerate(selected)}
+        results.sort(key=lambda row: order[row['id']])
+        self._release_budget(allowed - len(results))
+        with self._stats_lock:
+            self.rounds += 1
+            self.dispatched += len(results)
+            self.merged += merged_count
+            self.expired += expired
+            if allowed < limit:
+                self.budget_limited += 1
+            for row in results:
+                wait = row['age_seconds'] or 0
+                self._wait_counts[bisect.bisect_left(WAIT_BUCKETS_S, wait)] += 1
+                self._wait_total += wait
+                self.max_wait = max(self.max_wait, wait)
+        return {'bullet_screens': results, 'expired': expired, 'merged': merged_count, 'retry_after': None}
+
+    def stats(self):
+        now = time.monotonic()
+        with self._budget_lock:
+            used = sum(1 for at in self._dispatched_at if at > now - BUDGET_WINDOW)
+        with self._stats_lock:
+            histogram = {f"le_{bound}s": count for bound, count in zip(WAIT_BUCKETS_S, self._wait_counts)}
+            histogram["le_inf"] = self._wait_counts[-1]
+            return {
+                'answers_per_minute': self.answers_per_minute,
+                'budget_used_last_minute': used,
+                'max_age_seconds': self.max_age,
+                'topic_window_seconds': self.topic_window,
+                'per_user': self.per_user,
+                'active_sessions': len(self._sessions),
+                'rounds': self.rounds,
+                'dispatched': self.dispatched,
+                'merged': self.merged,
+                'expired': self.expired,
+                'budget_limited': self.budget_limited,
+                'avg_wait_seconds': round(self._wait_total / self.dispatched, 1) if self.dispatched else 0.0,
+                'max_wait_seconds': self.max_wait,
+                'wait_histogram': histogram,
+            }
+
+
+# 单例
+bullet_scheduler = FairScheduler(
+    answers_per_minute=Config.BULLET_ANSWERS_PER_MINUTE,
+    max_age=Config.BULLET_MAX_AGE_SECONDS,
+    topic_window=Config.BULLET_TOPIC_WINDOW_SECONDS,
+    per_user=Config.BULLET_SCHEDULE_PER_USER,
+)
@@ -1,101 +1,382 @@
 """
-轻量 WebSocket 广播服务（用于实时推送弹幕到前端）。
-如果环境中没有安装 `websockets` 包，模块会静默失败并回退到轮询机制。
+WebSocket 实时推送（弹幕、语音就绪通知）
+
+客户端连接 ``ws://host:port/?session_id=<会话ID>``，或连接后发送
+``{"action": "subscribe", "session_id": ...}`` / ``{"action": "unsubscribe", ...}`` 订阅会话房间，
+只会收到所订阅会话的消息；``{"action": "ping"}`` 返回 ``{"type": "pong"}``。
+
+- 合并发送：``broadcast()`` 只把消息放入待发缓冲（线程安全，不创建协程），事件循环每 ``flush_ms``
+  毫秒把每个房间的消息编码为一帧 ``{"type": "batch", "session_id", "messages": [...]}``，
+  每个房间每个周期只序列化一次；
+- 背压：每个客户端有独立的发送协程与容量 ``queue_size`` 帧的发送队列，队列满时丢弃最旧的帧，
+  慢客户端只影响自己，不会拖慢其他客户端；
+- 心跳与驱逐：协议层 ping/pong 心跳（``heartbeat`` 秒无响应即断开）；连接后 ``idle_timeout`` 秒内
+  没有订阅任何房间、或发送队列 ``stall_timeout`` 秒没有进展的客户端被主动断开。
+
+依赖 ``websockets`` 包；未安装时 ``start_server`` 返回 False，``broadcast`` 静默忽略，前端回退到轮询。
 
 启动：在 app 启动后调用 start_server(host, port)
-广播：调用 broadcast({'type':'bullet', ...})
+广播：调用 broadcast({'type': 'bullet', 'session_id': ..., ...})
+指标：stats()
 """
-import threading
+import asyncio
 import json
 import logging
+import threading
+import time
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
 
-logger = logging.getLogger(__name__)
+from config import Config
 
-_websockets = None
-_loop = None
-_server = None
-_clients = set()
+logger = logging.getLogger(__name__)
 
 try:
-    import asyncio
     import websockets
-    _websockets = websockets
+    from websockets.exceptions import ConnectionClosed
 except Exception:
-    _websockets = None
-
-
-async def _handler(ws, path):
-    # 注册客户端
-    _clients.add(ws)
-    logger.info(f"WS 客户端已连接: {ws.remote_address}")
-    try:
-        async for _ in ws:
-            # 本服务为单向广播，忽略客户端消息
-            continue
-    except Exception:
-        pass
-    finally:
-        try:
-            _clients.discard(ws)
-        except Exception:
-            pass
-        logger.info(f"WS 客户端断开: {ws.remote_address}")
+    websockets = None
+    ConnectionClosed = Exception
 
+# 每个会话待发缓冲的上限（事件循环处理不过来时丢弃最旧的消息）
+MAX_PENDING_PER_SESSION = 1000
+# 每个客户端最多订阅的房间数
+MAX_ROOMS_PER_CLIENT = 8
 
-async def _broadcast_json(obj):
-    if not _clients:
-        return
-    data = json.dumps(obj, ensure_ascii=False)
-    coros = []
-    for ws in list(_clients):
-        try:
-            coros.append(ws.send(data))
-        except Exception:
+
+class _Client:
+    __slots__ = ('ws', 'queue', 'ready', 'rooms', 'last_activity', 'last_progress', 'dropped', 'evicted')
+
+    def __init__(self, ws, queue_size, now):
+        self.ws = ws
+        self.queue = deque(maxlen=queue_size)
+        self.ready = asyncio.Event()
+        self.rooms = set()
+        self.last_activity = now
+        self.last_progress = now
+        self.dropped = 0
+        self.evicted = False
+
+    def push(self, frame, now):
+        """放入一帧；队列已满时丢弃最旧的帧，返回是否发生丢弃。"""
+        dropped = len(self.queue) == self.queue.maxlen
+        if dropped:
+            self.dropped += 1
+        elif not self.queue:
+            # 队列从空变为非空时重新开始计算发送进展
+            self.last_progress = now
+        self.queue.append(frame)
+        self.ready.set()
+        return dropped
+
+
+class BulletBroadcaster:
+    def __init__(self, queue_size=256, flush_ms=50, heartbeat=20, idle_timeout=60, stall_timeout=30):
+        self.queue_size = max(1, int(queue_size))
+        self.flush_interval = max(1, int(flush_ms)) / 1000.0
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.stall_timeout = stall_timeout
+        self._pending = {}  # session_id -> deque(消息)
+        self._pending_lock = threading.Lock()
+        # 以下结构只在事件循环线程中访问
+        self._rooms = {}  # session_id -> set(_Client)
+        self._clients = set()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # 指标
+        self.connections_total = 0
+        self.disconnections = 0
+        self.evicted_idle = 0
+        self.evicted_stalled = 0
+        self.published = 0
+        self.unrouted = 0
+        self.pending_dropped = 0
+        self.undelivered = 0
+        self.frames_built = 0
+        self.fanout = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.flushes = 0
+        self._flush_total_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.max_queue_depth = 0
+
+    @property
+    def running(self):
+        return self._loop is not None
+
+    # ---- 线程安全的对外接口 ----
+
+    def broadcast(self, obj):
+        """把消息放入所属会话（obj['session_id']）的待发缓冲，返回是否已接收。"""
+        if self._loop is None:
+            return False
+        session_id = obj.get('session_id') if isinstance(obj, dict) else None
+        if not session_id:
+            self.unrouted += 1
+            return False
+        with self._pending_lock:
+            pending = self._pending.get(session_id)
+            if pending is None:
+                pending = self._pending[session_id] = deque(maxlen=MAX_PENDING_PER_SESSION)
+            elif len(pending) == pending.maxlen:
+                self.pending_dropped += 1
+            pending.append(obj)
+            self.published += 1
+        return True
+
+    def start(self, host='127.0.0.1', port=6789):
+        """在后台线程启动 WebSocket 服务器；返回 True 表示已启动，False 表示不可用（缺少依赖或端口占用）"""
+        if websockets is None:
+            logger.warning('websockets 库不可用，WebSocket 推送未启用')
+            return False
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return True
+            started = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(host, port, started), name='bullet-ws', daemon=True)
+            self._thread.start()
+            started.wait(10)
+            return self._loop is not None
+
+    def stats(self):
+        with self._pending_lock:
+            pending = sum(len(messages) for messages in self._pending.values())
+        connections = room_count = subscriptions = queued_frames = 0
+        loop = self._loop
+        if loop is not None:
+            # 连接与房间只在事件循环线程中修改，在循环内取快照，避免遍历时集合大小变化
             try:
-                _clients.discard(ws)
-            except Exception:
-                pass
-    if coros:
-        await asyncio.wait(coros)
+                connections, room_count, subscriptions, queued_frames = \
+                    asyncio.run_coroutine_threadsafe(self._snapshot(), loop).result(timeout=2)
+            except Exception as err:
+                logger.warning(f'获取 WebSocket 连接快照失败: {err}')
+        return {
+            'running': self.running,
+            'connections': connections,
+            'connections_total': self.connections_total,
+            'disconnections': self.disconnections,
+            'evicted_idle': self.evicted_idle,
+            'evicted_stalled': self.evicted_stalled,
+            'rooms': room_count,
+            'subscriptions': subscriptions,
+            'published': self.published,
+            'pending': pending,
+            'pending_dropped': self.pending_dropped,
+            'unrouted': self.unrouted,
+            'undelivered': self.undelivered,
+            'frames_built': self.frames_built,
+            'fanout': self.fanout,
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'queued_frames': queued_frames,
+            'max_queue_depth': self.max_queue_depth,
+            'queue_size': self.queue_size,
+            'flush_ms': int(self.flush_interval * 1000),
+            'flushes': self.flushes,
+            'avg_flush_ms': round(self._flush_total_ms / self.flushes, 3) if self.flushes else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 3),
+        }
 
+    # ---- 事件循环线程 ----
 
-def start_server(host='127.0.0.1', port=6789):
-    """在后台线程启动 WebSocket 服务器；返回 True 表示已启动，False 表示不可用（缺少依赖）"""
-    global _loop, _server
-    if _websockets is None:
-        logger.warning('websockets 库不可用，WebSocket 广播未启用')
-        return False
-
-    def _run():
-        global _loop, _server
-        _loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(_loop)
-        start_coro = _websockets.serve(_handler, host, port)
-        _server = _loop.run_until_complete(start_coro)
-        logger.info(f'WebSocket 广播服务已启动 -> ws://{host}:{port}')
+    async def _snapshot(self):
+        return (
+            len(self._clients),
+            len(self._rooms),
+            sum(len(members) for members in self._rooms.values()),
+            sum(len(client.queue) for client in self._clients),
+        )
+
+    def _run(self, host, port, started):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
         try:
-            _loop.run_forever()
+            self._server = loop.run_until_complete(self._serve(host, port))
+        except Exception as err:
+            logger.warning(f'WebSocket 推送服务启动失败: {err}')
+            started.set()
+            return
+        loop.create_task(self._flush_loop())
+        loop.create_task(self._janitor_loop())
+        self._loop = loop
+        started.set()
+        logger.info(f'WebSocket 推送服务已启动 -> ws://{host}:{port}')
+        try:
+            loop.run_forever()
+        finally:
+            self._loop = None
+            self._server.close()
+
+    async def _serve(self, host, port):
+        # 新版 websockets 的 serve() 需要在运行中的事件循环里创建；关闭压缩，同一帧对所有客户端只编码一次
+        return await websockets.serve(
+            self._handler, host, port,
+            ping_interval=self.heartbeat, ping_timeout=self.heartbeat,
+            close_timeout=5, compression=None, max_size=64 * 1024,
+        )
+
+    async def _handler(self, ws, path=None):
+        now = time.monotonic()
+        client = _Client(ws, self.queue_size, now)
+        self._clients.add(client)
+        self.connections_total += 1
+        writer = asyncio.ensure_future(self._writer(client))
+        try:
+            request = getattr(ws, 'request', None)
+            path = path or (request.path if request is not None else getattr(ws, 'path', '')) or ''
+            for session_id in parse_qs(urlsplit(path).query).get('session_id', [])[:MAX_ROOMS_PER_CLIENT]:
+                self._subscribe(client, session_id)
+            async for raw in ws:
+                client.last_activity = time.monotonic()
+                self._on_message(client, raw)
+        except ConnectionClosed:
+            pass
         finally:
+            writer.cancel()
+            for session_id in list(client.rooms):
+                self._unsubscribe(client, session_id)
+            self._clients.discard(client)
+            self.disconnections += 1
+
+    def _on_message(self, client, raw):
+        try:
+            data = json.loads(raw)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        action = data.get('action')
+        session_id = data.get('session_id')
+        if action == 'subscribe' and isinstance(session_id, str) and session_id:
+            if session_id not in client.rooms and len(client.rooms) >= MAX_ROOMS_PER_CLIENT:
+                reply = {'type': 'error', 'error': f'最多订阅 {MAX_ROOMS_PER_CLIENT} 个会话'}
+            else:
+                self._subscribe(client, session_id)
+                reply = {'type': 'subscribed', 'session_id': session_id}
+        elif action == 'unsubscribe' and isinstance(session_id, str):
+            self._unsubscribe(client, session_id)
+            reply = {'type': 'unsubscribed', 'session_id': session_id}
+        elif action == 'ping':
+            reply = {'type': 'pong'}
+        else:
+            return
+        self._push(client, json.dumps(reply, ensure_ascii=False), time.monotonic())
+
+    def _subscribe(self, client, session_id):
+        client.rooms.add(session_id)
+        self._rooms.setdefault(session_id, set()).add(client)
+
+    def _unsubscribe(self, client, session_id):
+        client.rooms.discard(session_id)
+        members = self._rooms.get(session_id)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self._rooms[session_id]
+
+    def _push(self, client, frame, now):
+        if client.push(frame, now):
+            self.frames_dropped += 1
+
+    async def _writer(self, client):
+        while True:
+            await client.ready.wait()
+            client.ready.clear()
+            while client.queue:
+                frame = client.queue.popleft()
+                try:
+                    await client.ws.send(frame)
+                except ConnectionClosed:
+                    return
+                self.frames_sent += 1
+                client.last_progress = time.monotonic()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
             try:
-                _server.close()
-                _loop.run_until_complete(_server.wait_closed())
-            except Exception:
-                pass
+                self._flush()
+            except Exception as err:
+                logger.warning(f'WebSocket 合并发送失败: {err}')
+
+    def _flush(self):
+        with self._pending_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+        started = time.perf_counter()
+        now = time.monotonic()
+        for session_id, messages in pending.items():
+            members = self._rooms.get(session_id)
+            if not members:
+                self.undelivered += len(messages)
+                continue
+            frame = json.dumps(
+                {'type': 'batch', 'session_id': session_id, 'messages': list(messages)},
+                ensure_ascii=False, default=str,
+            )
+            self.frames_built += 1
+            self.fanout += len(members)
+            for client in members:
+                self._push(client, frame, now)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self._flush_total_ms += elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+
+    async def _janitor_loop(self):
+        interval = max(1.0, min(self.idle_timeout, self.stall_timeout) / 4)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            max_depth = 0
+            for client in list(self._clients):
+                max_depth = max(max_depth, len(client.queue))
+                if client.evicted:
+                    continue
+                if client.queue and now - client.last_progress > self.stall_timeout:
+                    self.evicted_stalled += 1
+                    self._evict(client, 1013, 'send queue stalled', abort=True)
+                elif not client.rooms and now - client.last_activity > self.idle_timeout:
+                    self.evicted_idle += 1
+                    self._evict(client, 1008, 'no subscription')
+            self.max_queue_depth = max_depth
+
+    def _evict(self, client, code, reason, abort=False):
+        """断开客户端并立即退出房间。不读数据的客户端无法完成关闭握手，abort 时直接中断 TCP 连接。"""
+        client.evicted = True
+        for session_id in list(client.rooms):
+            self._unsubscribe(client, session_id)
+        client.queue.clear()
+        if abort:
+            client.ws.transport.abort()
+        else:
+            asyncio.ensure_future(client.ws.close(code, reason))
+
+
+# 单例
+broadcaster = BulletBroadcaster(
+    queue_size=Config.BULLET_WS_QUEUE_SIZE,
+    flush_ms=Config.BULLET_WS_FLUSH_MS,
+    heartbeat=Config.BULLET_WS_HEARTBEAT,
+    idle_timeout=Config.BULLET_WS_IDLE_TIMEOUT,
+    stall_timeout=Config.BULLET_WS_STALL_TIMEOUT,
+)
 
-    t = threading.Thread(target=_run, daemon=True)
-    t.start()
-    return True
+
+def start_server(host='127.0.0.1', port=6789):
+    """在后台线程启动 WebSocket 服务器；返回 True 表示已启动，False 表示不可用（缺少依赖）"""
+    return broadcaster.start(host, port)
 
 
 def broadcast(obj):
-    """向所有已连接客户端广播 JSON 可序列化对象。"""
-    global _loop
-    if _websockets is None or _loop is None:
-        return False
-    try:
-        fut = asyncio.run_coroutine_threadsafe(_broadcast_json(obj), _loop)
-        # 不阻塞，丢弃结果
-        return True
-    except Exception as e:
-        logger.warning(f'广播失败: {e}')
-        return False
+    """把消息推送给订阅了 obj['session_id'] 的客户端（合并后异步发送，不阻塞调用方）。"""
+    return broadcaster.broadcast(obj)
+
+
+def stats():
+    return broadcaster.stats()
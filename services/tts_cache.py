@@ -0,0 +1,116 @@
+"""
+按内容寻址的 TTS 音频缓存
+
+缓存键为 hash(text, voice, speed, format, sample_rate)，同一段文本在相同发音参数下
+只合成一次，文件名固定为 ``tts-<key>.<ext>``。磁盘占用超过字节预算时按最近最少使用
+（LRU）顺序淘汰旧文件。
+"""
+import hashlib
+import os
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+FILE_PREFIX = 'tts-'
+
+
+def make_cache_key(text, voice, speed, fmt, sample_rate):
+    """根据文本与发音参数计算缓存键（sha256 十六进制）。"""
+    raw = '\x1f'.join([text or '', str(voice), str(speed), str(fmt).lower(), str(sample_rate)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class TTSAudioCache:
+    """音频目录的 LRU 索引。只维护文件名与大小，音频内容始终保存在磁盘上。"""
+
+    def __init__(self, audio_dir, max_bytes):
+        self.audio_dir = audio_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # filename -> size，越靠后越新
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._scan()
+
+    def _scan(self):
+        """启动时把已有音频按修改时间载入索引，使预算覆盖历史文件。"""
+        if not os.path.isdir(self.audio_dir):
+            return
+        files = []
+        for name in os.listdir(self.audio_dir):
+            if not name.startswith(FILE_PREFIX) or name.endswith('.part'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.audio_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        with self._lock:
+            for _, name, size in files:
+                self._entries[name] = size
+                self._bytes += size
+            self._evict_locked()
+        if files:
+            logger.info(f"ℹ️ TTS 音频缓存已载入 {len(self._entries)} 个文件，共 {self._bytes} 字节")
+
+    def lookup(self, filename):
+        """命中时刷新 LRU 位置并返回 True；文件已被外部删除时移出索引。"""
+        with self._lock:
+            size = self._entries.get(filename)
+            if size is not None and os.path.isfile(os.path.join(self.audio_dir, filename)):
+                self._entries.move_to_end(filename)
+                self.hits += 1
+                return True
+            if size is not None:
+                self._entries.pop(filename, None)
+                self._bytes -= size
+            self.misses += 1
+            return False
+
+    def add(self, filename):
+        """登记新合成的文件，并在超出预算时淘汰最旧的文件。"""
+        try:
+            size = os.path.getsize(os.path.join(self.audio_dir, filename))
+        except OSError:
+            return
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old is not None:
+                self._bytes -= old
+            self._entries[filename] = size
+            self._bytes += size
+            self._evict_locked()
+
+    def _evict_locked(self):
+        # 至少保留最新的一个文件，避免单个超大文件刚写入即被删除
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+            try:
+                os.remove(os.path.join(self.audio_dir, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除 TTS 缓存文件失败 {name}: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'files': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+            }
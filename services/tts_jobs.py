@@ -0,0 +1,237 @@
+"""
+后台语音合成任务队列
+
+/api/chat 只负责把回答文本入队并立即返回 audio_job_id 与预分配的 audio_url，
+实际的百度 TTS 合成由后台线程池完成。前端可以通过 /api/tts/status 轮询任务状态，
+或监听 WebSocket 推送的 ``tts_ready`` 消息。
+
+音频文件按内容寻址（见 tts_cache）：相同文本与发音参数直接复用已有文件，
+同一缓存键的并发请求合并到同一个进行中的任务。
+"""
+import os
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from . import baidu_tts
+from . import bullet_ws
+from .tts_cache import TTSAudioCache, make_cache_key, FILE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class TTSJobQueue:
+    """带任务表的 TTS 合成线程池。
+
+    任务表只保存在进程内存中，只登记真正需要合成的任务，已结束的任务在 ``job_ttl`` 秒后被清理；
+    缓存命中与清理后的任务都根据磁盘上的音频文件判断是否就绪。
+    """
+
+    def __init__(self, audio_dir, url_prefix='/static/audio', max_workers=4, job_ttl=600,
+                 cache_max_bytes=512 * 1024 * 1024):
+        self.audio_dir = audio_dir
+        self.url_prefix = url_prefix.rstrip('/')
+        self.job_ttl = job_ttl
+        self.cache = TTSAudioCache(audio_dir, cache_max_bytes)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='tts')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._by_file = {}
+        self._inflight = {}   # filename -> job_id，用于合并同一缓存键的并发请求
+        self._callbacks = {}  # job_id -> [on_done, ...]
+        self.deduplicated = 0
+
+    def submit(self, text, session_id=None, on_done=None, **tts_params):
+        """提交合成任务，立即返回任务快照（含 job_id、status 与 audio_url）。
+
+        ``on_done(job)`` 在任务结束（成功或失败）后于工作线程中调用；
+        若音频已在缓存中，直接返回 done 状态的快照（job_id 为 None，不登记到任务表），
+        ``on_done`` 在当前线程同步调用。
+        """
+        if not text:
+            raise ValueError('text must be provided')
+
+        params = baidu_tts.resolve_params(**tts_params)
+        ext = 'mp3' if str(params['fmt']).lower() == 'mp3' else 'wav'
+        key = make_cache_key(text, params['voice'], params['rate'], params['fmt'], params['sample_rate'])
+        filename = f"{FILE_PREFIX}{key}.{ext}"
+
+        with self._lock:
+            self._prune_locked()
+
+            # 同一缓存键已有任务在合成：挂上回调后直接复用
+            inflight_id = self._inflight.get(filename)
+            if inflight_id is not None:
+                self.deduplicated += 1
+                if on_done:
+                    self._callbacks.setdefault(inflight_id, []).append(on_done)
+                return dict(self._jobs[inflight_id])
+
+            cached = self.cache.lookup(filename)
+            if not cached:
+                job = self._new_job_locked(filename, session_id)
+                self._inflight[filename] = job['job_id']
+                if on_done:
+                    self._callbacks[job['job_id']] = [on_done]
+                snapshot = dict(job)
+
+        if cached:
+            # 缓存命中不登记任务：任务表只跟踪需要合成的任务，不随命中次数增长
+            now = time.time()
+            snapshot = {
+                'job_id': None,
+                'session_id': session_id,
+                'status': STATUS_DONE,
+                'file': filename,
+                'audio_url': f"{self.url_prefix}/{filename}",
+                'cached': True,
+                'error': None,
+                'created_at': now,
+                'finished_at': now,
+            }
+            if on_done:
+                self._invoke(on_done, snapshot)
+            return snapshot
+
+        self._executor.submit(self._run, snapshot['job_id'], text, params)
+        return snapshot
+
+    def _new_job_locked(self, filename, session_id):
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'session_id': session_id,
+            'status': STATUS_PENDING,
+            'file': filename,
+            'audio_url': f"{self.url_prefix}/{filename}",
+            'cached': False,
+            'error': None,
+            'created_at': time.time(),
+            'finished_at': None,
+        }
+        self._jobs[job_id] = job
+        self._by_file[filename] = job_id
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def get_by_file(self, filename):
+        with self._lock:
+            job_id = self._by_file.get(filename)
+            job = self._jobs.get(job_id) if job_id else None
+            return dict(job) if job else None
+
+    def file_exists(self, filename):
+        """任务已被清理时，根据磁盘文件判断音频是否可用。"""
+        name = os.path.basename(filename or '')
+        return bool(name) and os.path.isfile(os.path.join(self.audio_dir, name))
+
+    def stats(self):
+        with self._lock:
+            counts = {STATUS_PENDING: 0, STATUS_RUNNING: 0, STATUS_DONE: 0, STATUS_FAILED: 0}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            jobs = {'jobs': len(self._jobs), 'deduplicated': self.deduplicated, **counts}
+        return {**jobs, 'cache': self.cache.stats()}
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(fields)
+            return dict(job)
+
+    def _run(self, job_id, text, params):
+        job = self._set(job_id, status=STATUS_RUNNING)
+        if job is None:
+            return
+
+        out_path = os.path.join(self.audio_dir, job['file'])
+        tmp_path = out_path + '.part'
+        try:
+            os.makedirs(self.audio_dir, exist_ok=True)
+            baidu_tts.synthesize(
+                text,
+                out_path=tmp_path,
+                voice=params['voice'],
+                fmt=params['fmt'],
+                sample_rate=params['sample_rate'],
+                rate=params['rate'],
+            )
+            # 先写临时文件再原子替换，避免半写入的文件被当作缓存命中
+            os.replace(tmp_path, out_path)
+            self.cache.add(job['file'])
+            status, error = STATUS_DONE, None
+            logger.info(f"✅ TTS 任务完成 - job: {job_id}")
+        except Exception as e:
+            logger.warning(f'Baidu TTS 合成失败 - job: {job_id}: {e}', exc_info=True)
+            status, error = STATUS_FAILED, str(e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(status=status, error=error, finished_at=time.time())
+            self._inflight.pop(job['file'], None)
+            callbacks = self._callbacks.pop(job_id, [])
+            job = dict(job)
+
+        if status == STATUS_DONE:
+            self._notify(job)
+
+        for callback in callbacks:
+            self._invoke(callback, job)
+
+    def _invoke(self, callback, job):
+        try:
+            callback(job)
+        except Exception:
+            logger.warning('TTS 任务回调失败', exc_info=True)
+
+    def _notify(self, job):
+        # 通过 WebSocket 推送就绪通知（若广播服务未启用则静默忽略）
+        try:
+            bullet_ws.broadcast({
+                'type': 'tts_ready',
+                'session_id': job.get('session_id'),
+                'job_id': job['job_id'],
+                'audio_url': job['audio_url'],
+            })
+        except Exception:
+            logger.debug('TTS 就绪通知广播失败', exc_info=True)
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.job_ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and job['finished_at'] < cutoff
+        ]
+        for job_id in expired:
+            job = self._jobs.pop(job_id)
+            if self._by_file.get(job['file']) == job_id:
+                self._by_file.pop(job['file'], None)
+
+
+# 单例
+tts_jobs = TTSJobQueue(
+    Config.AUDIO_DIR,
+    max_workers=Config.TTS_WORKERS,
+    job_ttl=Config.TTS_JOB_TTL,
+    cache_max_bytes=Config.TTS_CACHE_MAX_BYTES,
+)
@@ -0,0 +1,98 @@
+"""
+分句语音流水线
+
+把流式输出的回答按中文句末标点（。！？；）切分，每得到一个完整句子就立即提交
+后台语音合成，使首句音频与后续文本生成并行进行。各句音频按顺序组成播放列表，
+前端在第 1 段就绪后即可开始播放。
+
+句子音频按内容寻址（见 tts_cache），同一回答再次命中缓存时会切出相同的句子，
+可直接复用已合成的文件。
+"""
+import logging
+
+from .tts_jobs import tts_jobs
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_ENDINGS = '。！？；!?;\n'
+SOFT_BREAKS = '，,、：:'
+
+
+class SentenceSegmenter:
+    """增量分句器。
+
+    - 过短的句子（少于 ``min_chars``）与下一句合并，避免为“好的！”之类片段单独请求合成；
+    - 超过 ``max_chars`` 仍未遇到句末标点时，在最后一个逗号处（没有则直接）截断。
+    """
+
+    def __init__(self, min_chars=4, max_chars=120):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ''
+
+    def feed(self, delta):
+        """追加一段增量文本，返回本次新完成的句子列表。"""
+        if not delta:
+            return []
+        self._buffer += delta
+
+        sentences = []
+        start = 0
+        for i, ch in enumerate(self._buffer):
+            if ch in SENTENCE_ENDINGS and len(self._buffer[start:i + 1].strip()) >= self.min_chars:
+                sentences.append(self._buffer[start:i + 1])
+                start = i + 1
+        self._buffer = self._buffer[start:]
+
+        while len(self._buffer) > self.max_chars:
+            head = self._buffer[:self.max_chars]
+            cut = max(head.rfind(c) for c in SOFT_BREAKS)
+            cut = cut + 1 if cut > 0 else self.max_chars
+            sentences.append(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+
+        return [s.strip() for s in sentences if s.strip()]
+
+    def flush(self):
+        """返回缓冲区中剩余的不完整句子（流结束时调用）。"""
+        rest = self._buffer.strip()
+        self._buffer = ''
+        return [rest] if rest else []
+
+
+class SpeechPipeline:
+    """把分句结果逐句提交到 TTS 任务队列，并维护有序播放列表。"""
+
+    def __init__(self, session_id=None, jobs=None, segmenter=None):
+        self.session_id = session_id
+        self.jobs = jobs or tts_jobs
+        self.segmenter = segmenter or SentenceSegmenter()
+        self.playlist = []
+
+    def feed(self, delta):
+        """追加增量文本，返回本次新提交的音频片段。"""
+        return [self._dispatch(s) for s in self.segmenter.feed(delta)]
+
+    def finish(self):
+        """流结束时提交剩余文本，返回本次新提交的音频片段。"""
+        return [self._dispatch(s) for s in self.segmenter.flush()]
+
+    def _dispatch(self, sentence):
+        segment = {
+            'index': len(self.playlist),
+            'text': sentence,
+            'audio_job_id': None,
+            'audio_url': None,
+            'audio_pending': False,
+        }
+        try:
+            job = self.jobs.submit(sentence, session_id=self.session_id)
+            segment.update(
+                audio_job_id=job['job_id'],
+                audio_url=job['audio_url'],
+                audio_pending=job['status'] != 'done',
+            )
+        except Exception as e:
+            logger.warning(f'提交分句语音合成失败: {e}', exc_info=True)
+        self.playlist.append(segment)
+        return segment
@@ -503,6 +503,7 @@ async function waitForTTSReady(audioUrl, maxWaitMs = 1500, pollIntervalMs = 150)
             if (!resp.ok) break; // 端点不可用则直接跳出
             const data = await resp.json();
             if (data && data.ready) return; // 就绪
+            if (data && data.status === 'failed') return; // 合成失败，交给audio自带重试
             // 未就绪则短暂等待
         } catch (e) {
             break; // 网络或其他问题，直接跳出，后续走audio自带重试
@@ -511,6 +512,138 @@ async function waitForTTSReady(audioUrl, maxWaitMs = 1500, pollIntervalMs = 150)
     }
 }
 
+// 浏览器是否支持以流的方式读取响应体
+function supportsStreaming() {
+    return typeof window.ReadableStream !== 'undefined' && typeof window.TextDecoder !== 'undefined';
+}
+
+// 请求 /api/chat/stream 并解析 SSE：delta / audio_segment 逐段回调，返回 done 事件数据，error 事件抛出异常
+async function streamChat(message, onDelta, onSegment) {
+    const resp = await fetch(`${API_BASE}/api/chat/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ session_id: currentSessionId, message: message })
+    });
+    if (!resp.ok || !resp.body) {
+        let data = {};
+        try {
+            data = await resp.json();
+        } catch (e) {
+            data = {};
+        }
+        throw new Error((data && data.error) ? data.error : '请求失败');
+    }
+
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    let result = null;
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let idx;
+        while ((idx = buffer.indexOf('\n\n')) >= 0) {
+            const rawEvent = buffer.slice(0, idx);
+            buffer = buffer.slice(idx + 2);
+            let eventName = 'message';
+            const dataLines = [];
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+            });
+            const payload = dataLines.length ? JSON.parse(dataLines.join('\n')) : {};
+            if (eventName === 'delta') {
+                onDelta(payload.content || '');
+            } else if (eventName === 'audio_segment') {
+                if (onSegment) onSegment(payload);
+            } else if (eventName === 'done') {
+                result = payload;
+            } else if (eventName === 'error') {
+                throw new Error(payload.error || 'AI服务暂时不可用，请稍后重试');
+            }
+        }
+    }
+    return result;
+}
+
+// 分句语音播放器：按序播放各句音频，每段就绪后立即播放，不等待整段回答合成完毕
+function createSegmentPlayer(messageDiv) {
+    const audioWrap = document.createElement('div');
+    audioWrap.className = 'audio-wrap';
+    const audio = document.createElement('audio');
+    audio.controls = true;
+    audio.preload = 'auto';
+    audioWrap.appendChild(audio);
+    messageDiv.appendChild(audioWrap);
+
+    const queue = [];
+    let playing = false;
+
+    const playNext = async () => {
+        if (playing || queue.length === 0) return;
+        playing = true;
+        const segment = queue.shift();
+        await waitForTTSReady(segment.audio_url, 30000, 200);
+        const url = new URL(segment.audio_url, window.location.origin);
+        url.searchParams.set('__r', `__r=${Date.now()}`);
+        audio.src = url.pathname + url.search;
+        audio.load();
+        const playPromise = audio.play();
+        if (playPromise !== undefined) {
+            playPromise.catch(() => {/* 自动播放受限时静默失败，用户可手动播放 */});
+        }
+    };
+    const onFinished = () => {
+        playing = false;
+        playNext();
+    };
+    audio.addEventListener('ended', onFinished);
+    audio.addEventListener('error', onFinished); // 单段失败时跳过，继续播放后续片段
+
+    return {
+        add(segment) {
+            if (!segment || !segment.audio_url) return;
+            queue.push(segment);
+            playNext();
+        }
+    };
+}
+
+// 流式发送：先创建空的助手消息，逐段追加文本，按句挂载语音
+async function sendMessageStreaming(message, status) {
+    const chatContainer = document.getElementById('chatContainer');
+    const messageDiv = addMessage('assistant', '');
+    const textP = messageDiv.querySelector('p');
+    let text = '';
+    let player = null;
+    try {
+        const data = await streamChat(message, (delta) => {
+            text += delta;
+            textP.textContent = text;
+            status.textContent = '小聚正在回答...';
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+        }, (segment) => {
+            if (!player) player = createSegmentPlayer(messageDiv);
+            player.add(segment);
+        });
+        if (data && typeof data.response === 'string' && data.response.trim().length > 0) {
+            textP.textContent = data.response;
+        } else if (!text) {
+            textP.textContent = '(未返回文本)';
+            console.warn('收到空的 AI 响应文本，已在界面显示占位。完整返回：', data);
+        }
+        if (!player && data && data.audio_url) {
+            attachAudio(messageDiv, data.audio_url, data.audio_pending);
+        }
+        status.textContent = '✅ 思考完毕';
+    } catch (error) {
+        // 尚未输出任何文本时移除空消息，由调用方统一展示错误
+        if (!text) messageDiv.remove();
+        throw error;
+    }
+}
+
 // 发送消息
 async function sendMessage() {
     if (!currentSessionId) {
@@ -538,6 +671,12 @@ async function sendMessage() {
     status.textContent = '小聚正在思考...';
 
     try {
+        // 优先使用流式接口，尽快展示首段文字
+        if (supportsStreaming()) {
+            await sendMessageStreaming(originalMessage, status);
+            return;
+        }
+
         const callChat = async () => {
             const resp = await fetch(`${API_BASE}/api/chat`, {
                 method: 'POST',
@@ -599,7 +738,7 @@ async function sendMessage() {
             if (!data || !data.response) {
                 console.warn('收到空的 AI 响应文本，已在界面显示占位。完整返回：', data);
             }
-            addMessage('assistant', assistantText, data && data.audio_url);
+            addMessage('assistant', assistantText, data && data.audio_url, data && data.audio_pending);
             status.textContent = '✅ 思考完毕';
         } else {
             throw new Error((data && data.error) ? data.error : '请求失败');
@@ -617,8 +756,8 @@ async function sendMessage() {
     }
 }
 
-// 添加消息到聊天界面
-function addMessage(role, content, audioUrl) {
+// 添加消息到聊天界面，返回消息节点以便流式追加内容
+function addMessage(role, content, audioUrl, audioPending) {
     const chatContainer = document.getElementById('chatContainer');
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${role}-message`;
@@ -629,46 +768,54 @@ function addMessage(role, content, audioUrl) {
 
     // 若附带语音
     if (role === 'assistant' && audioUrl) {
-        const audioWrap = document.createElement('div');
-        audioWrap.className = 'audio-wrap';
-        const audio = document.createElement('audio');
-        audio.controls = true;
-        audio.preload = 'auto';
-        // 自动播放（可能受浏览器自动播放策略限制）
-        audio.addEventListener('canplay', () => {
-            const playPromise = audio.play();
-            if (playPromise !== undefined) {
-                playPromise.catch(() => {/* 静默失败，用户可手动播放 */});
-            }
-        });
-        // 若TTS文件尚未生成或被系统短暂占用，采用指数退避重试加载（最长约20s）
-        let retry = 0;
-        audio.addEventListener('error', () => {
-            if (retry < 15) { // 最多重试15次
-                retry++;
-                const delay = Math.min(5000, 400 + Math.pow(1.35, retry) * 200); // 400ms起步，指数增长，封顶5s
-                setTimeout(() => {
-                    const bust = `__r=${Date.now()}`;
-                    const url = new URL(audioUrl, window.location.origin);
-                    url.searchParams.set('__r', bust);
-                    audio.src = url.pathname + url.search;
-                    audio.load();
-                }, delay);
-            }
-        });
-        // 先做一次短轮询，等到ready后再首次设置src，避免一上来就是404
-        waitForTTSReady(audioUrl, 1500, 150).finally(() => {
-            const bust = `__r=${Date.now()}`;
-            const url = new URL(audioUrl, window.location.origin);
-            url.searchParams.set('__r', bust);
-            audio.src = url.pathname + url.search;
-            audio.load();
-        });
-        audioWrap.appendChild(audio);
-        messageDiv.appendChild(audioWrap);
+        attachAudio(messageDiv, audioUrl, audioPending);
     }
     chatContainer.appendChild(messageDiv);
     chatContainer.scrollTop = chatContainer.scrollHeight;
+    return messageDiv;
+}
+
+// 为消息节点附加语音播放器
+function attachAudio(messageDiv, audioUrl, audioPending) {
+    const audioWrap = document.createElement('div');
+    audioWrap.className = 'audio-wrap';
+    const audio = document.createElement('audio');
+    audio.controls = true;
+    audio.preload = 'auto';
+    // 自动播放（可能受浏览器自动播放策略限制）
+    audio.addEventListener('canplay', () => {
+        const playPromise = audio.play();
+        if (playPromise !== undefined) {
+            playPromise.catch(() => {/* 静默失败，用户可手动播放 */});
+        }
+    });
+    // 若TTS文件尚未生成或被系统短暂占用，采用指数退避重试加载（最长约20s）
+    let retry = 0;
+    audio.addEventListener('error', () => {
+        if (retry < 15) { // 最多重试15次
+            retry++;
+            const delay = Math.min(5000, 400 + Math.pow(1.35, retry) * 200); // 400ms起步，指数增长，封顶5s
+            setTimeout(() => {
+                const bust = `__r=${Date.now()}`;
+                const url = new URL(audioUrl, window.location.origin);
+                url.searchParams.set('__r', bust);
+                audio.src = url.pathname + url.search;
+                audio.load();
+            }, delay);
+        }
+    });
+    // 先轮询等到ready后再首次设置src，避免一上来就是404；后台合成中的语音等待更久
+    const maxWaitMs = audioPending ? 30000 : 1500;
+    const pollIntervalMs = audioPending ? 300 : 150;
+    waitForTTSReady(audioUrl, maxWaitMs, pollIntervalMs).finally(() => {
+        const bust = `__r=${Date.now()}`;
+        const url = new URL(audioUrl, window.location.origin);
+        url.searchParams.set('__r', bust);
+        audio.src = url.pathname + url.search;
+        audio.load();
+    });
+    audioWrap.appendChild(audio);
+    messageDiv.appendChild(audioWrap);
 }
 
 // 显示错误信息
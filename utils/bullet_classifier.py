@@ -0,0 +1,147 @@
+"""
+弹幕入库分类器
+
+弹幕写入队列前按规则 + 词典分类并设置优先级，``get_pending_bullet_screens`` / ``claim_bullet_screens``
+按优先级阈值只取出值得交给 AI 回答的弹幕，问候、刷屏与广告不再消耗模型调用。
+
+类别与默认优先级：
+
+- ``product_attribute``（80，提到会话商品名时 90）：询问商品属性，如“苹果甜不甜”“产地是哪里”；
+- ``question``（60）：其他提问；
+- ``purchase_intent``（带提问 40，否则 10）：下单、链接、发货、优惠等购买相关，如“怎么买”“拍了”；
+- ``other``（0）：普通聊天；
+- ``greeting``（-10）：问候、捧场；
+- ``spam``（-100）：广告引流、联系方式、纯表情、同一字符刷屏。
+
+内置词典与会话词典（会话商品名、FAQ 模板与白名单模式）各编译为一个 Aho–Corasick 匹配器，
+每条弹幕只需各扫描一次，分类耗时为微秒级。
+"""
+import re
+from collections import namedtuple
+
+from utils.helpers import normalize_question
+from utils.pattern_matcher import PatternMatcher
+
+Classification = namedtuple('Classification', 'category priority')
+
+PRODUCT_ATTRIBUTE = 'product_attribute'
+QUESTION = 'question'
+PURCHASE_INTENT = 'purchase_intent'
+OTHER = 'other'
+GREETING = 'greeting'
+SPAM = 'spam'
+
+CATEGORY_PRIORITY = {
+    PRODUCT_ATTRIBUTE: 80,
+    QUESTION: 60,
+    PURCHASE_INTENT: 40,
+    OTHER: 0,
+    GREETING: -10,
+    SPAM: -100,
+}
+# 提到会话商品名的属性提问额外加分；不带提问的购买表态（如“拍了”）只需主播口播感谢
+PRODUCT_MENTION_BONUS = 10
+PURCHASE_STATEMENT_PRIORITY = 10
+
+QUESTION_TERMS = (
+    '?', '？', '吗', '呢', '多少', '几', '怎么', '怎样', '咋', '什么', '啥', '哪', '如何', '为什么', '为啥',
+    '能不能', '可不可以', '可以吗', '有没有', '是不是', '会不会', '要不要', '多久', '多大', '多重', '多长', '请问',
+)
+ATTRIBUTE_TERMS = (
+    '价格', '多少钱', '价钱', '价位', '几块', '产地', '哪里的', '哪产的', '甜', '酸', '口感', '味道', '新鲜',
+    '保质期', '保存', '放几天', '重量', '几斤', '斤', '规格', '大小', '个头', '品种', '尺寸', '材质', '材料',
+    '成分', '原料', '配料', '怎么吃', '怎么做', '做法', '营养', '农药', '有机', '熟', '脆', '水分', '多汁',
+)
+PURCHASE_TERMS = (
+    '买', '下单', '拍了', '已拍', '拍下', '付款', '链接', '上车', '库存', '有货', '没货', '补货', '发货', '快递',
+    '包邮', '运费', '优惠', '券', '满减', '折扣', '便宜', '秒杀', '抢到', '加购', '购物车', '来一箱', '要一箱',
+    '售后', '退款', '退货', '坏果', '包赔',
+)
+GREETING_TERMS = (
+    '你好', '您好', '主播好', '大家好', '家人们好', '早上好', '中午好', '下午好', '晚上好', '早安', '晚安',
+    '哈喽', '嗨', 'hello', '来了', '报到', '打卡', '拜拜', '再见', '加油', '支持', '点赞', '关注了',
+    '辛苦了', '666', '么么哒', '爱你', '好看', '厉害',
+)
+SPAM_TERMS = (
+    '加微信', '加v', '加vx', 'vx', 'v信', '微信号', 'qq群', 'q群', '加群', '私信我', '私聊我', '代刷', '刷单',
+    '兼职', '日赚', '日入', '点击链接', 'http', 'www.', '.com', '互粉', '互关', '关注我', '看我主页',
+    '免费领', '低价出', '代购',
+)
+
+# 平台表情（如 [赞]）、手机号/QQ 号、“甜不甜”“有没有”式正反问
+EMOTE_PATTERN = re.compile(r'\[[^\[\]]{1,6}\]')
+CONTACT_PATTERN = re.compile(r'\d{7,}')
+A_NOT_A_PATTERN = re.compile(r'(.)[不没]\1')
+# 只由一两种字符组成且长度不少于 FLOOD_MIN_LENGTH 视为刷屏（“666” 仍算捧场）
+FLOOD_MIN_LENGTH = 6
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or '\u4e00' <= ch <= '\u9fff'
+
+
+def _build_builtin_matcher():
+    matcher = PatternMatcher()
+    for kind, terms in (('question', QUESTION_TERMS), ('attribute', ATTRIBUTE_TERMS),
+                        ('purchase', PURCHASE_TERMS), ('greeting', GREETING_TERMS), ('spam', SPAM_TERMS)):
+        for term in terms:
+            matcher.add(term, kind)
+    return matcher
+
+
+def compile_lexicon(product_names=(), faq_patterns=()):
+    """编译会话词典：商品名命中记为 'product'，FAQ 模式命中记为 'faq'。"""
+    matcher = PatternMatcher()
+    for name in product_names:
+        if name and str(name).strip():
+            matcher.add(str(name).strip(), 'product')
+    for pattern in faq_patterns:
+        if pattern and str(pattern).strip():
+            matcher.add(str(pattern).strip(), 'faq')
+    return matcher
+
+
+class BulletClassifier:
+    """无状态的弹幕分类器；会话词典由调用方编译（见 ``compile_lexicon``）并缓存。"""
+
+    def __init__(self):
+        self._builtin = _build_builtin_matcher()
+
+    def classify(self, message, lexicon=None):
+        """返回 Classification(category, priority)。lexicon 为会话词典匹配器，可为 None。"""
+        text = EMOTE_PATTERN.sub('', (message or '').strip().lower())
+        words = [ch for ch in text if _is_word_char(ch)]
+        if not words or CONTACT_PATTERN.search(text):
+            return Classification(SPAM, CATEGORY_PRIORITY[SPAM])
+        if len(words) >= FLOOD_MIN_LENGTH and len(set(words)) <= 2:
+            return Classification(SPAM, CATEGORY_PRIORITY[SPAM])
+
+        kinds = {match.value for match in self._builtin.find_all(text)}
+        if 'spam' in kinds:
+            return Classification(SPAM, CATEGORY_PRIORITY[SPAM])
+        if lexicon is not None:
+            kinds.update(match.value for match in lexicon.find_all(text))
+
+        is_question = 'question' in kinds or A_NOT_A_PATTERN.search(text) is not None
+        if 'faq' in kinds or ('attribute' in kinds and is_question):
+            bonus = PRODUCT_MENTION_BONUS if 'product' in kinds else 0
+            return Classification(PRODUCT_ATTRIBUTE, CATEGORY_PRIORITY[PRODUCT_ATTRIBUTE] + bonus)
+        if 'purchase' in kinds:
+            priority = CATEGORY_PRIORITY[PURCHASE_INTENT] if is_question else PURCHASE_STATEMENT_PRIORITY
+            return Classification(PURCHASE_INTENT, priority)
+        if is_question:
+            return Classification(QUESTION, CATEGORY_PRIORITY[QUESTION])
+        if 'greeting' in kinds:
+            return Classification(GREETING, CATEGORY_PRIORITY[GREETING])
+        return Classification(OTHER, CATEGORY_PRIORITY[OTHER])
+
+    def topic(self, message, lexicon=None):
+        """话题键：提到的会话商品名 + 商品属性词（如“苹果甜不甜”“苹果甜吗”均为 “甜|苹果”）；
+        没有属性词时退回归一化后的原文。用于调度时合并同一话题的提问。"""
+        text = (message or '').lower()
+        terms = {match.pattern for match in self._builtin.find_all(text) if match.value == 'attribute'}
+        if not terms:
+            return normalize_question(message)
+        if lexicon is not None:
+            terms.update(match.pattern for match in lexicon.find_all(text) if match.value == 'product')
+        return '|'.join(sorted(terms))
@@ -0,0 +1,162 @@
+"""
+MySQL 连接池的阻塞获取与熔断
+
+``BlockingPool`` 在 mysql-connector 的连接池外加一个信号量：连接用完时调用方排队等待（最多
+``timeout`` 秒），而不是立即抛出 "pool exhausted"；等待人数与等待耗时计入直方图。
+等待超时抛出 ``PoolTimeout``——这是负载问题，不代表数据库不可用。
+
+``CircuitBreaker`` 只统计真正的连接失败（数据库宕机、网络中断）：连续失败达到阈值后断开，
+由调用方切换到备用后端，并通过健康探测决定何时恢复。
+"""
+import bisect
+import threading
+import time
+
+# 等待耗时直方图的桶上界（毫秒），最后一个桶为 +Inf
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class PoolTimeout(Exception):
+    """等待空闲连接超时（连接池耗尽）。"""
+
+
+class _PooledConnection:
+    """归还连接时同时释放信号量（只释放一次）。"""
+
+    def __init__(self, conn, release):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_release', release)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        release = self._release
+        if release is None:
+            return
+        object.__setattr__(self, '_release', None)
+        try:
+            self._conn.close()
+        finally:
+            release()
+
+
+class BlockingPool:
+    def __init__(self, pool, size, timeout=5.0):
+        self.pool = pool
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.waiters = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.max_wait_ms = 0.0
+        self._wait_counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self._wait_total_ms = 0.0
+
+    def get_connection(self):
+        started = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waiters += 1
+            try:
+                ok = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._lock:
+                    self.waiters -= 1
+            if not ok:
+                with self._lock:
+                    self.timeouts += 1
+                raise PoolTimeout(f"等待数据库连接超过 {self.timeout}s（连接池大小 {self.size}）")
+
+        try:
+            conn = self.pool.get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            self._wait_total_ms += waited_ms
+            self.max_wait_ms = max(self.max_wait_ms, waited_ms)
+            self._wait_counts[bisect.bisect_left(WAIT_BUCKETS_MS, waited_ms)] += 1
+        return _PooledConnection(conn, self._release)
+
+    def _release(self):
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            histogram = {f"le_{bound}ms": count for bound, count in zip(WAIT_BUCKETS_MS, self._wait_counts)}
+            histogram["le_inf"] = self._wait_counts[-1]
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'waiters': self.waiters,
+                'acquired': self.acquired,
+                'timeouts': self.timeouts,
+                'wait_timeout': self.timeout,
+                'avg_wait_ms': round(self._wait_total_ms / self.acquired, 3) if self.acquired else 0.0,
+                'max_wait_ms': round(self.max_wait_ms, 3),
+                'wait_histogram': histogram,
+            }
+
+
+class CircuitBreaker:
+    """连续失败 ``failure_threshold`` 次后断开（open），成功一次即恢复（closed）。"""
+
+    def __init__(self, failure_threshold=3):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.opened_at = None
+        self.last_error = None
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = 'closed'
+            self.opened_at = None
+
+    def record_failure(self, err):
+        """记录一次失败，返回本次是否使熔断器断开。"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self.last_error = str(err)
+            if self.state == 'closed' and self.consecutive_failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def trip(self, err):
+        """直接断开（例如启动时就无法连接数据库）。"""
+        with self._lock:
+            self.total_failures += 1
+            self.last_error = str(err)
+            if self.state == 'closed':
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'total_failures': self.total_failures,
+                'failure_threshold': self.failure_threshold,
+                'opened_at': self.opened_at,
+                'last_error': self.last_error,
+            }
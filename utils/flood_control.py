@@ -0,0 +1,167 @@
+"""
+弹幕刷屏控制：按用户限流与重复消息合并
+
+``TokenBucketLimiter`` 为每个 key（会话 + 用户名）维护一个令牌桶：每秒补充 ``rate`` 个令牌，
+最多积攒 ``burst`` 个，令牌不足的消息直接丢弃。
+
+``DuplicateCollapser`` 在 ``window`` 秒内把相同或近似相同（归一化后一致，如“666666”与“666”、
+“苹果甜吗？？”与“苹果甜吗”）的消息合并为一条：第一条照常写入，其后的只计入该行的 repeat_count。
+窗口从第一条出现时开始计算，持续刷屏时每个窗口写入一行。
+
+两者都是进程内存结构：key 数量超过 ``max_keys`` 时淘汰最久未使用的 key，``sweep()`` 清理空闲 key
+（令牌已补满的桶、窗口已结束的消息），由后台任务定期调用。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from utils.bullet_classifier import EMOTE_PATTERN
+from utils.helpers import normalize_question
+
+# 同一字符连续 3 次以上视为刷屏式重复（“6666”与“666”相同，“11箱”与“1箱”不同）
+REPEAT_PATTERN = re.compile(r'(.)\1{2,}')
+SEPARATOR_PATTERN = re.compile(r'[\s~～…·`!！?？.。,，、;；:：\'"“”‘’()（）\[\]【】<>《》-]+')
+
+
+def flood_key(message):
+    """合并用的归一化文本：去除表情、标点与语气词，同一字符连续 3 次以上只保留一个。"""
+    text = SEPARATOR_PATTERN.sub('', normalize_question(EMOTE_PATTERN.sub('', message or '')))
+    return REPEAT_PATTERN.sub(r'\1', text) or REPEAT_PATTERN.sub(r'\1', (message or '').strip())
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate=1.0, burst=5, max_keys=100000):
+        self.rate = max(0.0, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.max_keys = max(1, int(max_keys))
+        # 空闲这么久的桶已补满，删除与保留等价
+        self.idle_ttl = self.burst / self.rate if self.rate else 0.0
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (令牌数, 更新时间)，按更新时间排序
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+        self.swept = 0
+
+    def allow(self, key, cost=1):
+        """消耗 cost 个令牌，返回是否放行。rate 为 0 时不限流。"""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+                self.allowed += 1
+            else:
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            return allowed
+
+    def refund(self, key, cost=1):
+        """退回令牌（例如放行的消息最终没有写入）。"""
+        if not self.rate:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets[key] = (min(self.burst, bucket[0] + cost), bucket[1])
+
+    def sweep(self):
+        """删除空闲超过 idle_ttl 的桶，返回删除数量。"""
+        cutoff = time.monotonic() - self.idle_ttl
+        removed = 0
+        with self._lock:
+            while self._buckets:
+                key, (_, updated_at) = next(iter(self._buckets.items()))
+                if updated_at > cutoff:
+                    break
+                del self._buckets[key]
+                removed += 1
+            self.swept += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            keys = len(self._buckets)
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'keys': keys,
+            'max_keys': self.max_keys,
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'evicted': self.evicted,
+            'swept': self.swept,
+        }
+
+
+class DuplicateCollapser:
+    def __init__(self, window=10, max_keys=100000):
+        self.window = max(0.0, float(window))
+        self.max_keys = max(1, int(max_keys))
+        self._lock = threading.Lock()
+        self._first_seen = OrderedDict()  # key -> 第一条出现时间，按时间排序
+        self.unique = 0
+        self.collapsed = 0
+        self.evicted = 0
+        self.swept = 0
+
+    def is_duplicate(self, key):
+        """key 在窗口内已出现过时返回 True（应合并）；否则记为新的一条并返回 False。window 为 0 时不合并。"""
+        if not self.window:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            first_seen = self._first_seen.get(key)
+            if first_seen is not None and now - first_seen < self.window:
+                self.collapsed += 1
+                return True
+            self._first_seen.pop(key, None)
+            if len(self._first_seen) >= self.max_keys:
+                self._first_seen.popitem(last=False)
+                self.evicted += 1
+            self._first_seen[key] = now
+            self.unique += 1
+            return False
+
+    def forget(self, key):
+        """撤销一条新消息的登记（例如它最终没有写入），之后相同的消息重新作为第一条写入。"""
+        with self._lock:
+            self._first_seen.pop(key, None)
+
+    def sweep(self):
+        """删除窗口已结束的 key，返回删除数量。"""
+        cutoff = time.monotonic() - self.window
+        removed = 0
+        with self._lock:
+            while self._first_seen:
+                key, first_seen = next(iter(self._first_seen.items()))
+                if first_seen > cutoff:
+                    break
+                del self._first_seen[key]
+                removed += 1
+            self.swept += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            keys = len(self._first_seen)
+        return {
+            'window': self.window,
+            'keys': keys,
+            'max_keys': self.max_keys,
+            'unique': self.unique,
+            'collapsed': self.collapsed,
+            'evicted': self.evicted,
+            'swept': self.swept,
+        }
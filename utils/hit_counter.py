@@ -0,0 +1,111 @@
+"""
+写后（write-behind）命中计数器
+
+请求路径只在内存中累加每个行 id 的命中次数与最近命中时间，后台线程每隔 ``flush_interval`` 秒
+（或累计 ``flush_threshold`` 次命中后立即）把增量交给 ``flush_fn`` 批量写回数据库。
+写回失败的增量会合并回待写队列，下次重试；进程退出前调用 ``stop()`` 做最后一次写回。
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HitCounter:
+    """按 key 聚合命中增量。``flush_fn(pending)`` 接收 {key: (次数, 最近命中时间戳)}。"""
+
+    def __init__(self, flush_fn, name='hits', flush_interval=5.0, flush_threshold=256):
+        self.flush_fn = flush_fn
+        self.name = name
+        self.flush_interval = flush_interval
+        self.flush_threshold = max(1, int(flush_threshold))
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._pending_hits = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.flushed_hits = 0
+        self.failures = 0
+
+    def record(self, key, count=1, at=None):
+        if key is None:
+            return
+        at = at or time.time()
+        with self._lock:
+            prev_count, prev_at = self._pending.get(key, (0, 0))
+            self._pending[key] = (prev_count + count, max(prev_at, at))
+            self._pending_hits += count
+            full = self._pending_hits >= self.flush_threshold
+        if full:
+            if self._thread and self._thread.is_alive():
+                self._wake.set()
+            else:
+                self.flush()
+
+    def pending(self):
+        """未写回的增量快照 {key: (次数, 最近命中时间戳)}。"""
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self):
+        """立即写回全部增量，返回写回的命中次数。"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+                hits, self._pending_hits = self._pending_hits, 0
+            try:
+                self.flush_fn(pending)
+            except Exception as err:
+                self.failures += 1
+                logger.warning(f"批量写回命中计数失败（{self.name}），稍后重试: {err}")
+                with self._lock:
+                    for key, (count, at) in pending.items():
+                        prev_count, prev_at = self._pending.get(key, (0, 0))
+                        self._pending[key] = (prev_count + count, max(prev_at, at))
+                    self._pending_hits += hits
+                return 0
+            self.flushes += 1
+            self.flushed_hits += hits
+            return hits
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"hit-counter-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程并写回剩余增量。"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending_rows, pending_hits = len(self._pending), self._pending_hits
+        return {
+            'pending_rows': pending_rows,
+            'pending_hits': pending_hits,
+            'flushes': self.flushes,
+            'flushed_hits': self.flushed_hits,
+            'failures': self.failures,
+            'flush_interval': self.flush_interval,
+            'flush_threshold': self.flush_threshold,
+        }
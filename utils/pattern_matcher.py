@@ -0,0 +1,127 @@
+"""
+多模式匹配器（Aho–Corasick 自动机）
+
+敏感词、黑名单与 FAQ 白名单共用。模式集编译一次后，每条消息只需一次 O(len(message)) 扫描即可
+找出全部命中及其位置，匹配开销不随模式数量增长。匹配不区分大小写。
+
+新增模式直接插入字典树，失败指针在下一次查询前统一重建，无需重新编译整个模式集。
+查询只读取最近一次构建发布的只读表 ``_tables``：重建在局部变量中完成后一次赋值替换，
+并发查询要么使用旧表、要么使用新表，不会读到构建到一半的失败指针。
+"""
+import threading
+from collections import deque, namedtuple
+
+PatternMatch = namedtuple('PatternMatch', 'start end pattern value')
+
+
+class PatternMatcher:
+    """可增量添加模式的 Aho–Corasick 匹配器。"""
+
+    def __init__(self, patterns=()):
+        self._lock = threading.Lock()
+        # 字典树本身，只在持锁时由 add 修改
+        self._goto = [{}]    # 节点 -> {字符: 子节点}
+        self._own = [[]]     # 节点 -> 以该节点结尾的模式下标
+        self._patterns = []  # (pattern, value, 长度)
+        # 查询使用的只读表 (goto, fail, out, patterns)：out 为含失败链在内的全部输出
+        self._tables = ([{}], [0], [[]], ())
+        self._dirty = False
+        for item in patterns:
+            if isinstance(item, tuple):
+                self.add(*item)
+            else:
+                self.add(item)
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def patterns(self):
+        """返回已添加的模式（按添加顺序）。"""
+        return [pattern for pattern, _, _ in self._patterns]
+
+    def add(self, pattern, value=None):
+        """添加一个模式；value 默认为模式本身。空模式被忽略。"""
+        key = (pattern or '').lower()
+        if not key:
+            return
+        with self._lock:
+            node = 0
+            for ch in key:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._own.append([])
+                    self._goto[node][ch] = nxt
+                node = nxt
+            self._own[node].append(len(self._patterns))
+            self._patterns.append((pattern, pattern if value is None else value, len(key)))
+            self._dirty = True
+
+    def _ensure_built(self):
+        if not self._dirty:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            goto = [dict(edges) for edges in self._goto]
+            fail = [0] * len(goto)
+            out = [[] for _ in goto]
+            queue = deque()
+            for child in goto[0].values():
+                out[child] = list(self._own[child])
+                queue.append(child)
+            while queue:
+                node = queue.popleft()
+                for ch, child in goto[node].items():
+                    state = fail[node]
+                    while state and ch not in goto[state]:
+                        state = fail[state]
+                    state = goto[state].get(ch, 0)
+                    fail[child] = state
+                    out[child] = self._own[child] + out[state]
+                    queue.append(child)
+            self._tables = (goto, fail, out, tuple(self._patterns))
+            self._dirty = False
+
+    def find_all(self, text):
+        """返回全部命中的 PatternMatch(start, end, pattern, value)，按结束位置排序。"""
+        self._ensure_built()
+        goto, fail, out, patterns = self._tables
+        matches = []
+        node = 0
+        for i, ch in enumerate((text or '').lower()):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for idx in out[node]:
+                pattern, value, length = patterns[idx]
+                matches.append(PatternMatch(i - length + 1, i + 1, pattern, value))
+        return matches
+
+    def contains_any(self, text):
+        """是否命中任一模式（命中即返回，不收集全部结果）。"""
+        self._ensure_built()
+        goto, fail, out, _ = self._tables
+        node = 0
+        for ch in (text or '').lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                return True
+        return False
+
+    def best(self, text, score, accept=None):
+        """返回满足 accept 且 score(match) 最大的命中，没有时返回 None。
+
+        例如 FAQ 按 (优先级, 模式长度) 选取：``best(msg, lambda m: (m.value['priority'], m.end - m.start))``。
+        """
+        best, best_score = None, None
+        for match in self.find_all(text):
+            if accept is not None and not accept(match):
+                continue
+            current = score(match)
+            if best is None or current > best_score:
+                best, best_score = match, current
+        return best
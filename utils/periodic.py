@@ -0,0 +1,46 @@
+"""
+后台周期任务
+
+在守护线程中每隔 ``interval`` 秒执行一次 ``fn``，也可以通过 ``trigger()`` 提前唤醒。
+任务抛出的异常只记录日志，不会终止线程。
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    def __init__(self, fn, interval=60.0, name='periodic'):
+        self.fn = fn
+        self.interval = interval
+        self.name = name
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def trigger(self):
+        """提前唤醒一次执行（线程未启动时忽略）。"""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.fn()
+            except Exception as err:
+                logger.warning(f"后台任务 {self.name} 执行失败: {err}")
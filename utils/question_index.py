@@ -0,0 +1,188 @@
+"""
+问题相似度索引
+
+对归一化后的问题提取字符一元/二元特征，按会话维护 TF-IDF 倒排索引，用余弦相似度匹配
+近似重复的提问（如“这个苹果多少钱一斤”与“苹果一斤多少钱”）。
+
+为保证单会话上万条问题时查询仍在亚毫秒级：
+- 候选只从文档频率较低的特征（如“苹果”）生成，倒排表扫描量设有上限，
+  “多少”“钱”这类几乎每条都有的特征不参与候选生成；
+- 只对部分得分最高的少量候选计算精确余弦。
+
+“苹果产地是哪里”与“梨产地是哪里”字面高度相似但答案不能互换，因此匹配前还要求双方涉及的
+主题字（会话商品名中的字）、数字与计量单位完全一致。
+"""
+import heapq
+import math
+import re
+import threading
+import time
+from collections import Counter
+
+# 不影响问题含义的口头用语，提取特征前去除
+FILLER_PATTERN = re.compile(r'(这个|那个|请问|一下|主播|你们|你家|咱们|的)')
+BIGRAM_WEIGHT = 0.5
+# 数字与计量单位决定问题含义（“一箱多少钱”≠“一箱多少斤”），候选必须与查询一致
+GUARD_CHARS = frozenset('0123456789零一二两三四五六七八九十百千万半斤钱元块箱个克盒袋份件')
+
+
+def extract_features(text):
+    """字符一元 + 二元特征（去除口头用语与空白）。二元特征降权，使语序调整不至于拉低相似度。"""
+    chars = [ch for ch in FILLER_PATTERN.sub('', text or '') if not ch.isspace()]
+    features = Counter(chars)
+    features.update({a + b: BIGRAM_WEIGHT for a, b in zip(chars, chars[1:])})
+    return features
+
+
+class _Partition:
+    """单个会话的倒排索引。``guard_chars`` 中的字在查询与候选之间必须一致。"""
+
+    def __init__(self, guard_chars=GUARD_CHARS):
+        self.guard_chars = guard_chars
+        self.docs = {}       # doc_id -> (features, guard, payload)
+        self.postings = {}   # feature -> {doc_id: tf}
+        self.by_key = {}     # 去重键 -> doc_id
+        self._next_id = 0
+
+    def add(self, text, key, payload):
+        if key in self.by_key:
+            return
+        features = extract_features(text)
+        if not features:
+            return
+        doc_id = self._next_id
+        self._next_id += 1
+        self.docs[doc_id] = (features, self._guard(features), payload)
+        self.by_key[key] = doc_id
+        for feature, tf in features.items():
+            self.postings.setdefault(feature, {})[doc_id] = tf
+
+    def remove(self, key):
+        doc_id = self.by_key.pop(key, None)
+        if doc_id is None:
+            return
+        features, _, _ = self.docs.pop(doc_id)
+        for feature in features:
+            posting = self.postings.get(feature)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[feature]
+
+    def _guard(self, features):
+        return frozenset(f for f in features if f in self.guard_chars)
+
+    def _idf(self, feature, n_docs):
+        df = len(self.postings.get(feature, ()))
+        return math.log((n_docs + 1) / (df + 1)) + 1.0
+
+    def search(self, text, accept=None, max_candidates=8, scan_budget=2000):
+        """返回 (最佳相似度, payload)；没有候选时返回 (0.0, None)。
+
+        ``accept(payload)`` 可用于过滤候选（如要求产地一致）。
+        """
+        n_docs = len(self.docs)
+        q_features = extract_features(text)
+        if not n_docs or not q_features:
+            return 0.0, None
+
+        idf = {f: self._idf(f, n_docs) for f in q_features}
+        known = sorted(
+            (f for f in q_features if f in self.postings),
+            key=lambda f: len(self.postings[f]),
+        )
+        if not known:
+            return 0.0, None
+
+        # 候选生成：按文档频率从低到高扫描倒排表，扫描量达到上限即停止；
+        # “多少”“钱”这类高频特征权重低，跳过对排序影响很小
+        partial = {}
+        scanned = 0
+        for i, feature in enumerate(known):
+            posting = self.postings[feature]
+            if i > 0 and scanned + len(posting) > scan_budget:
+                break
+            weight = idf[feature] * idf[feature] * q_features[feature]
+            for doc_id, tf in posting.items():
+                partial[doc_id] = partial.get(doc_id, 0.0) + weight * tf
+            scanned += len(posting)
+
+        candidates = heapq.nlargest(max_candidates, partial, key=partial.get)
+
+        q_norm = math.sqrt(sum((tf * idf[f]) ** 2 for f, tf in q_features.items()))
+        q_guard = self._guard(q_features)
+        best_score, best_payload = 0.0, None
+        for doc_id in candidates:
+            d_features, d_guard, payload = self.docs[doc_id]
+            if d_guard != q_guard or (accept is not None and not accept(payload)):
+                continue
+            dot = 0.0
+            d_norm_sq = 0.0
+            for f, tf in d_features.items():
+                w = tf * (idf[f] if f in idf else self._idf(f, n_docs))
+                d_norm_sq += w * w
+                q_tf = q_features.get(f)
+                if q_tf:
+                    dot += w * q_tf * idf[f]
+            if not d_norm_sq:
+                continue
+            score = dot / (q_norm * math.sqrt(d_norm_sq))
+            if score > best_score:
+                best_score, best_payload = score, payload
+        return best_score, best_payload
+
+
+class QuestionIndex:
+    """按会话分区的问题相似度索引（线程安全）。分区首次使用前由调用方通过 ``load`` 载入。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._partitions = {}
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    def is_loaded(self, session_id):
+        with self._lock:
+            return session_id in self._partitions
+
+    def load(self, session_id, rows, subject_terms=()):
+        """rows: 可迭代的 (text, key, payload)；subject_terms: 会话商品名等主题词。"""
+        guard_chars = GUARD_CHARS.union(*(set(term or '') for term in subject_terms))
+        partition = _Partition(frozenset(ch for ch in guard_chars if not ch.isspace()))
+        for text, key, payload in rows:
+            partition.add(text, key, payload)
+        with self._lock:
+            self._partitions[session_id] = partition
+
+    def add(self, session_id, text, key, payload):
+        with self._lock:
+            partition = self._partitions.get(session_id)
+            if partition is not None:
+                partition.add(text, key, payload)
+
+    def remove(self, session_id, key):
+        with self._lock:
+            partition = self._partitions.get(session_id)
+            if partition is not None:
+                partition.remove(key)
+
+    def search(self, session_id, text, accept=None):
+        """返回 (最佳相似度, payload)。"""
+        started = time.perf_counter()
+        with self._lock:
+            partition = self._partitions.get(session_id)
+            if partition is None:
+                return 0.0, None
+            result = partition.search(text, accept=accept)
+            self.searches += 1
+            self.search_seconds += time.perf_counter() - started
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._partitions),
+                'questions': sum(len(p.docs) for p in self._partitions.values()),
+                'searches': self.searches,
+                'avg_search_ms': round(self.search_seconds * 1000 / self.searches, 3) if self.searches else 0.0,
+            }
@@ -0,0 +1,109 @@
+"""
+规则文件快照
+
+把 data/blacklist.json、data/whitelist.json 这类规则文件载入为不可变的内存快照，并预先编译好
+匹配索引。后台线程按固定间隔检查文件的修改时间与大小，变化时在后台重新解析、编译，
+再整体替换快照引用；请求路径只读取当前快照，不做任何文件 I/O。
+
+文件正在写入导致解析失败时保留旧快照，下一轮轮询再重试。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+RuleSnapshot = namedtuple('RuleSnapshot', 'compiled version loaded_at')
+
+
+def _file_version(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class RuleFileWatcher:
+    """监视单个 JSON 规则文件；``compile_fn(data)`` 返回供请求路径使用的编译结果。"""
+
+    def __init__(self, path, compile_fn, poll_interval=2.0):
+        self.path = path
+        self.compile_fn = compile_fn
+        self.poll_interval = poll_interval
+        self.reloads = 0
+        self.errors = 0
+        self.last_reload_at = None
+        self._failed_version = None
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._snapshot = RuleSnapshot(compile_fn({}), None, None)
+        self.reload()
+
+    @property
+    def current(self):
+        """当前快照（只读，调用方不要修改其中的编译结果）。"""
+        return self._snapshot
+
+    def reload(self, force=False):
+        """文件有变化（或 force）时重新载入，返回是否替换了快照。"""
+        with self._reload_lock:
+            version = _file_version(self.path)
+            if not force and version == self._snapshot.version:
+                return False
+            if not force and version is not None and version == self._failed_version:
+                return False
+
+            try:
+                data = {}
+                if version is not None:
+                    with open(self.path, 'r', encoding='utf-8') as handle:
+                        data = json.load(handle)
+                compiled = self.compile_fn(data)
+            except Exception as err:
+                self.errors += 1
+                self._failed_version = version
+                logger.warning(f"规则文件载入失败，继续使用旧快照 {self.path}: {err}")
+                return False
+
+            self._snapshot = RuleSnapshot(compiled, version, time.time())
+            self._failed_version = None
+            self.reloads += 1
+            self.last_reload_at = self._snapshot.loaded_at
+            logger.info(f"✅ 规则文件已载入: {os.path.basename(self.path)} (第 {self.reloads} 次)")
+            return True
+
+    def start(self):
+        """启动后台轮询线程（poll_interval 不大于 0 时不启动）。"""
+        if self.poll_interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._poll_loop,
+            name=f"rule-watch-{os.path.basename(self.path)}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.reload()
+            except Exception as err:
+                logger.warning(f"检查规则文件失败 {self.path}: {err}")
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'reloads': self.reloads,
+            'errors': self.errors,
+            'last_reload_at': self.last_reload_at,
+            'poll_interval': self.poll_interval,
+        }
@@ -0,0 +1,105 @@
+"""
+进程内单飞（single-flight）合并
+
+同一个键同时只允许一个调用方（leader）执行实际工作，其余并发调用方等待 leader 的结果；
+leader 抛出的异常会原样传递给所有等待者。用于把秒杀时刻大量相同的提问合并为一次上游调用。
+"""
+import threading
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class FlightCall:
+    """一次进行中的调用。leader 必须调用 resolve 或 reject 之一。"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+        self.waiters = 0
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """等待 leader 结果；超时抛出 TimeoutError，leader 失败时抛出其异常。"""
+        if not self._event.wait(timeout):
+            raise TimeoutError('等待相同请求的结果超时')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class SingleFlight:
+    """按键合并并发调用。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def acquire(self, key):
+        """返回 (call, is_leader)。is_leader 为 True 时调用方负责执行工作并 resolve/reject。"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared += 1
+                return call, False
+            call = FlightCall()
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def resolve(self, key, call, result):
+        self._finish(key, call, result=result)
+
+    def reject(self, key, call, error):
+        self._finish(key, call, error=error)
+
+    def _finish(self, key, call, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        if call.done:
+            return
+        call._result = result
+        call._error = error
+        call._event.set()
+        if call.waiters:
+            logger.info(f"✅ 单飞合并完成 - 共享结果的等待请求: {call.waiters}")
+
+    def wait(self, call, timeout=None):
+        try:
+            return call.wait(timeout)
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+
+    def do(self, key, fn, timeout=None):
+        """执行 fn 或等待相同键进行中的调用，返回 (result, shared)。"""
+        call, leader = self.acquire(key)
+        if not leader:
+            return self.wait(call, timeout), True
+        try:
+            result = fn()
+        except Exception as e:
+            self.reject(key, call, e)
+            raise
+        self.resolve(key, call, result)
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'shared': self.shared,
+                'timeouts': self.timeouts,
+            }
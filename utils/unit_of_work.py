@@ -0,0 +1,114 @@
+"""
+请求级工作单元（unit of work）
+
+工作单元存在时，同一线程内所有 ``Database`` 方法共用一个数据库连接和一个事务：
+连接在第一次访问数据库时才获取，各方法拿到的是包装后的连接——``commit()`` 只释放本方法的
+保存点（savepoint），``close()`` 时未提交的改动回滚到保存点，单个方法失败仍不影响其他方法的写入。
+真正的提交在工作单元结束（或 ``checkpoint()``）时执行一次。
+
+进程内缓存的更新通过 ``defer()`` 登记，提交成功后才执行；失效类操作可指定回滚时同样执行。
+
+保存点语法在 MySQL 与 SQLite 中相同。
+"""
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ScopedConnection:
+    """交给 Database 方法的连接包装：commit/rollback/close 作用于本方法的保存点。"""
+
+    def __init__(self, uow, savepoint):
+        object.__setattr__(self, '_uow', uow)
+        object.__setattr__(self, '_savepoint', savepoint)
+        object.__setattr__(self, '_finished', False)
+
+    def __getattr__(self, name):
+        return getattr(self._uow.conn, name)
+
+    def __setattr__(self, name, value):
+        # 例如 SQLite 的 row_factory，直接设置到底层连接
+        setattr(self._uow.conn, name, value)
+
+    def commit(self):
+        if self._finished:
+            return
+        self._uow.release(self._savepoint)
+        self._uow.dirty = True
+        object.__setattr__(self, '_finished', True)
+
+    def rollback(self):
+        if self._finished:
+            return
+        self._uow.rollback_to(self._savepoint)
+        object.__setattr__(self, '_finished', True)
+
+    def close(self):
+        self.rollback()
+
+
+class UnitOfWork:
+    """一个线程内的工作单元。``connect()`` 返回新的底层连接（池化连接或 SQLite 连接）。"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, connect):
+        self._connect = connect
+        self.conn = None
+        self.dirty = False
+        self.depth = 0
+        self._deferred = []  # (回调, 回滚时是否也执行)
+
+    def connection(self):
+        """为一次 Database 方法调用返回包装连接；底层连接按需获取。"""
+        if self.conn is None:
+            conn = self._connect()
+            if conn is None:
+                return None
+            conn.cursor().execute("BEGIN")
+            self.conn = conn
+        savepoint = f"uow_{next(self._ids)}"
+        self.conn.cursor().execute(f"SAVEPOINT {savepoint}")
+        return ScopedConnection(self, savepoint)
+
+    def defer(self, callback, on_rollback=False):
+        """登记在当前事务提交成功后执行的回调；on_rollback 为 True 时事务回滚或提交失败也执行。"""
+        self._deferred.append((callback, on_rollback))
+
+    def release(self, savepoint):
+        try:
+            self.conn.cursor().execute(f"RELEASE SAVEPOINT {savepoint}")
+        except Exception as err:
+            logger.debug(f"释放保存点失败 {savepoint}: {err}")
+
+    def rollback_to(self, savepoint):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+            cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+        except Exception as err:
+            logger.debug(f"回滚保存点失败 {savepoint}: {err}")
+
+    def checkpoint(self, commit=True):
+        """结束当前事务并归还连接；之后的数据库访问会重新获取连接。提交失败时抛出异常。"""
+        conn, self.conn = self.conn, None
+        deferred, self._deferred = self._deferred, []
+        if conn is None:
+            return
+        committed = False
+        try:
+            if commit and self.dirty:
+                conn.commit()
+                committed = True
+            else:
+                conn.rollback()
+        finally:
+            self.dirty = False
+            conn.close()
+            for callback, on_rollback in deferred:
+                if committed or on_rollback:
+                    try:
+                        callback()
+                    except Exception as err:
+                        logger.warning(f"工作单元提交后回调失败: {err}")